@@ -0,0 +1,227 @@
+"""Benchmark the EOJ orchestration offline with the local EOJ client.
+
+Runs ``--chains`` cloud removal -> geomosaic -> resample -> bandmath chains
+through the scheduler, poller and journal used by ``geospatial_processing.py``,
+against ``LocalEarthObservationClient``. Failed chains are re-run from their
+journal until they all complete (or ``--max-rounds`` is reached), so the
+report also shows how much work failure recovery re-does.
+
+With ``--compare-batching``, the same weekly requests are also run as a
+single season wide chain (``--batch-weeks`` of ``geospatial_processing.py``)
+and the job count and wall-clock time of both modes are reported side by side.
+
+    python benchmark_eoj_orchestration.py --chains 6 --failure-rate 0.1
+    python benchmark_eoj_orchestration.py --chains 3 --compare-batching --latency-per-day 0.2
+"""
+import argparse
+import asyncio
+import dataclasses
+import glob
+import logging
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from geospatial_processing import EOJ_STAGES, batch_requests_manifests
+from utils.eoj_client_helper import create_earth_observation_client
+from utils.eoj_pipeline_helper import EarthObservationJobJournal, run_earth_observation_job_pipeline
+from utils.eoj_poller_helper import EarthObservationJobPoller
+from utils.eoj_scheduler_helper import EarthObservationJobScheduler
+from utils.fips_to_satellite_tiles_metadata_helper import split_satellite_images_by_window
+
+logger = logging.getLogger()
+
+BENCHMARK_AOI = [[(-89.0, 40.0), (-88.5, 40.0), (-88.5, 40.5), (-89.0, 40.5), (-89.0, 40.0)]]
+BENCHMARK_SPECTRAL_INDICES = [["NDVI", " ( nir - red ) / ( nir + red ) "]]
+
+
+def benchmark_input_config(context):
+    """Cloud removal query over a fixed AOI, no counties file needed."""
+    return {
+        "RasterDataCollectionQuery": {
+            "RasterDataCollectionArn": context["data_collections_arns"][1],
+            "AreaOfInterest": {
+                "AreaOfInterestGeometry": {"PolygonGeometry": {"Coordinates": BENCHMARK_AOI}}
+            },
+            "TimeRangeFilter": {"StartTime": context["start_time"], "EndTime": context["end_time"]},
+        }
+    }
+
+
+def benchmark_manifests(chains, week_gap):
+    """Weekly request manifests, ``week_gap`` weeks apart like phenology stages."""
+    first_week = datetime(2020, 6, 1)
+    manifests = {}
+    for idx in range(chains):
+        start_time = first_week + timedelta(weeks=idx * week_gap)
+        manifests[f"chain-{idx}"] = {
+            "startime": f"{start_time:%Y-%m-%dT%H:%M:%SZ}",
+            "endtime": f"{start_time + timedelta(days=6):%Y-%m-%dT%H:%M:%SZ}",
+            "week": start_time.isocalendar()[1],
+            "year": start_time.year,
+            "fips": "17001",
+            "spectralindices": BENCHMARK_SPECTRAL_INDICES,
+        }
+    return manifests
+
+
+def benchmark_contexts(manifests, data_collections_arns):
+    return {
+        chain_id: {
+            "start_time": manifest["startime"],
+            "end_time": manifest["endtime"],
+            "spectral_indices": manifest["spectralindices"],
+            "data_collections_arns": data_collections_arns,
+        }
+        for chain_id, manifest in manifests.items()
+    }
+
+
+async def run_round(client, stages, contexts, journal_dir, args):
+    scheduler = EarthObservationJobScheduler(
+        max_concurrent_chains=args.max_concurrent_chains,
+        max_concurrent_jobs=args.max_concurrent_jobs,
+        progress_interval=args.progress_interval,
+    )
+    poller = EarthObservationJobPoller(
+        client, first_check_delay=args.first_check_delay, max_delay=args.max_check_delay
+    )
+
+    async def chain(scheduler, chain_id):
+        journal = EarthObservationJobJournal(f"{journal_dir}/{chain_id}.json")
+        _, job_status = await run_earth_observation_job_pipeline(
+            client,
+            poller,
+            stages,
+            contexts[chain_id],
+            journal,
+            "arn:local:role/benchmark",
+            f"s3://benchmark/geospatial-results/{chain_id}/",
+            scheduler,
+            chain_id,
+        )
+        return job_status
+
+    results = await scheduler.run({chain_id: chain for chain_id in contexts})
+    return results, poller.api_calls
+
+
+def compare_batching(client, stages, manifests, data_collections_arns, output_dir, args):
+    """Run the weekly manifests one chain each, then as a single season chain."""
+    for mode, mode_manifests in [
+        ("per-week", manifests),
+        ("batched", batch_requests_manifests(manifests)),
+    ]:
+        jobs_before = client.jobs_started
+        started = time.monotonic()
+        contexts = benchmark_contexts(mode_manifests, data_collections_arns)
+        results, status_calls = asyncio.run(
+            run_round(client, stages, contexts, f"{output_dir}/journal-{mode}", args)
+        )
+        completed = sum(result == "COMPLETED" for result in results.values())
+        print(
+            f"{mode}: {completed}/{len(results)} chains completed"
+            f" in {time.monotonic() - started:.1f}s,"
+            f" {client.jobs_started - jobs_before} EOJs started,"
+            f" {status_calls} status API calls"
+        )
+
+        for chain_id, manifest in mode_manifests.items():
+            if "windows" not in manifest:
+                continue
+            images = glob.glob(f"{output_dir}/benchmark/geospatial-results/{chain_id}/*.tif")
+            windows_images = split_satellite_images_by_window(images, manifest["windows"])
+            print(
+                f"  {chain_id} split into weeks "
+                + ", ".join(
+                    f"{window['week']}: {len(window_images)} files"
+                    for window, window_images in zip(manifest["windows"], windows_images)
+                )
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chains", type=int, default=6)
+    parser.add_argument("--week-gap", type=int, default=1, help="Weeks between two requests")
+    parser.add_argument("--max-concurrent-chains", type=int, default=4)
+    parser.add_argument("--max-concurrent-jobs", type=int, default=4)
+    parser.add_argument("--min-latency", type=float, default=1.0)
+    parser.add_argument("--max-latency", type=float, default=3.0)
+    parser.add_argument(
+        "--latency-per-day",
+        type=float,
+        default=0.0,
+        help="Extra EOJ latency for every day of the queried time range",
+    )
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--throttling-rate", type=float, default=0.0)
+    parser.add_argument("--first-check-delay", type=float, default=0.2)
+    parser.add_argument("--max-check-delay", type=float, default=2.0)
+    parser.add_argument("--progress-interval", type=float, default=60)
+    parser.add_argument("--max-rounds", type=int, default=5)
+    parser.add_argument("--compare-batching", action="store_true")
+    parser.add_argument("--output-dir", type=str, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    output_dir = args.output_dir or tempfile.mkdtemp(prefix="local-eoj-")
+    client = create_earth_observation_client(
+        "local",
+        output_dir=output_dir,
+        latency=(args.min_latency, args.max_latency),
+        export_latency=(args.min_latency / 2, args.max_latency / 2),
+        latency_per_day=args.latency_per_day,
+        failure_rate=args.failure_rate,
+        throttling_rate=args.throttling_rate,
+        seed=args.seed,
+    )
+    data_collections_arns = [
+        c["Arn"] for c in client.list_raster_data_collections()["RasterDataCollectionSummaries"]
+    ]
+    stages = [dataclasses.replace(EOJ_STAGES[0], input_config=benchmark_input_config)]
+    stages += EOJ_STAGES[1:]
+    manifests = benchmark_manifests(args.chains, args.week_gap)
+
+    print(f"Synthetic EOJ outputs and journals under {output_dir}")
+    if args.compare_batching:
+        compare_batching(client, stages, manifests, data_collections_arns, output_dir, args)
+        return
+
+    contexts = benchmark_contexts(manifests, data_collections_arns)
+    started = time.monotonic()
+    pending = dict(contexts)
+    for round_idx in range(1, args.max_rounds + 1):
+        jobs_before = client.jobs_started
+        round_started = time.monotonic()
+        results, status_calls = asyncio.run(
+            run_round(client, stages, pending, f"{output_dir}/journal", args)
+        )
+        pending = {
+            chain_id: contexts[chain_id]
+            for chain_id, result in results.items()
+            if result != "COMPLETED"
+        }
+        print(
+            f"round {round_idx}: {len(results) - len(pending)}/{len(results)} chains completed"
+            f" in {time.monotonic() - round_started:.1f}s,"
+            f" {client.jobs_started - jobs_before} EOJs started,"
+            f" {status_calls} status API calls"
+        )
+        if not pending:
+            break
+
+    print(
+        f"total: {args.chains - len(pending)}/{args.chains} chains completed"
+        f" in {time.monotonic() - started:.1f}s,"
+        f" {client.jobs_started} EOJs started"
+        f" ({len(stages) * args.chains} without failures),"
+        f" {client.api_calls} API calls"
+    )
+
+
+if __name__ == "__main__":
+    main()
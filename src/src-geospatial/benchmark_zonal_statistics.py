@@ -0,0 +1,277 @@
+"""Compare the zonal statistics engines of ``feature_extraction.py`` offline.
+
+Computes the cells statistics of a synthetic multi-band county raster with
+rasterstats (one ``zonal_stats`` call per band) and with the label grid
+engine, checks that both give the same statistics and reports their times.
+
+With ``--check-windowed``, also runs the in-memory and the block-by-block
+(``--max-block-mb``) feature extraction of a synthetic county mosaic and
+checks that they give the same cells statistics.
+
+    python benchmark_zonal_statistics.py --bands 6 --size 2000 --cells 12
+    python benchmark_zonal_statistics.py --bands 3 --size 2000 --cells 12 --check-windowed
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import geopandas as gp
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform_geom
+from rasterstats import zonal_stats
+from shapely.geometry import box, mapping, shape
+
+from utils.zonal_statistics_helper import ZonalLabelIndex, rasterize_cell_labels, zonal_statistics
+
+NODATA = -9999
+
+
+def benchmark_raster(bands, size, nodata_rate, seed):
+    """Random bands over a ``size`` x ``size`` EPSG:4326 grid with nodata pixels."""
+    rng = np.random.default_rng(seed)
+    image = rng.random((bands, size, size), dtype="float32")
+    image[:, rng.random((size, size)) < nodata_rate] = NODATA
+    # Same ~10 m pixels as the masked county mosaics
+    return image, from_origin(-89.0, 41.0, 0.0001, 0.0001)
+
+
+def benchmark_cells(transform, size, cells):
+    """``cells`` x ``cells`` grid of square cells covering the raster."""
+    x0, y0 = transform.c, transform.f
+    step = size * transform.a / cells
+    return [
+        box(x0 + col * step, y0 - (row + 1) * step, x0 + (col + 1) * step, y0 - row * step)
+        for row in range(cells)
+        for col in range(cells)
+    ]
+
+
+class LocalRasterWriter:
+    """Keeps the crop mosaics of the extraction in a local directory instead of S3."""
+
+    def __init__(self, output_dirpath):
+        self.output_dirpath = output_dirpath
+
+    def _output_path(self, key):
+        key = key[0] if isinstance(key, list) else key
+        return os.path.join(self.output_dirpath, key.replace("/", "_"))
+
+    def write_array(self, array, profile, key):
+        with rasterio.open(self._output_path(key), "w", **{**profile, "driver": "GTiff"}) as dst:
+            dst.write(array)
+
+    def write_file(self, path, key):
+        shutil.move(path, self._output_path(key))
+
+    def wait(self):
+        pass
+
+
+def benchmark_county(temp_dirpath, bands, size, cells, nodata_rate, seed):
+    """Synthetic county: UTM mosaic, irregular EPSG:4326 county, Albers 30 m crop mask, cells."""
+    rng = np.random.default_rng(seed)
+    image = rng.random((bands, size, size), dtype="float32")
+    image[:, rng.random((size, size)) < nodata_rate] = NODATA
+    mosaic_path = os.path.join(temp_dirpath, "mosaic.tif")
+    mosaic_profile = {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "count": bands,
+        "nodata": NODATA,
+        "crs": "EPSG:32616",
+        "transform": from_origin(300000, 4500000, 10, 10),
+        "width": size,
+        "height": size,
+    }
+    with rasterio.open(mosaic_path, "w", **mosaic_profile) as dst:
+        dst.write(image)
+
+    # Irregular county well inside the mosaic, its boundary cuts through pixels
+    center = (300000 + size * 5, 4500000 - size * 5)
+    angles = np.linspace(0, 2 * np.pi, 37)[:-1]
+    radii = size * 10 * (0.3 + 0.1 * rng.random(len(angles)))
+    county_utm = shape(
+        {
+            "type": "Polygon",
+            "coordinates": [
+                [
+                    (center[0] + r * np.cos(a), center[1] + r * np.sin(a))
+                    for r, a in zip(np.append(radii, radii[0]), np.append(angles, angles[0]))
+                ]
+            ],
+        }
+    )
+    county = shape(transform_geom("EPSG:32616", "EPSG:4326", mapping(county_utm)))
+    geo_counties_fips = gp.GeoDataFrame({"FIPS": ["99999"]}, geometry=[county], crs="EPSG:4326")
+
+    crop_mask_path = os.path.join(temp_dirpath, "crop_mask.tif")
+    county_albers = gp.GeoSeries([county], crs="EPSG:4326").to_crs("EPSG:5070")
+    left, bottom, right, top = county_albers.total_bounds
+    crop_mask_width = int((right - left) // 30) + 20
+    crop_mask_height = int((top - bottom) // 30) + 20
+    with rasterio.open(
+        crop_mask_path,
+        "w",
+        driver="GTiff",
+        dtype="uint8",
+        count=1,
+        crs="EPSG:5070",
+        transform=from_origin(left - 300, top + 300, 30, 30),
+        width=crop_mask_width,
+        height=crop_mask_height,
+    ) as dst:
+        dst.write(
+            (rng.random((1, crop_mask_height, crop_mask_width)) < 0.6).astype("uint8")
+        )
+
+    minx, miny, maxx, maxy = county.bounds
+    step = max(maxx - minx, maxy - miny) / cells
+    zonal_polygons = gp.GeoDataFrame(
+        {"id_10": np.arange(cells * cells)},
+        geometry=[
+            box(
+                minx + col * step,
+                miny + row * step,
+                minx + (col + 1) * step,
+                miny + (row + 1) * step,
+            )
+            for row in range(cells)
+            for col in range(cells)
+        ],
+        crs="EPSG:4326",
+    )
+    return mosaic_path, crop_mask_path, geo_counties_fips, zonal_polygons
+
+
+def check_windowed(args):
+    """Cells statistics of the in-memory and the block-by-block extractions must match."""
+    from feature_extraction import (
+        extract_zonal_statistics_in_memory,
+        extract_zonal_statistics_windowed,
+    )
+    from utils.satellite_image_preparation_helper import crop_image_with_fips_shape_as_profile
+    from utils.windowed_raster_helper import PeakMemoryTracker
+
+    band_names = [f"band{idx + 1}" for idx in range(args.bands)]
+    temp_dirpath = tempfile.mkdtemp()
+    try:
+        mosaic_path, crop_mask_path, geo_counties_fips, zonal_polygons = benchmark_county(
+            temp_dirpath, args.bands, args.size, args.cells, args.nodata_rate, args.seed
+        )
+        crop_mask = crop_image_with_fips_shape_as_profile(
+            crop_mask_path, "99999", geo_counties_fips
+        )
+        crop_masks = {"corn": crop_mask}
+        mosaic_names = {"corn": "mosaic_corn.tif"}
+
+        started = time.monotonic()
+        in_memory = extract_zonal_statistics_in_memory(
+            mosaic_path,
+            "99999",
+            geo_counties_fips,
+            crop_masks,
+            zonal_polygons,
+            band_names,
+            mosaic_names,
+            "bincount",
+            None,
+            PeakMemoryTracker(),
+            LocalRasterWriter(temp_dirpath),
+        )["corn"]
+        in_memory_time = time.monotonic() - started
+
+        started = time.monotonic()
+        windowed = extract_zonal_statistics_windowed(
+            mosaic_path,
+            geo_counties_fips["geometry"].values,
+            crop_masks,
+            zonal_polygons,
+            band_names,
+            mosaic_names,
+            temp_dirpath,
+            args.max_block_mb * 1024**2,
+            PeakMemoryTracker(),
+            LocalRasterWriter(temp_dirpath),
+        )["corn"]
+        windowed_time = time.monotonic() - started
+    finally:
+        shutil.rmtree(temp_dirpath)
+
+    pd.testing.assert_frame_equal(windowed, in_memory, check_dtype=False, rtol=1e-6)
+    print(
+        f"County of {int(in_memory[f'count_{band_names[0]}'].sum())} valid pixels in"
+        f" {len(zonal_polygons)} cells: in memory {in_memory_time:.2f}s, by blocks of"
+        f" {args.max_block_mb} MB {windowed_time:.2f}s, statistics match"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bands", type=int, default=6)
+    parser.add_argument("--size", type=int, default=2000, help="Raster width and height in pixels")
+    parser.add_argument("--cells", type=int, default=12, help="Cells per row and column")
+    parser.add_argument("--nodata-rate", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--check-windowed",
+        action="store_true",
+        help="Also compare the in-memory and the block-by-block feature extraction",
+    )
+    parser.add_argument(
+        "--max-block-mb",
+        type=int,
+        default=1,
+        help="Block size of --check-windowed",
+    )
+    args = parser.parse_args()
+
+    image, transform = benchmark_raster(args.bands, args.size, args.nodata_rate, args.seed)
+    cells = benchmark_cells(transform, args.size, args.cells)
+    band_names = [f"band{idx + 1}" for idx in range(args.bands)]
+
+    started = time.monotonic()
+    reference = pd.concat(
+        [
+            pd.DataFrame.from_records(
+                zonal_stats(cells, band, affine=transform, nodata=NODATA)
+            ).add_suffix(f"_{band_name}")
+            for band, band_name in zip(image, band_names)
+        ],
+        axis=1,
+    )
+    rasterstats_time = time.monotonic() - started
+
+    started = time.monotonic()
+    labels = rasterize_cell_labels(cells, transform, image.shape[1:])
+    index = ZonalLabelIndex.from_labels(labels, len(cells))
+    result = zonal_statistics(index, image, band_names, nodata=NODATA)
+    bincount_time = time.monotonic() - started
+
+    # Following weeks load the cells label index saved by ZonalLabelIndexCache
+    saved_index = index.to_bytes()
+    started = time.monotonic()
+    zonal_statistics(ZonalLabelIndex.from_bytes(saved_index), image, band_names, nodata=NODATA)
+    cached_index_time = time.monotonic() - started
+
+    assert list(result.columns) == list(reference.columns), "Columns differ"
+    # rasterstats averages in float32, the label grid engine in float64
+    pd.testing.assert_frame_equal(result, reference, check_dtype=False, rtol=1e-5)
+
+    print(
+        f"{len(cells)} cells x {args.bands} bands over {args.size}x{args.size} pixels:"
+        f" rasterstats {rasterstats_time:.2f}s, label grid {bincount_time:.2f}s"
+        f" ({rasterstats_time / bincount_time:.1f}x), label grid with a cached index"
+        f" {cached_index_time:.2f}s ({rasterstats_time / cached_index_time:.1f}x), statistics match"
+    )
+
+    if args.check_windowed:
+        check_windowed(args)
+
+
+if __name__ == "__main__":
+    main()
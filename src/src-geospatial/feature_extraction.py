@@ -1,10 +1,10 @@
 import argparse
+import functools
 import glob
-import itertools
+import hashlib
 import json
 import logging
 import os
-import random
 import shutil
 import sys
 import tempfile
@@ -12,7 +12,6 @@ from os import path
 from shutil import move
 
 import boto3
-import dask.dataframe as dd
 import geopandas as gp
 import pandas as pd
 import rasterio
@@ -20,11 +19,60 @@ import rasterio.mask
 import rasterio.merge
 from rasterstats import zonal_stats
 
+from utils.crop_mask_cache_helper import CropMaskCache
+from utils.datacube_helper import (
+    datacube_uri,
+    write_datacube_week,
+    write_datacube_week_from_raster,
+)
+from utils.feature_extraction_manifest_helper import (
+    FeatureExtractionManifests,
+    polygons_digest,
+    read_tile_etags,
+    task_inputs_manifest,
+)
+from utils.feature_extraction_pool_helper import FeatureExtractionPool
+from utils.fips_to_satellite_tiles_metadata_helper import (
+    SatelliteTilesIndex,
+    read_satellite_tiles_catalog,
+    read_satellite_tiles_mapping_files,
+)
+from utils.raster_output_helper import (
+    BackgroundUploader,
+    DeferredUploader,
+    RasterOutputWriter,
+    TaskUploads,
+)
+from utils.remote_raster_helper import (
+    RemoteRasterCache,
+    configure_remote_raster_access,
+    read_network_stats,
+    reset_network_stats,
+)
 from utils.satellite_image_preparation_helper import (
-    crop_image_with_fips_shape,
+    build_band_stack_vrt,
+    crop_image_with_fips_shape_as_profile,
     get_first_day_in_isoweek,
-    reproject_tif_with_template_raster,
-    write_rasterio_image_from_numy_array,
+    reproject_array_like,
+    reproject_array_to_crs,
+)
+from utils.task_sharding_helper import (
+    check_input_fully_replicated,
+    county_areas,
+    read_host_index_and_count,
+    shard_tasks,
+)
+from utils.windowed_raster_helper import (
+    PeakMemoryTracker,
+    write_masked_county_mosaic,
+    zonal_statistics_windowed,
+)
+from utils.zonal_statistics_helper import ZonalLabelIndexCache, zonal_statistics
+from utils.zonal_statistics_parquet_helper import (
+    cell_polygons_parquet_uri,
+    write_cell_polygons_parquet,
+    write_zonal_statistics_parquet,
+    zonal_statistics_parquet_uri,
 )
 
 
@@ -47,260 +95,778 @@ spectral_indices = os.environ.get("SPECTRAL_INDICES")
 s3_client = boto3.client("s3")
 
 
-def sort_bands(bands_tiles, sort_order):
-    """Reorder input bands"""
-
-    res = {tile.split("/")[-1].split(".")[0].split("_")[-1]: tile for tile in bands_tiles}
-    res_list = list(enumerate(res))
+def stack_bands_into_single_tile(
+    tile_records, temp_dirpath, band_names, isoweek, remote_cache=None
+):
+    """Stack the band mosaics of a task, in ``band_names`` order, into a VRT.
 
-    return [res[y[1]] for x in sort_order for y in res_list if y[1] == x]
+    With ``remote_cache`` the band mosaics are fetched concurrently to the
+    local cache and the VRT references the local copies.
+    """
 
+    missing_bands = [
+        band for band in band_names if band not in {item["band_name"] for item in tile_records}
+    ]
+    if missing_bands:
+        raise ValueError(f"Bands {missing_bands} missing from the mosaics of week {isoweek}")
+
+    bands_tiles = [f"{item['mosaic_s3_path']}" for item in tile_records]
+    if remote_cache is not None:
+        bands_tiles = remote_cache.prefetch(bands_tiles)
+    # Counties of different requests have different mosaics for the same week
+    tiles_digest = hashlib.sha1(" ".join(bands_tiles).encode("UTF-8")).hexdigest()[:12]
+    merged_bands_output_path = os.path.join(temp_dirpath, f"merged_{isoweek}_{tiles_digest}.vrt")
+    if path.exists(merged_bands_output_path):
+        return merged_bands_output_path
+
+    # Workers may open the VRT as soon as it exists, only expose a complete file
+    build_band_stack_vrt(
+        bands_tiles, f"{merged_bands_output_path}.{os.getpid()}.tmp", band_names=band_names
+    )
+    os.replace(f"{merged_bands_output_path}.{os.getpid()}.tmp", merged_bands_output_path)
+    return merged_bands_output_path
 
-def stack_bands_into_single_tile(mapping, temp_dirpath, sort_order, isoweek):
 
-    bands_to_merge = [
-        {
-            "key": key,
-            "tiles_to_merge": [
-                f"{item['mosaic_s3_path']}" for item in group
-            ],
-        }
-        for key, group in itertools.groupby(mapping, key=lambda x: x["starttime"])
-    ]
+def crop_mask_grid(crop_mask_profile):
+    """Key of the grid of a crop mask, the crops of a county usually share it."""
+    return (
+        str(crop_mask_profile["crs"]),
+        tuple(crop_mask_profile["transform"]),
+        crop_mask_profile["height"],
+        crop_mask_profile["width"],
+    )
 
-    tiles_with_merged_bands = []
-    for item in bands_to_merge:
-        bands_tiles = item["tiles_to_merge"]
 
-        bands_tiles = " ".join(sort_bands(bands_tiles, sort_order))
-        bands_tiles = bands_tiles.replace("s3://", "/vsis3/")
-        merged_bands_output_path = os.path.join(temp_dirpath, f"merged_{isoweek}.tif")
-        tiles_with_merged_bands.append(merged_bands_output_path)
-        cmd = f"rio stack {bands_tiles} -o {merged_bands_output_path}" " --overwrite"
-        os.system(cmd)
+def extract_zonal_statistics_in_memory(
+    merged_mosaic_path,
+    fips,
+    geo_counties_fips,
+    crop_masks,
+    zonal_polygons,
+    band_names,
+    mosaic_names,
+    zonal_stats_engine,
+    cell_index_cache,
+    memory_tracker,
+    raster_writer,
+    datacube_uris=None,
+    isoweek=None,
+):
+    """Crop, reproject and mask the county mosaic in memory, returns the cells statistics.
+
+    ``crop_masks`` maps each crop to its ``(image, profile)`` crop mask. The
+    mosaic is read and cropped once, and reprojected once per crop mask grid;
+    every crop mask is then applied to the same aligned array. Returns the
+    statistics of each crop. With ``datacube_uris`` the masked pixels of each
+    crop are also written as the week ``isoweek`` of its datacube.
+    """
+
+    # ====================================================================
+    #  Crop the mosaic using county's shape
+    # ====================================================================
+    logger.info("Crop the combined mosaic using the county's shape")
+
+    county_image, county_profile = crop_image_with_fips_shape_as_profile(
+        merged_mosaic_path, fips, geo_counties_fips
+    )
 
-    return tiles_with_merged_bands
+    crops_by_grid = {}
+    for type_of_crop, (_, crop_mask_profile) in crop_masks.items():
+        crops_by_grid.setdefault(crop_mask_grid(crop_mask_profile), []).append(type_of_crop)
 
+    stats_by_crop = {}
+    for grid_crops in crops_by_grid.values():
+        # ====================================================================
+        #  Reproject satellite image to use the same crop_mask's projection
+        # ====================================================================
 
-def get_tiles_for_fips_isoweek_year(fips, starttime, endtime, mapping_df, band_names):
-    res = mapping_df[
-        (mapping_df["FIPS"] == fips)
-        & (mapping_df["starttime"] == starttime)
-        & (mapping_df["endtime"] == endtime)
-    ]
-    res = res[res["band_name"].isin(band_names)]
-    return res.to_dict(orient="records")
+        logger.info(f"Reproject the satellite image to the crop_mask's grid of {grid_crops}")
 
+        mosaic_image, mosaic_profile = reproject_array_like(
+            county_image, county_profile, crop_masks[grid_crops[0]][1]
+        )
+        logger.info(f"Reprojected mosaic shape {mosaic_image.shape}")
+        memory_tracker.sample()
 
-def handler(event, geo_counties_fips, mapping_df, temp_dirpath):
-    starttime = event["starttime"]
-    endtime = event["endtime"]
-    fips = str(event["fips"])
-    type_of_crop = event["type_of_crop"]
-    band_names = spectral_indices.split(",")
+        logger.info("Upload the crop mosaic to s3")
+        raster_writer.write_array(
+            mosaic_image,
+            mosaic_profile,
+            [f"crop-mosaic/{mosaic_names[type_of_crop]}" for type_of_crop in grid_crops],
+        )
 
-    year, isoweek = event["year"], event["week"]
+        for type_of_crop in grid_crops:
+            stats_by_crop[type_of_crop] = extract_crop_zonal_statistics_in_memory(
+                mosaic_image,
+                mosaic_profile,
+                crop_masks[type_of_crop][0],
+                fips,
+                zonal_polygons,
+                band_names,
+                mosaic_names[type_of_crop],
+                zonal_stats_engine,
+                cell_index_cache,
+                memory_tracker,
+                raster_writer,
+                datacube_uri=(datacube_uris or {}).get(type_of_crop),
+                isoweek=isoweek,
+            )
 
-    try:
-        logger.info(f"Using temp_dirpath = {temp_dirpath}")
-        # ====================================================================
-        #  Get mapping between fips, isoweek, year and geotiffs paths in s3
-        # ====================================================================
+    return stats_by_crop
+
+
+def extract_crop_zonal_statistics_in_memory(
+    mosaic_image,
+    mosaic_profile,
+    crop_mask_image,
+    fips,
+    zonal_polygons,
+    band_names,
+    mosaic_name,
+    zonal_stats_engine,
+    cell_index_cache,
+    memory_tracker,
+    raster_writer,
+    datacube_uri=None,
+    isoweek=None,
+):
+    """Statistics of the cells over the mosaic masked with one crop mask of the same grid."""
+
+    # ====================================================================
+    #  Applying the crop mask and reproject the mosaic to the cells polygons's crs
+    # ====================================================================
+
+    # Like rio calc, pixels without data in the mosaic stay nodata
+    masked_image = (mosaic_image * crop_mask_image[:1]).astype(mosaic_image.dtype)
+    if mosaic_profile["nodata"] is not None:
+        masked_image[mosaic_image == mosaic_profile["nodata"]] = mosaic_profile["nodata"]
+    memory_tracker.sample()
+
+    logger.info("Upload the crop mosaic [masked] to s3")
+    raster_writer.write_array(
+        masked_image, mosaic_profile, f"crop-mosaic-masked/{mosaic_name}"
+    )
 
-        logger.info("Get mapping between (fips, week, year) and s3 paths from mapping file")
-        
-        fips_tile_paths = get_tiles_for_fips_isoweek_year(
-            fips, starttime, endtime, mapping_df, band_names
+    if datacube_uri is not None:
+        logger.info(f"Write the masked pixels of week {isoweek} to {datacube_uri}")
+        write_datacube_week(
+            datacube_uri, isoweek, masked_image, crop_mask_image, mosaic_profile, band_names
         )
+        memory_tracker.sample()
 
+    masked_image, masked_profile = reproject_array_to_crs(
+        masked_image, mosaic_profile, "EPSG:4326"
+    )
+    memory_tracker.sample()
 
-        tiles_in_s3 = [
-            f"{item['mosaic_s3_path']}"
-            for item in fips_tile_paths
-        ]
+    # ====================================================================
+    #  Create zonal statistics by using the cells polygons
+    # ====================================================================
 
-        logger.info(f"Band file in s3 to stack: {tiles_in_s3}")
+    logger.info("Compute zonal statistics for the cells polygons")
 
-        # ====================================================================
-        #  Merge bands into a single multi-channel mosaic
-        # ====================================================================
+    if zonal_stats_engine == "rasterstats":
+        all_stats = []
+        for band_idx, band_name in enumerate(band_names):
 
-        if not path.exists(f"{temp_dirpath}/merged_{isoweek}.tif"):
+            stats = zonal_stats(
+                zonal_polygons,
+                masked_image[band_idx],
+                affine=masked_profile["transform"],
+                nodata=masked_profile["nodata"],
+            )
 
-            logger.info("Merge all bands into a single multi-channel mosaic")
-            stack_bands_into_single_tile(fips_tile_paths, temp_dirpath, band_names, isoweek)
+            logger.debug(f"Zonal statistics of {len(stats)} cells for the band {band_name}")
 
-        # ====================================================================
-        #  Crop the mosaic using county's shape
-        # ====================================================================
-        logger.info("Crop the combined mosaic using the county's shape")
+            zonal_stats_df = pd.DataFrame.from_records(stats)
+            zonal_stats_df = zonal_stats_df.add_suffix("_{}".format(band_name))
+            all_stats.append(zonal_stats_df)
 
-        out_image, out_transform, out_meta, raster_meta = crop_image_with_fips_shape(
-            f"{temp_dirpath}/merged_{isoweek}.tif",
+        all_stats_gf = pd.concat(all_stats, axis=1)
+    else:
+        # The cells label index only depends on the county and the crop mask grid
+        cell_index = (cell_index_cache or ZonalLabelIndexCache()).get(
             fips,
-            geo_counties_fips,
-            geojson_projection="EPSG:4326",
+            zonal_polygons.geometry,
+            masked_profile["transform"],
+            masked_profile["crs"],
+            masked_image.shape[1:],
+            cell_ids=zonal_polygons["id_10"].to_numpy() if "id_10" in zonal_polygons else None,
         )
-
-        # Prepare the output raster image metadata
-        output_raster_metadata = raster_meta.copy()
-        output_raster_metadata["transform"] = out_transform
-        output_raster_metadata["height"] = out_image.shape[1]
-        output_raster_metadata["width"] = out_image.shape[2]
-
-        # Write the cropped raster image.
-        mosaic_prefix = f"s2-l2a_sat_image_{fips}"
-        write_rasterio_image_from_numy_array(
-            f"{temp_dirpath}/{mosaic_prefix}_cropped.tif",
-            out_image,
-            output_raster_metadata,
+        all_stats_gf = zonal_statistics(
+            cell_index, masked_image, band_names, nodata=masked_profile["nodata"]
         )
-
-        # ====================================================================
-        #  Crop the mask file using county's shape and upload to s3
-        # ====================================================================
-        crop_mask_s3_path = (
-            f"s3://{input_crop_mask_bucket_name}"
-            f"/{input_crop_mask_prefix}"
-            f"/{year}/{fips}/cdl_{type_of_crop}_mask_{fips}.tif"
+    memory_tracker.sample()
+
+    return all_stats_gf
+
+
+def extract_zonal_statistics_windowed(
+    merged_mosaic_path,
+    county_geometries,
+    crop_masks,
+    zonal_polygons,
+    band_names,
+    mosaic_names,
+    temp_dirpath,
+    max_block_bytes,
+    memory_tracker,
+    raster_writer,
+    datacube_uris=None,
+    isoweek=None,
+):
+    """Same outputs as ``extract_zonal_statistics_in_memory``, processed by blocks of rows.
+
+    The crop mosaics are written block by block to local GeoTIFFs then handed
+    to ``raster_writer``, and the statistics are accumulated block by block, so
+    the memory used does not grow with the size of the county. The mosaic is
+    read once per crop mask grid, every crop mask of the grid is applied to
+    the same blocks.
+    """
+    crops_by_grid = {}
+    for type_of_crop, (_, crop_mask_profile) in crop_masks.items():
+        crops_by_grid.setdefault(crop_mask_grid(crop_mask_profile), []).append(type_of_crop)
+
+    stats_by_crop = {}
+    for grid_crops in crops_by_grid.values():
+        mosaic_path = os.path.join(
+            temp_dirpath, mosaic_names[grid_crops[0]].replace("/", "_")
         )
+        masked_paths = {
+            type_of_crop: os.path.join(
+                temp_dirpath, f"masked_{mosaic_names[type_of_crop].replace('/', '_')}"
+            )
+            for type_of_crop in grid_crops
+        }
 
-        logger.info("Crop the crop_mask image with the fips geometry")
-        (
-            crop_mask_out_image,
-            mask_out_transform,
-            mask_out_meta,
-            mask_raster_meta,
-        ) = crop_image_with_fips_shape(
-            crop_mask_s3_path, fips, geo_counties_fips, geojson_projection="EPSG:4326"
-        )
+        try:
+            logger.info(
+                f"Crop, reproject and mask the mosaic for {grid_crops}"
+                f" by blocks of {max_block_bytes} bytes"
+            )
+            write_masked_county_mosaic(
+                merged_mosaic_path,
+                county_geometries,
+                [crop_masks[type_of_crop][0] for type_of_crop in grid_crops],
+                crop_masks[grid_crops[0]][1],
+                mosaic_path,
+                [masked_paths[type_of_crop] for type_of_crop in grid_crops],
+                max_block_bytes,
+                memory_tracker=memory_tracker,
+            )
 
-        mask_output_raster_metadata = mask_raster_meta.copy()
-        mask_output_raster_metadata["transform"] = mask_out_transform
-        mask_output_raster_metadata["height"] = crop_mask_out_image.shape[1]
-        mask_output_raster_metadata["width"] = crop_mask_out_image.shape[2]
+            logger.info("Upload the crop mosaic to s3")
+            raster_writer.write_file(
+                mosaic_path,
+                [f"crop-mosaic/{mosaic_names[type_of_crop]}" for type_of_crop in grid_crops],
+            )
 
-        write_rasterio_image_from_numy_array(
-            f"{temp_dirpath}/cdl_{type_of_crop}_mask_{fips}_cropped.tif",
-            crop_mask_out_image,
-            mask_output_raster_metadata,
+            for type_of_crop in grid_crops:
+                logger.info(f"Compute zonal statistics of {type_of_crop} for the cells by blocks")
+                stats_by_crop[type_of_crop] = zonal_statistics_windowed(
+                    masked_paths[type_of_crop],
+                    zonal_polygons.geometry,
+                    band_names,
+                    max_block_bytes,
+                    memory_tracker=memory_tracker,
+                )
+
+                if datacube_uris is not None:
+                    logger.info(
+                        f"Write the masked pixels of week {isoweek}"
+                        f" to {datacube_uris[type_of_crop]} by blocks"
+                    )
+                    write_datacube_week_from_raster(
+                        datacube_uris[type_of_crop],
+                        isoweek,
+                        masked_paths[type_of_crop],
+                        crop_masks[type_of_crop][0],
+                        band_names,
+                        max_block_bytes,
+                    )
+
+                logger.info("Upload the crop mosaic [masked] to s3")
+                raster_writer.write_file(
+                    masked_paths[type_of_crop],
+                    f"crop-mosaic-masked/{mosaic_names[type_of_crop]}",
+                )
+        except BaseException:
+            # Files handed to the writer were moved away, only the others are left
+            for output_path in (mosaic_path, *masked_paths.values()):
+                if path.exists(output_path):
+                    os.remove(output_path)
+            raise
+
+    return stats_by_crop
+
+
+def zonal_statistics_output_uri(output_format, type_of_crop, year, isoweek, fips):
+    if output_format == "parquet":
+        return zonal_statistics_parquet_uri(
+            f"s3://{output_bucket_name}/data/zonal-statistics-parquet",
+            type_of_crop,
+            year,
+            isoweek,
+            fips,
         )
+    return (
+        f"s3://{output_bucket_name}/data/zonal-statistics-allbands/{type_of_crop}/{year}/isoweek-{isoweek}/"
+        f"zonal_stats_{fips}.csv"
+    )
+
 
+def handler(
+    event,
+    geo_counties_fips,
+    tiles_index,
+    temp_dirpath,
+    cell_index_cache=None,
+    crop_mask_cache=None,
+    manifests=None,
+    uploader=None,
+    remote_cache=None,
+):
+    starttime = event["starttime"]
+    endtime = event["endtime"]
+    fips = str(event["fips"])
+    # Every crop is extracted from the same mosaic read
+    types_of_crop = event.get("types_of_crop") or [event["type_of_crop"]]
+    band_names = spectral_indices.split(",")
+
+    year, isoweek = event["year"], event["week"]
+
+    try:
+        logger.info(f"Using temp_dirpath = {temp_dirpath}")
         # ====================================================================
-        #  Reproject satellite image to use the same crop_mask's projection
+        #  Get mapping between fips, isoweek, year and geotiffs paths in s3
         # ====================================================================
 
-        logger.info("Reproject the satellite image to the crop_mask's projection")
-
-        src_file = f"{temp_dirpath}/{mosaic_prefix}_cropped.tif"
-        dst_file = f"{temp_dirpath}/{mosaic_prefix}_cropped_resized.tif"
+        logger.info("Get mapping between (fips, week, year) and s3 paths from mapping file")
 
-        # reproject sat image to Mask projection using WKT file
-        # reproject_tiff_with_wkt(src_file, local_wkt_file, dst_file)
-        # template raster used to deduce crs, affline, etc.
+        fips_tile_paths = tiles_index.get(fips, starttime, endtime)
 
-        mask_cropped_path = f"{temp_dirpath}/cdl_{type_of_crop}_mask_{fips}_cropped.tif"
-        template_raster = f"{temp_dirpath}/cdl_{type_of_crop}_mask_{fips}_cropped.tif"
+        tiles_in_s3 = [
+            f"{item['mosaic_s3_path']}"
+            for item in fips_tile_paths
+        ]
 
-        reproject_tif_with_template_raster(src_file, dst_file, template_raster)
+        logger.info(f"Band file in s3 to stack: {tiles_in_s3}")
 
-        print(f"resized_file {dst_file} size: {rasterio.open(mask_cropped_path).read(1).shape}")
-        print(
-            f"small file {mask_cropped_path} size: {rasterio.open(mask_cropped_path).read(1).shape}"
-        )
+        crop_mask_s3_paths = {
+            type_of_crop: (
+                f"s3://{input_crop_mask_bucket_name}"
+                f"/{input_crop_mask_prefix}"
+                f"/{year}/{fips}/cdl_{type_of_crop}_mask_{fips}.tif"
+            )
+            for type_of_crop in types_of_crop
+        }
+        polygons_shp_file = f"/opt/ml/processing/input/polygons/cell_polygons_{fips}.shp"
+        output_format = event.get("output_format", "csv")
+        zonal_stats_uris = {
+            type_of_crop: zonal_statistics_output_uri(
+                output_format, type_of_crop, year, isoweek, fips
+            )
+            for type_of_crop in types_of_crop
+        }
 
         # ====================================================================
-        #  Applying the crop mask and reproject the mosaic to the cells polygons's crs
+        #  Skip the outputs whose inputs did not change since the last run
         # ====================================================================
 
-        logger.info("Upload the crop mosaic to s3")
-        s3_client.upload_file(
-            f"{temp_dirpath}/{mosaic_prefix}_cropped_resized.tif",
-            output_bucket_name,
-            f"crop-mosaic/{isoweek}/mosaic_{type_of_crop}_{year}_{fips}.tif",
-        )
-
-        rio_calc = "(* (read 1) (read 2))"
-
-        cmd = (
-            f'rio calc "{rio_calc}" "{temp_dirpath}/{mosaic_prefix}_cropped_resized.tif"'
-            f' "{temp_dirpath}/cdl_{type_of_crop}_mask_{fips}_cropped.tif"'
-            f' -o "{temp_dirpath}/{mosaic_prefix}_masked.tif" --overwrite'
-        )
-        os.system(cmd)
+        if manifests is not None:
+            # The tiles are shared by the crops, their ETags are read once
+            tile_etags = read_tile_etags(tiles_in_s3)
+            crop_manifests = {
+                type_of_crop: task_inputs_manifest(
+                    tile_etags,
+                    crop_mask_s3_paths[type_of_crop],
+                    polygons_shp_file,
+                    band_names,
+                    options={
+                        "zonal_stats_engine": event.get("zonal_stats_engine", "bincount"),
+                        "output_format": output_format,
+                        "raster_format": event.get("raster_format", "cog"),
+                        # None for the in-memory processing
+                        "max_block_mb": event.get("max_block_mb"),
+                        # Only when set, the manifests of the runs without datacube stay valid
+                        **(
+                            {"datacube_uri": event["datacube_uri"]}
+                            if event.get("datacube_uri")
+                            else {}
+                        ),
+                    },
+                )
+                for type_of_crop in types_of_crop
+            }
+            types_of_crop = [
+                type_of_crop
+                for type_of_crop in types_of_crop
+                if not manifests.is_up_to_date(
+                    type_of_crop,
+                    year,
+                    isoweek,
+                    fips,
+                    crop_manifests[type_of_crop],
+                    zonal_stats_uris[type_of_crop],
+                )
+            ]
+            if not types_of_crop:
+                logger.info(f"Inputs of FIPS {fips} week {isoweek} did not change, skipping")
+                return {
+                    "result": "skipped",
+                    "fips": f"{fips}",
+                    "isoweek": f"{isoweek}",
+                    "year": f"{year}",
+                }
 
-        logger.info("Upload the crop mosaic [masked] to s3")
-        s3_client.upload_file(
-            f"{temp_dirpath}/{mosaic_prefix}_masked.tif",
-            output_bucket_name,
-            f"crop-mosaic-masked/{isoweek}/mosaic_{type_of_crop}_{year}_{fips}.tif",
-        )
+        # ====================================================================
+        #  Merge bands into a single multi-channel mosaic
+        # ====================================================================
 
-        cmd = (
-            f"rio warp --dst-crs EPSG:4326 '{temp_dirpath}/{mosaic_prefix}_masked.tif'"
-            f" -o '{temp_dirpath}/{mosaic_prefix}_masked_resized.tif' --overwrite"
+        logger.info("Stack all bands into a single multi-channel VRT mosaic")
+        reset_network_stats()
+        remote_io_before = dict(remote_cache.counters) if remote_cache is not None else None
+        merged_mosaic_path = stack_bands_into_single_tile(
+            fips_tile_paths, temp_dirpath, band_names, isoweek, remote_cache=remote_cache
         )
-        os.system(cmd)
 
         # ====================================================================
-        #  Create zonal statistics by using the cells polygons
+        #  Crop the crop masks using county's shape
         # ====================================================================
 
-        logger.info("Compute zonal statistics for the cells polygons")
-
-        all_stats = []
-
-        polygons_shp_file = f"/opt/ml/processing/input/polygons/cell_polygons_{fips}.shp"
-        rasters_file = f"{temp_dirpath}/{mosaic_prefix}_masked_resized.tif"
+        # The crop mask only changes by year, it is prepared once for all the weeks
+        logger.info(f"Crop the crop_mask images of {types_of_crop} with the fips geometry")
+        crop_masks = {
+            type_of_crop: (crop_mask_cache or CropMaskCache()).get(
+                (int(year), fips, type_of_crop),
+                functools.partial(
+                    crop_image_with_fips_shape_as_profile,
+                    crop_mask_s3_paths[type_of_crop],
+                    fips,
+                    geo_counties_fips,
+                ),
+            )
+            for type_of_crop in types_of_crop
+        }
 
         zonal_polygons = gp.read_file(polygons_shp_file)
 
-        for band_idx, band_name in enumerate(band_names):
-
-            stats = zonal_stats(polygons_shp_file, rasters_file, band=band_idx + 1)
-
-            print(
-                f"band name {band_name}, zonal stats {random.sample(stats, 2)}",
-                end="\n\n",
+        mosaic_names = {
+            type_of_crop: f"{isoweek}/mosaic_{type_of_crop}_{year}_{fips}.tif"
+            for type_of_crop in types_of_crop
+        }
+        # The masked pixels of every week of the season go to one datacube per county and crop
+        datacube_uris = (
+            {
+                type_of_crop: datacube_uri(event["datacube_uri"], type_of_crop, year, fips)
+                for type_of_crop in types_of_crop
+            }
+            if event.get("datacube_uri")
+            else None
+        )
+        memory_tracker = PeakMemoryTracker()
+        # The crop mosaics are uploaded while the zonal statistics are computed
+        task_uploader = uploader or BackgroundUploader(output_bucket_name)
+        raster_writer = RasterOutputWriter(
+            task_uploader, temp_dirpath, raster_format=event.get("raster_format", "cog")
+        )
+        if event.get("max_block_mb"):
+            stats_by_crop = extract_zonal_statistics_windowed(
+                merged_mosaic_path,
+                geo_counties_fips[geo_counties_fips["FIPS"] == fips]["geometry"].values,
+                crop_masks,
+                zonal_polygons,
+                band_names,
+                mosaic_names,
+                temp_dirpath,
+                event["max_block_mb"] * 1024**2,
+                memory_tracker,
+                raster_writer,
+                datacube_uris=datacube_uris,
+                isoweek=isoweek,
             )
-
-            zonal_stats_df = pd.DataFrame.from_records(stats)
-            zonal_stats_df = zonal_stats_df.add_suffix("_{}".format(band_name))
-            all_stats.append(zonal_stats_df)
-
-        all_stats_gf = pd.concat(all_stats, axis=1)
-        all_stats_gf = pd.concat([all_stats_gf, zonal_polygons], axis=1)
-
-        # upload to s3 the concatenated zonal statistics for each isoweek/ fips combination
-        all_stats_gf.to_csv(
-            f"s3://{output_bucket_name}/data/zonal-statistics-allbands/{type_of_crop}/{year}/isoweek-{isoweek}/"
-            f"zonal_stats_{fips}.csv",
-            index=False,
+        else:
+            stats_by_crop = extract_zonal_statistics_in_memory(
+                merged_mosaic_path,
+                fips,
+                geo_counties_fips,
+                crop_masks,
+                zonal_polygons,
+                band_names,
+                mosaic_names,
+                event.get("zonal_stats_engine", "bincount"),
+                cell_index_cache,
+                memory_tracker,
+                raster_writer,
+                datacube_uris=datacube_uris,
+                isoweek=isoweek,
+            )
+        logger.info(
+            f"Peak memory {memory_tracker.peak_mb:.0f} MB"
+            f" (+{memory_tracker.increase_mb:.0f} MB for this task)"
         )
 
+        if output_format == "parquet":
+            # The cell polygons are written once per county, the statistics refer to them by id_10
+            write_cell_polygons_parquet(
+                zonal_polygons,
+                cell_polygons_parquet_uri(
+                    f"s3://{output_bucket_name}/data/cell-polygons-parquet", fips
+                ),
+                polygons_digest(polygons_shp_file),
+            )
+        for type_of_crop, all_stats_gf in stats_by_crop.items():
+            if output_format == "parquet":
+                write_zonal_statistics_parquet(
+                    all_stats_gf, zonal_polygons, zonal_stats_uris[type_of_crop]
+                )
+            else:
+                all_stats_gf = pd.concat([all_stats_gf, zonal_polygons], axis=1)
+
+                # upload to s3 the concatenated zonal statistics for each isoweek/ fips combination
+                all_stats_gf.to_csv(zonal_stats_uris[type_of_crop], index=False)
+
+        deferred_uploads = isinstance(task_uploader, DeferredUploader)
+        if not deferred_uploads:
+            logger.info("Wait for the crop mosaics uploads")
+            raster_writer.wait()
+            if uploader is None:
+                task_uploader.close()
+
+            # Recorded last, an interrupted task runs again on the next incremental run
+            if manifests is not None:
+                for type_of_crop in types_of_crop:
+                    manifests.put(type_of_crop, year, isoweek, fips, crop_manifests[type_of_crop])
+
         result = os.listdir(f"{temp_dirpath}")
 
         logger.info("Finished successfully")
-        return {
+        task_result = {
             "result": "success",
             "fips": f"{fips}",
             "isoweek": f"{isoweek}",
             "year": f"{year}",
+            "crops": types_of_crop,
             "output": result,
+            "peak_memory_mb": round(memory_tracker.peak_mb),
         }
+        if deferred_uploads:
+            # Uploaded by the parent process while this worker goes on with the next task,
+            # the manifests are recorded there once the rasters are uploaded
+            task_result["uploads"] = task_uploader.take()
+            if manifests is not None:
+                task_result["manifests"] = {
+                    type_of_crop: crop_manifests[type_of_crop] for type_of_crop in types_of_crop
+                }
+        # Range reads through /vsis3/, and the whole files the cache downloaded if enabled
+        task_result["remote_io"] = {
+            f"vsis3_{counter}": value for counter, value in read_network_stats().items()
+        }
+        if remote_cache is not None:
+            task_result["remote_io"].update(
+                (counter, value - remote_io_before[counter])
+                for counter, value in remote_cache.counters.items()
+            )
+        return task_result
     except Exception as e:
         error_msg = f"=== Error processing FIPS: {fips}  Week: {isoweek} ==="
         logger.error(error_msg)
+        if isinstance(uploader, DeferredUploader):
+            # Partial outputs of the failed task, not to be uploaded with the next task
+            uploader.discard()
         raise e
 
 
+# State of a feature extraction worker process, set by init_feature_extraction_worker
+worker_state = {}
+
+
+def init_feature_extraction_worker(
+    geo_counties_fips,
+    tiles_index,
+    temp_dirpath,
+    cell_index_cache_uri,
+    crop_mask_cache_bytes,
+    manifests_uri=None,
+    remote_cache_bytes=0,
+):
+    worker_state.update(
+        geo_counties_fips=geo_counties_fips,
+        tiles_index=tiles_index,
+        temp_dirpath=temp_dirpath,
+        cell_index_cache=ZonalLabelIndexCache(cell_index_cache_uri),
+        # Spilled masks are shared by the workers of the executor
+        crop_mask_cache=CropMaskCache(
+            max_bytes=crop_mask_cache_bytes,
+            spill_dir=os.path.join(temp_dirpath, "crop-mask-cache"),
+        ),
+        manifests=FeatureExtractionManifests(manifests_uri) if manifests_uri else None,
+        # The rasters are uploaded by the parent process, see TaskUploads
+        uploader=DeferredUploader(),
+        remote_cache=remote_raster_cache(temp_dirpath, remote_cache_bytes),
+    )
+
+
+def run_feature_extraction_task(task):
+    return handler(
+        task,
+        worker_state["geo_counties_fips"],
+        worker_state["tiles_index"],
+        worker_state["temp_dirpath"],
+        cell_index_cache=worker_state["cell_index_cache"],
+        crop_mask_cache=worker_state["crop_mask_cache"],
+        manifests=worker_state["manifests"],
+        uploader=worker_state["uploader"],
+        remote_cache=worker_state["remote_cache"],
+    )
+
+
+def record_task_manifests(manifests, result):
+    """Record the manifests of a task once its rasters are uploaded, see ``TaskUploads``.
+
+    Recorded last, an interrupted task runs again on the next incremental run.
+    """
+    for type_of_crop, manifest in result.pop("manifests", {}).items():
+        manifests.put(type_of_crop, result["year"], result["isoweek"], result["fips"], manifest)
+
+
+def remote_raster_cache(temp_dirpath, max_bytes):
+    """Cache of the band mosaics shared by the processes of the executor, None if disabled."""
+    if not max_bytes:
+        return None
+    return RemoteRasterCache(os.path.join(temp_dirpath, "remote-raster-cache"), max_bytes)
+
+
+def stack_week_mosaics(week_tasks, tiles_index, temp_dirpath, remote_cache=None):
+    """Build the stacked VRT mosaics of a week once, before its counties are processed."""
+    week_tiles = [
+        tiles_index.get(task["fips"], task["starttime"], task["endtime"]) for task in week_tasks
+    ]
+    if remote_cache is not None:
+        # All the band mosaics of the week are fetched at once, concurrently
+        remote_cache.prefetch(
+            sorted({item["mosaic_s3_path"] for tiles in week_tiles for item in tiles})
+        )
+
+    for task, tiles in zip(week_tasks, week_tiles):
+        stack_bands_into_single_tile(
+            tiles,
+            temp_dirpath,
+            tiles_index.band_names,
+            task["week"],
+            remote_cache=remote_cache,
+        )
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--crop-type", type=str, required=True)
+    parser.add_argument(
+        "--crop-type",
+        type=str,
+        required=True,
+        help="Crop of the CDL masks, or comma separated crops (corn,soybeans) extracted"
+        " from the same mosaic reads",
+    )
+    parser.add_argument(
+        "--zonal-stats-engine",
+        type=str,
+        default="bincount",
+        choices=["bincount", "rasterstats"],
+        help="Compute the cells statistics from a label grid in one pass, or with rasterstats",
+    )
+    parser.add_argument(
+        "--cell-index-cache-uri",
+        type=str,
+        default=None,
+        help="Local directory or S3 prefix of the cells label indexes (default s3://<output-bucket>/cell-index-cache)",
+    )
+    parser.add_argument("--disable-cell-index-cache", action="store_true")
+    parser.add_argument(
+        "--crop-mask-cache-mb",
+        type=int,
+        default=1024,
+        help="Memory used to keep the cropped crop masks, the rest is spilled to local disk",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes extracting the counties features (default one per core),"
+        " 1 runs every task in the main process",
+    )
+    parser.add_argument(
+        "--max-block-mb",
+        type=int,
+        default=None,
+        help="Process the county rasters by blocks of rows of at most this size,"
+        " instead of holding them in memory",
+    )
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        default="csv",
+        choices=["csv", "parquet"],
+        help="CSV files with the cells geometry as WKT, or a Parquet dataset partitioned by"
+        " crop_type, year and isoweek with the cell polygons stored once per county",
+    )
+    parser.add_argument(
+        "--raster-format",
+        type=str,
+        default="cog",
+        choices=["cog", "gtiff"],
+        help="Write the crop mosaics as Cloud Optimized GeoTIFFs or as plain GeoTIFFs",
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=4,
+        help="Threads uploading the crop mosaics of the worker processes in the background",
+    )
+    parser.add_argument(
+        "--remote-cache-mb",
+        type=int,
+        default=0,
+        help="Local disk of an opt-in cache of whole band mosaics, for requests whose counties"
+        " read the same mosaics; 0 (default) reads only the needed windows through /vsis3/",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip the (FIPS, week) outputs whose inputs did not change since the last run",
+    )
+    parser.add_argument(
+        "--manifests-uri",
+        type=str,
+        default=None,
+        help="Local directory or S3 prefix of the outputs inputs manifests"
+        " (default s3://<output-bucket>/feature-extraction-manifests)",
+    )
+    parser.add_argument(
+        "--shard-tasks",
+        action="store_true",
+        help="Every instance reads the whole metadata (FullyReplicated input) and processes"
+        " its share of the counties, balanced by county area",
+    )
+    parser.add_argument(
+        "--datacube",
+        action="store_true",
+        help="Also write the masked pixels of every week to a (band, week, y, x) Zarr datacube"
+        " per county, crop and season",
+    )
+    parser.add_argument(
+        "--datacube-uri",
+        type=str,
+        default=None,
+        help="Local directory or S3 prefix of the datacubes"
+        " (default s3://<output-bucket>/data/datacube)",
+    )
     args, _ = parser.parse_known_args()
 
-    crop_type = args.crop_type
+    crop_types = args.crop_type.split(",")
+
+    # Set before the workers are spawned, they inherit the environment
+    configure_remote_raster_access()
 
     sat_images_metadata_mapping = "/opt/ml/processing/input/sat_images_metadata_mapping"
 
@@ -308,11 +874,22 @@ if __name__ == "__main__":
 
     metadata_mapping_files = os.listdir(sat_images_metadata_mapping)
 
+    if args.shard_tasks:
+        # Fail rather than leave the counties of missing metadata files unprocessed
+        check_input_fully_replicated(sat_images_metadata_mapping)
+
+    satellite_tiles_catalog = f"{sat_images_metadata_mapping}/catalog"
+
+    if path.exists(satellite_tiles_catalog):
+        sat_images_metadata_mapping_df = read_satellite_tiles_catalog(
+            satellite_tiles_catalog, band_names=spectral_indices.split(",")
+        )
 
-    if metadata_mapping_files:
-        sat_images_metadata_mapping_df = dd.read_csv(
-            f"{sat_images_metadata_mapping}/*/*", dtype={"FIPS": object}
-        ).compute()
+    elif metadata_mapping_files:
+        # Mapping files written as one CSV per FIPS by older geospatial processing jobs
+        sat_images_metadata_mapping_df = read_satellite_tiles_mapping_files(
+            f"{sat_images_metadata_mapping}/*/*"
+        )
 
     else:
         logger.error(
@@ -327,20 +904,113 @@ if __name__ == "__main__":
         logger.info("Exiting..")
         sys.exit(0)
 
-    metadata_mapping_dict = (
-        sat_images_metadata_mapping_df[["starttime", "endtime", "FIPS", "year", "week"]]
-        .drop_duplicates()
-        .to_dict(orient="records")
-    )
+    # Built once, the tiles of each task are then looked up by (FIPS, starttime, endtime)
+    tiles_index = SatelliteTilesIndex(sat_images_metadata_mapping_df, spectral_indices.split(","))
+    metadata_mapping_dict = tiles_index.tasks()
+    logger.info(f"Indexed the band mosaics of {len(tiles_index)} (FIPS, week) tasks")
 
     logger.info("Load counties-fips geojson file with geopandas")
     geo_counties_fips = gp.read_file(COUNTIES_GEOJSON_FILE_PATH)
     geo_counties_fips["FIPS"] = geo_counties_fips["STATE"] + geo_counties_fips["COUNTY"]
-    print(geo_counties_fips.head())
+    logger.debug(f"Loaded {len(geo_counties_fips)} counties")
 
+    cell_index_cache_uri = (
+        None
+        if args.disable_cell_index_cache
+        else args.cell_index_cache_uri or f"s3://{output_bucket_name}/cell-index-cache"
+    )
+
+    tasks = []
     for mapping in metadata_mapping_dict:
 
         mapping["fips"] = mapping["FIPS"]
-        mapping["type_of_crop"] = crop_type
+        mapping["type_of_crop"] = crop_types[0]
+        mapping["types_of_crop"] = crop_types
+        mapping["zonal_stats_engine"] = args.zonal_stats_engine
+        mapping["max_block_mb"] = args.max_block_mb
+        mapping["output_format"] = args.output_format
+        mapping["raster_format"] = args.raster_format
+        mapping["datacube_uri"] = (
+            (args.datacube_uri or f"s3://{output_bucket_name}/data/datacube").rstrip("/")
+            if args.datacube
+            else None
+        )
+        tasks.append(mapping)
+
+    if args.shard_tasks:
+        host_index, host_count = read_host_index_and_count()
+        county_weights = county_areas(geo_counties_fips, [task["fips"] for task in tasks])
+        tasks = shard_tasks(tasks, county_weights, host_index, host_count)
+        logger.info(f"Host {host_index} of {host_count} processes {len(tasks)} tasks")
+        if not tasks:
+            logger.info("No task assigned to this host, exiting..")
+            sys.exit(0)
+
+    remote_cache = remote_raster_cache(temp_dirpath, args.remote_cache_mb * 1024**2)
+
+    manifests_uri = (
+        (args.manifests_uri or f"s3://{output_bucket_name}/feature-extraction-manifests")
+        if args.incremental
+        else None
+    )
+    # The workers hand their rasters over and go on with the next task, they are uploaded here
+    task_uploads = TaskUploads(
+        BackgroundUploader(output_bucket_name, max_workers=args.upload_workers),
+        on_uploaded=(
+            functools.partial(record_task_manifests, FeatureExtractionManifests(manifests_uri))
+            if manifests_uri
+            else None
+        ),
+    )
+
+    workers = args.workers or os.cpu_count()
+    pool = FeatureExtractionPool(
+        run_feature_extraction_task,
+        max_workers=workers,
+        initializer=init_feature_extraction_worker,
+        initargs=(
+            geo_counties_fips,
+            tiles_index,
+            temp_dirpath,
+            cell_index_cache_uri,
+            # The crop mask memory budget is shared by the workers
+            args.crop_mask_cache_mb * 1024**2 // workers,
+            manifests_uri,
+            args.remote_cache_mb * 1024**2,
+        ),
+        prepare_week=lambda week_tasks: stack_week_mosaics(
+            week_tasks, tiles_index, temp_dirpath, remote_cache=remote_cache
+        ),
+        on_result=task_uploads.submit,
+    )
+    results = pool.run_all(tasks)
+
+    logger.info("Wait for the crop mosaics uploads")
+    task_uploads.finish()
+    task_uploads.uploader.close()
+
+    tasks_io = [result["remote_io"] for result in results if "remote_io" in result]
+    if tasks_io:
+        logger.info(
+            f"Remote rasters read through /vsis3/ by the tasks:"
+            f" {sum(io['vsis3_bytes_fetched'] for io in tasks_io) / 1024**2:.1f} MB in"
+            f" {sum(io['vsis3_requests'] for io in tasks_io)} requests"
+        )
+    if remote_cache is not None:
+        remote_cache.log_counters("Remote rasters prefetched for the weeks")
+        if tasks_io:
+            logger.info(
+                f"Remote rasters fetched by the tasks:"
+                f" {sum(io['bytes_fetched'] for io in tasks_io) / 1024**2:.1f} MB,"
+                f" {sum(io['hits'] for io in tasks_io)} hits,"
+                f" {sum(io['misses'] for io in tasks_io)} misses"
+            )
+
+    if workers == 1:
+        crop_mask_cache = worker_state["crop_mask_cache"]
+        logger.info(
+            f"Crop mask cache: {crop_mask_cache.hits} hits, {crop_mask_cache.misses} misses"
+        )
 
-        handler(mapping, geo_counties_fips, sat_images_metadata_mapping_df, temp_dirpath)
+    if any(result["result"] == "error" for result in results):
+        sys.exit(1)
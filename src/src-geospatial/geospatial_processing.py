@@ -1,46 +1,77 @@
 from datetime import datetime
 import argparse
+import asyncio
+import functools
+import hashlib
 import json
 import logging
 import os
-import time
+import tempfile
 import uuid
 
 import boto3
 import botocore
-import geopandas as gp
-
+import pandas as pd
+
+from utils.area_of_interest_helper import AOI_HULLS, prepare_area_of_interest
+from utils.bandmath_helper import compile_spectral_indices, compute_spectral_indices
+from utils.county_geometry_store_helper import get_county_geometry_store
+from utils.eoj_cache_helper import EarthObservationJobCache, stage_cache_keys
+from utils.eoj_client_helper import create_earth_observation_client
+from utils.eoj_pipeline_helper import (
+    EarthObservationJobJournal,
+    EarthObservationJobStage,
+    run_earth_observation_job_pipeline,
+)
+from utils.eoj_poller_helper import EarthObservationJobPoller
+from utils.eoj_scheduler_helper import EarthObservationJobScheduler
 from utils.fips_to_satellite_tiles_metadata_helper import (
     create_fips_isoweek_year_satellite_tiles_mapping,
     list_satellite_images_in_s3,
+    read_satellite_tiles_catalog,
+    split_satellite_images_by_window,
+    write_satellite_tiles_catalog,
 )
 
 log_format = "%(asctime)s %(levelname)s %(message)s"
 logging.basicConfig(format=log_format, level=logging.INFO)
 logger = logging.getLogger()
 
-
-axisClient = boto3.client(service_name="sagemaker-geospatial", region_name=os.environ["REGION"])
-
 # Used to get boundary polygon coordinates for a given county's based on FIPS
-COUNTIES_GEOJSON = os.environ["COUNTIES_GEOJSON_FILE_PATH"]
+COUNTIES_GEOJSON = os.environ.get("COUNTIES_GEOJSON_FILE_PATH")
+# Optional local GeoParquet copy of the counties, reused by later processes
+COUNTIES_GEOPARQUET_CACHE = os.environ.get("COUNTIES_GEOPARQUET_CACHE_PATH")
 
 AXIS_REQUEST_MANIFEST_PATH = "/opt/ml/processing/input/axis_requests_manifests/"
 
-AXIS_ROLE_ARN = os.environ["AXIS_ROLE_ARN"]
+AXIS_ROLE_ARN = os.environ.get("AXIS_ROLE_ARN")
+
+# Satellite tiles catalog, partitioned by year and week, under the metadata key
+SATELLITE_TILES_CATALOG = "catalog"
 
-s3_resource = boto3.resource("s3")
+# Delay before the first status check of an EOJ, and upper bound of the
+# exponential backoff between two status checks
+EOJ_STATUS_FIRST_CHECK_DELAY = 10
+EOJ_STATUS_MAX_CHECK_DELAY = 120
 
 
-def fips_to_polygon_coordinates(fips):
-    """Get polygon coordinates from fips id."""
+def fips_to_polygon_coordinates(fips, aoi_options=None):
+    """Get polygon coordinates from fips id.
 
-    geo_df = gp.read_file(COUNTIES_GEOJSON)
-    geo_df["FIPS"] = geo_df["STATE"] + geo_df["COUNTY"]
-    geometries = geo_df[geo_df["FIPS"].isin(fips)]["geometry"]
-    geometries_union = gp.GeoDataFrame(crs=geometries.crs, geometry=[geometries.unary_union])
-    geom_type = geometries_union.geom_type[0]
-    geometries_union = geometries_union["geometry"].iloc[0]
+    When ``aoi_options`` are given, the counties union is replaced by a coarser
+    AOI covering it (see ``prepare_area_of_interest``).
+    """
+
+    county_geometry_store = get_county_geometry_store(
+        COUNTIES_GEOJSON, cache_path=COUNTIES_GEOPARQUET_CACHE
+    )
+    geometries_union = county_geometry_store.union(fips)
+
+    if aoi_options:
+        geometries_union, aoi_report = prepare_area_of_interest(geometries_union, **aoi_options)
+        logger.info(f"AOI prepared for fips {fips}: {aoi_report}")
+
+    geom_type = geometries_union.geom_type
 
     if geom_type == "MultiPolygon":
         return [list(geom.boundary.coords) for geom in geometries_union.geoms]
@@ -58,149 +89,31 @@ def list_requests_manifest_files():
     logger.info(axis_requests_manifests)
     logger.info("Loading request manifests file")
 
-    axis_requests_configs = []
+    axis_requests_configs = {}
 
     for manifest_file in axis_requests_manifests:
         mnifest_file_path = f"{AXIS_REQUEST_MANIFEST_PATH}/{manifest_file}"
         with open(mnifest_file_path, "r") as manifest:
-            axis_requests_configs.append(json.load(manifest))
+            axis_requests_configs[manifest_file] = json.load(manifest)
     return axis_requests_configs
 
 
-def run_geomosaic_earth_observation_job(eoj_arn, output_bucket_name, key_prefix):
-    """Run a geomosaic EOJ to merge multiple rasters into one raster for each band."""
-
-
-    eoj_config = {"JobConfig": {"GeoMosaicConfig": {"AlgorithmName": "NEAR"}}}
-
-    eojParams = {
-        "Name": "geomosaic",
-        "InputConfig": {"PreviousEarthObservationJobArn": eoj_arn},
-        **eoj_config,
-        "ExecutionRoleArn": AXIS_ROLE_ARN,
-    }
-
-    eoj_response = axisClient.start_earth_observation_job(**eojParams)
-
-    job_arn = eoj_response["Arn"]
-
-    while True:
-        # Sleep for 1 minute before calling to get the job status
-        time.sleep(60)
-
-        eoj_status_response = axisClient.get_earth_observation_job(Arn=job_arn)
-        job_status = eoj_status_response["Status"]
-        logger.info(f"Geomosaic EOJ status is {job_status}")
-
-        if job_status == "COMPLETED":
-            logger.info("Geomosaic EOJ finished successfuly.")
-            break
-
-        if job_status == "FAILED":
-            logger.info("Geomosaic EOJ Failed.")
-            logger.info(eoj_status_response)
-            break
-            
-
-    return job_arn, job_status, eoj_response["Arn"]
-
-
-def run_bandmath_earth_observation_job(eoj_arn, spectral_indices, output_bucket_name, key_prefix):
-    """Run EOJ to compute the spectral indices."""
-
-    eoj_config = {
-        "JobConfig": {
-            "BandMathConfig": {"CustomIndices": {"Operations": []}},
-        }
-    }
-
-    for indices in spectral_indices:
-        eoj_config["JobConfig"]["BandMathConfig"]["CustomIndices"]["Operations"].append(
-            {"Name": indices[0], "Equation": indices[1][1:-1]}
-        )
-
-    eojParams = {
-        "Name": "bandmath",
-        "InputConfig": {"PreviousEarthObservationJobArn": eoj_arn},
-        **eoj_config,
-        "ExecutionRoleArn": AXIS_ROLE_ARN,
-    }
+def cloud_removal_input_config(context):
+    """Query the raster data collection over the counties' AOI."""
 
-    eoj_response = axisClient.start_earth_observation_job(**eojParams)
+    request_polygon_coordinates = fips_to_polygon_coordinates(
+        context["county_fips"], context.get("aoi_options")
+    )
 
-    job_arn = eoj_response["Arn"]
-
-    while True:
-        # Sleep for 1 minute before calling to get the job status
-        time.sleep(60)
-
-        eoj_status_response = axisClient.get_earth_observation_job(Arn=job_arn)
-        job_status = eoj_status_response["Status"]
-        logger.info(f"Bandmath EOJstatus is {job_status}")
-
-        if job_status == "COMPLETED":
-            logger.info("Bandmath EOJ finished successfuly.")
-            break
-
-        if job_status == "FAILED":
-            logger.info("Bandmath EOJ Failed.")
-            logger.info(eoj_status_response)
-            break
-
-    # export results of an EarthObservationJob to an S3 location.
-
-    eojParamsExport = {
-        "Arn": eoj_response["Arn"],
-        "ExecutionRoleArn": AXIS_ROLE_ARN,
-        "OutputConfig": {"S3Data": {"S3Uri": f"s3://{output_bucket_name}/{key_prefix}"}},
-    }
-
-    eoj_response_export = axisClient.export_earth_observation_job(**eojParamsExport)
-
-    job_arn_export = eoj_response_export["Arn"]
-
-    while True:
-        # Sleep for 1 minute before calling to get the job status
-        time.sleep(60)
-
-        eoj_status_response = axisClient.get_earth_observation_job(Arn=job_arn_export)
-        job_status = eoj_status_response["ExportStatus"]
-        logger.info(f"Export EOJstatus is {job_status}")
-
-        if job_status == "SUCCEEDED":
-            logger.info("Export EOJ finished successfuly.")
-            break
-
-        if job_status == "FAILED":
-            logger.info("Export EOJ Failed.")
-            logger.info(eoj_status_response)
-            break
-
-    return job_arn, job_status
-
-
-def run_cloud_removal_earth_observation_job(
-    start_time,
-    end_time,
-    county_fips,
-    data_collections_names,
-    data_collections_arns,
-    output_bucket_name,
-    key_prefix,
-):
-    """Run cloud_removal EOJ to remove the clouds."""
-
-    request_polygon_coordinates = fips_to_polygon_coordinates(county_fips)
-
-    eoj_input_config = {
+    return {
         "RasterDataCollectionQuery": {
-            "RasterDataCollectionArn": data_collections_arns[1],
+            "RasterDataCollectionArn": context["data_collections_arns"][1],
             "AreaOfInterest": {
                 "AreaOfInterestGeometry": {
                     "PolygonGeometry": {"Coordinates": request_polygon_coordinates}
                 }
             },
-            "TimeRangeFilter": {"StartTime": start_time, "EndTime": end_time},
+            "TimeRangeFilter": {"StartTime": context["start_time"], "EndTime": context["end_time"]},
             "PropertyFilters": {
                 "Properties": [{"Property": {"EoCloudCover": {"LowerBound": 0, "UpperBound": 10}}}],
                 "LogicalOperator": "AND",
@@ -208,7 +121,11 @@ def run_cloud_removal_earth_observation_job(
         }
     }
 
-    eoj_config = {
+
+def cloud_removal_job_config(context):
+    """Cloud removal EOJ to remove the clouds."""
+
+    return {
         "JobConfig": {
             "CloudRemovalConfig": {
                 "AlgorithmName": "INTERPOLATION",
@@ -218,42 +135,18 @@ def run_cloud_removal_earth_observation_job(
         }
     }
 
-    eojParams = {
-        "Name": "cloudremoval",
-        "InputConfig": eoj_input_config,
-        **eoj_config,
-        "ExecutionRoleArn": AXIS_ROLE_ARN,
-    }
-
-    eoj_response = axisClient.start_earth_observation_job(**eojParams)
-
-    job_arn = eoj_response["Arn"]
-
-    while True:
-        # Sleep for 1 minute before calling to get the job status
-        time.sleep(60)
-
-        eoj_status_response = axisClient.get_earth_observation_job(Arn=job_arn)
-        job_status = eoj_status_response["Status"]
-        logger.info(f"Cloud Removal EOJ status is {job_status}")
 
-        if job_status == "COMPLETED":
-            logger.info("Cloud Removal EOJ finished successfuly.")
-            break
+def geomosaic_job_config(context):
+    """Geomosaic EOJ to merge multiple rasters into one raster for each band."""
 
-        if job_status == "FAILED":
-            logger.info("Cloud Removal EOJ Failed.")
-            logger.info(eoj_status_response)
-            break
+    return {"JobConfig": {"GeoMosaicConfig": {"AlgorithmName": "NEAR"}}}
 
-    return job_arn, job_status, eoj_response["Arn"]
 
-
-def run_resample_earth_observation_job(eoj_arn, output_bucket_name, key_prefix):
-    """Run rasample EOJ to resample the rasters to a 30m resolution
+def resample_job_config(context):
+    """Resample EOJ to resample the rasters to a 30m resolution
     Note: Required to match the crop masks resolution."""
 
-    eoj_config = {
+    return {
         "JobConfig": {
             "ResamplingConfig": {
                 "OutputResolution": {"UserDefined": {"Value": 30, "Unit": "METERS"}},
@@ -262,64 +155,310 @@ def run_resample_earth_observation_job(eoj_arn, output_bucket_name, key_prefix):
         }
     }
 
-    eojParams = {
-        "Name": "resample",
-        "InputConfig": {"PreviousEarthObservationJobArn": eoj_arn},
-        **eoj_config,
-        "ExecutionRoleArn": AXIS_ROLE_ARN,
+
+def bandmath_job_config(context):
+    """Bandmath EOJ to compute the spectral indices."""
+
+    eoj_config = {
+        "JobConfig": {
+            "BandMathConfig": {"CustomIndices": {"Operations": []}},
+        }
     }
 
-    eoj_response = axisClient.start_earth_observation_job(**eojParams)
+    for indices in context["spectral_indices"]:
+        eoj_config["JobConfig"]["BandMathConfig"]["CustomIndices"]["Operations"].append(
+            {"Name": indices[0], "Equation": indices[1][1:-1]}
+        )
 
-    job_arn = eoj_response["Arn"]
+    return eoj_config
 
-    while True:
-        # Sleep for 1 minute before calling to get the job status
-        time.sleep(60)
 
-        eoj_status_response = axisClient.get_earth_observation_job(Arn=job_arn)
-        job_status = eoj_status_response["Status"]
-        logger.info(f"Resample EOJ status is {job_status}")
+# Chain of EOJs run for every request manifest, resample and bandmath results
+# are exported to the chain's output prefix.
+EOJ_STAGES = [
+    EarthObservationJobStage(
+        "cloudremoval", cloud_removal_job_config, input_config=cloud_removal_input_config
+    ),
+    EarthObservationJobStage("geomosaic", geomosaic_job_config),
+    EarthObservationJobStage("resample", resample_job_config, export=True),
+    EarthObservationJobStage("bandmath", bandmath_job_config, export=True),
+]
 
-        if job_status == "COMPLETED":
-            logger.info("Resample EOJ finished successfuly.")
-            break
 
-        if job_status == "FAILED":
-            logger.info("Resample EOJ Failed.")
-            logger.info(eoj_status_response)
-            break
+def chain_journal_uri(journal_uri, chain_id, axis_request_config):
+    """Journal location of a chain, unique to the content of its request manifest."""
 
-    # export results of an EarthObservationJob to an S3 location.
+    manifest_hash = hashlib.sha1(
+        json.dumps(axis_request_config, sort_keys=True).encode("UTF-8")
+    ).hexdigest()[:12]
+    return f"{journal_uri.rstrip('/')}/{chain_id}-{manifest_hash}.json"
 
-    eojParamsExport = {
-        "Arn": eoj_response["Arn"],
-        "ExecutionRoleArn": AXIS_ROLE_ARN,
-        "OutputConfig": {"S3Data": {"S3Uri": f"s3://{output_bucket_name}/{key_prefix}"}},
+
+async def run_earth_observation_jobs_chain(
+    scheduler,
+    chain_id,
+    client,
+    axis_request_config,
+    data_collections_names,
+    data_collections_arns,
+    output_bucket_name,
+    output_metadata_key,
+    journal_uri,
+    poller,
+    aoi_options=None,
+    cache=None,
+    local_bandmath=False,
+):
+    """Run the cloud removal -> geomosaic -> resample -> bandmath chain of a
+    request manifest and write the fips to satellite tiles mapping files.
+
+    Progress is recorded in a journal, re-running a chain resumes it from the
+    last completed stage. A completed chain whose mapping is missing from the
+    tiles catalog (the metadata key is emptied between runs) only writes it
+    again. With a ``cache``, stages whose content address was already
+    computed by an earlier run are reused and the results are written
+    to a prefix derived from the content address of the whole chain. With
+    ``local_bandmath``, the spectral indices are computed in-process from the
+    resampled mosaics instead of with a BandMath EOJ.
+    """
+
+    logger.info(axis_request_config)
+    start_time = axis_request_config["startime"]
+    end_time = axis_request_config["endtime"]
+    county_fips = axis_request_config["fips"].split(",")
+    week = axis_request_config["week"]
+    year = axis_request_config["year"]
+
+    journal = await asyncio.to_thread(
+        EarthObservationJobJournal, chain_journal_uri(journal_uri, chain_id, axis_request_config)
+    )
+    # Windows of the manifest, manifests batched over a season hold the windows of the merged ones
+    windows = axis_request_config.get("windows") or [
+        {"startime": start_time, "endtime": end_time, "week": week}
+    ]
+    if journal.stage("mapping").get("status") == "COMPLETED":
+        # The metadata key is emptied before each run, only the EOJs can be skipped
+        mapping_exists = await asyncio.to_thread(
+            satellite_tiles_mapping_exists,
+            output_bucket_name,
+            output_metadata_key,
+            journal.state["key_prefix"],
+            county_fips,
+            windows,
+            year,
+        )
+        if mapping_exists:
+            logger.info(f"[{chain_id}] Chain already completed according to {journal.uri}")
+            return "COMPLETED"
+        logger.info(
+            f"[{chain_id}] EOJs already completed according to {journal.uri},"
+            " writing the missing metadata mapping"
+        )
+
+    logger.info(
+        f"[{chain_id}] Running chained EOJs for starttime {start_time}"
+        f" endtime {end_time} and county fips {county_fips}"
+    )
+
+    context = {
+        "start_time": start_time,
+        "end_time": end_time,
+        "county_fips": county_fips,
+        "spectral_indices": axis_request_config["spectralindices"],
+        "data_collections_names": data_collections_names,
+        "data_collections_arns": data_collections_arns,
+        "aoi_options": aoi_options,
     }
 
-    eoj_response_export = axisClient.export_earth_observation_job(**eojParamsExport)
+    stages = EOJ_STAGES
+    if local_bandmath:
+        stages = [stage for stage in EOJ_STAGES if stage.name != "bandmath"]
+
+    cache_keys = None
+    if cache is not None:
+        cache_keys = await asyncio.to_thread(stage_cache_keys, stages, context)
+
+    if "key_prefix" not in journal.state:
+        if cache_keys:
+            journal.state["key_prefix"] = f"geospatial-results/{cache_keys[-1][:16]}-{week}/"
+        else:
+            # Chains run concurrently, make sure two manifests never share a prefix
+            journal.state["key_prefix"] = (
+                f"geospatial-results/{datetime.utcnow():%Y-%m-%d-%H%M}-{week}-{uuid.uuid4().hex[:8]}/"
+            )
+        await asyncio.to_thread(journal.save)
+    key_prefix = journal.state["key_prefix"]
+
+    job_arn, job_status = await run_earth_observation_job_pipeline(
+        client,
+        poller,
+        stages,
+        context,
+        journal,
+        AXIS_ROLE_ARN,
+        f"s3://{output_bucket_name}/{key_prefix}",
+        scheduler,
+        chain_id,
+        cache=cache,
+        cache_keys=cache_keys,
+    )
+
+    if job_status == "FAILED":
+        logger.info(f"[{chain_id}] Skipping generating metadata mapping files.")
+        return job_status
+
+    if local_bandmath and journal.stage("local_bandmath").get("status") != "COMPLETED":
+        async with scheduler.job_slot(chain_id, "local_bandmath"):
+            await asyncio.to_thread(
+                compute_local_spectral_indices,
+                output_bucket_name,
+                key_prefix,
+                axis_request_config["spectralindices"],
+            )
+        await asyncio.to_thread(journal.update_stage, "local_bandmath", status="COMPLETED")
+
+    await asyncio.to_thread(
+        write_satellite_tiles_mapping_files,
+        output_bucket_name,
+        output_metadata_key,
+        key_prefix,
+        county_fips,
+        windows,
+        year,
+        split_by_acquisition_date=axis_request_config.get("windows") is not None,
+    )
+    await asyncio.to_thread(journal.update_stage, "mapping", status="COMPLETED")
+    return job_status
+
+
+def compute_local_spectral_indices(output_bucket_name, key_prefix, spectral_indices):
+    """Compute the spectral indices of the resampled mosaics in-process and
+    upload them next to the resample results, named like the BandMath EOJ
+    outputs (``<mosaic>_<index>.tif``)."""
+
+    kernels = compile_spectral_indices(spectral_indices)
+
+    s3_client = boto3.session.Session().client("s3")
+
+    mosaics = {}
+    for image in list_satellite_images_in_s3(output_bucket_name, key_prefix):
+        mosaic, band_name = image[: -len(".tif")].rsplit("_", 1)
+        mosaics.setdefault(mosaic, {})[band_name] = image
+
+    with tempfile.TemporaryDirectory() as temp_dirpath:
+        for mosaic, band_paths in mosaics.items():
+            logger.info(f"Computing spectral indices of {mosaic}")
+            mosaic_key = mosaic[len(f"s3://{output_bucket_name}/") :]
+            for index_path in compute_spectral_indices(
+                band_paths, kernels, temp_dirpath, os.path.basename(mosaic)
+            ):
+                index_name = index_path[: -len(".tif")].rsplit("_", 1)[1]
+                s3_client.upload_file(
+                    index_path, output_bucket_name, f"{mosaic_key}_{index_name}.tif"
+                )
+                os.remove(index_path)
+
+
+def write_satellite_tiles_mapping_files(
+    output_bucket_name,
+    output_metadata_key,
+    key_prefix,
+    county_fips,
+    windows,
+    year,
+    split_by_acquisition_date=False,
+):
+    """Add the fips to satellite tiles mapping of the chain to the catalog.
 
-    job_arn_export = eoj_response_export["Arn"]
+    ``windows`` are the (``startime``, ``endtime``, ``week``) of the request
+    manifests processed by the chain. With ``split_by_acquisition_date``, the
+    results of a season wide chain are split between the windows by the
+    acquisition date in their file name.
+    """
 
-    while True:
-        # Sleep for 1 minute before calling to get the job status
-        time.sleep(60)
+    satellite_images = list_satellite_images_in_s3(output_bucket_name, key_prefix)
 
-        eoj_status_response = axisClient.get_earth_observation_job(Arn=job_arn_export)
-        job_status = eoj_status_response["ExportStatus"]
-        logger.info(f"Export EOJstatus is {job_status}")
+    logger.info(f"EOJ results: {satellite_images}")
+    logger.info("Add tif files to the satellite tiles catalog")
 
-        if job_status == "SUCCEEDED":
-            logger.info("Export EOJ finished successfuly.")
-            break
+    if split_by_acquisition_date:
+        windows_images = split_satellite_images_by_window(satellite_images, windows)
+    else:
+        windows_images = [satellite_images] * len(windows)
 
-        if job_status == "FAILED":
-            logger.info("Export EOJ Failed.")
-            logger.info(eoj_status_response)
-            break
+    # Generate mapping from current geospatial results
+    mapping_df = pd.concat(
+        [
+            create_fips_isoweek_year_satellite_tiles_mapping(
+                window_images, fips, window["startime"], window["endtime"], window["week"], year
+            )
+            for window, window_images in zip(windows, windows_images)
+            for fips in county_fips
+        ]
+    )
 
-    return job_arn, job_status, eoj_response["Arn"]
+    write_satellite_tiles_catalog(
+        mapping_df, f"s3://{output_bucket_name}/{output_metadata_key}{SATELLITE_TILES_CATALOG}"
+    )
+
+
+def satellite_tiles_mapping_exists(
+    output_bucket_name, output_metadata_key, key_prefix, county_fips, windows, year
+):
+    """Whether the catalog holds the mapping of every county and window of a chain."""
+
+    catalog_uri = f"s3://{output_bucket_name}/{output_metadata_key}{SATELLITE_TILES_CATALOG}"
+    weeks = {int(window["week"]) for window in windows}
+    try:
+        catalog_df = read_satellite_tiles_catalog(catalog_uri, fips=county_fips, year=year)
+    except FileNotFoundError:
+        return False
+
+    results_prefix = f"s3://{output_bucket_name}/{key_prefix}"
+    chain_df = catalog_df[
+        catalog_df["week"].isin(weeks)
+        & catalog_df["mosaic_s3_path"].str.startswith(results_prefix)
+    ]
+    mapped = set(zip(chain_df["FIPS"], chain_df["week"]))
+    return all((str(fips), week) in mapped for fips in county_fips for week in weeks)
+
+
+def batch_requests_manifests(axis_requests_configs):
+    """Merge the request manifests of a season into a single request.
+
+    Manifests sharing their counties, year and spectral indices are merged in
+    one request covering all their time windows, the windows are kept under
+    ``windows`` to split the results afterwards.
+    """
+
+    seasons = {}
+    for manifest_file, axis_request_config in sorted(axis_requests_configs.items()):
+        season = (
+            axis_request_config["fips"],
+            axis_request_config["year"],
+            json.dumps(axis_request_config["spectralindices"]),
+        )
+        seasons.setdefault(season, []).append(axis_request_config)
+
+    batched_configs = {}
+    for season_configs in seasons.values():
+        season_configs = sorted(season_configs, key=lambda config: config["startime"])
+        first, last = season_configs[0], season_configs[-1]
+        year = first["year"]
+        season_week = f"{first['week']}-{last['week']}"
+        batched_configs[f"season-{year}-isoweeks-{season_week}-{len(batched_configs)}"] = {
+            "startime": first["startime"],
+            "endtime": max(config["endtime"] for config in season_configs),
+            "week": season_week,
+            "year": year,
+            "fips": first["fips"],
+            "spectralindices": first["spectralindices"],
+            "windows": [
+                {key: config[key] for key in ("startime", "endtime", "week")}
+                for config in season_configs
+            ],
+        }
+    return batched_configs
 
 
 if __name__ == "__main__":
@@ -327,19 +466,97 @@ if __name__ == "__main__":
 
     parser.add_argument("--output-bucket", type=str, required=True)
     parser.add_argument("--metadata-key", type=str, required=True)
+    parser.add_argument(
+        "--max-concurrent-chains",
+        type=int,
+        default=4,
+        help="Number of request manifests processed at the same time",
+    )
+    parser.add_argument(
+        "--max-concurrent-jobs",
+        type=int,
+        default=4,
+        help="Number of EOJs running at the same time, keep it under the account quota",
+    )
+    parser.add_argument(
+        "--journal-uri",
+        type=str,
+        default=None,
+        help="Local directory or s3:// prefix of the chains journals,"
+        " defaults to s3://<output-bucket>/geospatial-journal",
+    )
+
+    parser.add_argument(
+        "--cache-uri",
+        type=str,
+        default=None,
+        help="Local directory or s3:// prefix of the EOJ results cache,"
+        " defaults to s3://<output-bucket>/geospatial-cache",
+    )
+    parser.add_argument(
+        "--disable-cache",
+        action="store_true",
+        help="Always run the EOJs, even when the same request was already processed",
+    )
+    parser.add_argument(
+        "--local-bandmath",
+        action="store_true",
+        help="Compute the spectral indices in-process instead of running a BandMath EOJ",
+    )
+    parser.add_argument(
+        "--batch-weeks",
+        action="store_true",
+        help="Run one EOJ chain per season instead of one per request manifest",
+    )
+    parser.add_argument(
+        "--aoi-simplify-tolerance",
+        type=float,
+        default=0.0,
+        help="Simplification tolerance of the EOJ AOI, in degrees (0 keeps the exact counties)",
+    )
+    parser.add_argument(
+        "--aoi-max-vertices", type=int, default=None, help="Vertex budget of the EOJ AOI"
+    )
+    parser.add_argument("--aoi-hull", type=str, default="none", choices=AOI_HULLS)
+    parser.add_argument(
+        "--aoi-buffer",
+        type=float,
+        default=0.0,
+        help="Buffer distance of the 'buffered' AOI hull, in degrees",
+    )
 
     args, _ = parser.parse_known_args()
-    unique_folder_name = uuid.uuid4().hex
 
     output_bucket_name = args.output_bucket
     output_metadata_key = args.metadata_key
-    
-    bucket_resource = s3_resource.Bucket(output_bucket_name)
+    journal_uri = args.journal_uri or f"s3://{output_bucket_name}/geospatial-journal"
+    cache = None
+    if not args.disable_cache:
+        cache = EarthObservationJobCache(
+            args.cache_uri or f"s3://{output_bucket_name}/geospatial-cache"
+        )
+
+    aoi_options = None
+    if args.aoi_simplify_tolerance or args.aoi_max_vertices or args.aoi_hull != "none":
+        aoi_options = {
+            "tolerance": args.aoi_simplify_tolerance,
+            "max_vertices": args.aoi_max_vertices,
+            "hull": args.aoi_hull,
+            "buffer_distance": args.aoi_buffer,
+        }
+
+    axisClient = create_earth_observation_client(
+        "sagemaker-geospatial", region_name=os.environ["REGION"]
+    )
 
     axis_requests_configs = list_requests_manifest_files()
 
     logger.info(f"Found {len(axis_requests_configs)} requests manifest files")
 
+    if args.batch_weeks:
+        axis_requests_configs = batch_requests_manifests(axis_requests_configs)
+        logger.info(f"Batched the request manifests into {len(axis_requests_configs)} seasons")
+
     logger.info("Listing raster data collections")
     # Perform raster operations using axisClient
     data_collections = axisClient.list_raster_data_collections()
@@ -349,89 +566,36 @@ if __name__ == "__main__":
     logger.info("data_collections_arns, data_collections_names")
     print(data_collections_arns, data_collections_names)
 
-    # Run Axis EOJ jobs for all available request manifest config files
-    for axis_request_config in axis_requests_configs:
-        logger.info(axis_request_config)
-        start_time = axis_request_config["startime"]
-        end_time = axis_request_config["endtime"]
-        county_fips = axis_request_config["fips"].split(",")
-        week = axis_request_config["week"]
-        year = axis_request_config["year"]
-        spectral_indices = axis_request_config["spectralindices"]
-        key_prefix = f"geospatial-results/{datetime.utcnow():%Y-%m-%d-%H%M}-{week}/"
-        print("county_fips type", type(county_fips))
-
-        logger.info(
-            f"Running chained EOJs for starttime {start_time}"
-            f"endtime {end_time} and county fips {county_fips}"
-        )
-
-        # ====================================================================
-        #  Cloud Removal EOJ
-        # ====================================================================
-
-        job_arn, job_status, eoj_arn = run_cloud_removal_earth_observation_job(
-            start_time,
-            end_time,
-            county_fips,
-            data_collections_names,
-            data_collections_arns,
-            output_bucket_name,
-            key_prefix,
-        )
-
-        if job_status == "FAILED":
-            logger.info("Skipping generating metadata mapping files.")
-            continue
-
-        # ====================================================================
-        #  Geomosaic EOJ
-        # ====================================================================
-
-        job_arn, job_status, eoj_arn = run_geomosaic_earth_observation_job(
-            eoj_arn, output_bucket_name, key_prefix
-        )
-
-        if job_status == "FAILED":
-            logger.info("Skipping generating metadata mapping files.")
-            continue
-
-        # ====================================================================
-        #  Resample EOJ
-        # ====================================================================
-
-        job_arn, job_status, eoj_arn = run_resample_earth_observation_job(
-            eoj_arn, output_bucket_name, key_prefix
-        )
-
-        if job_status == "FAILED":
-            logger.info("Skipping generating metadata mapping files.")
-            continue
-
-        # ====================================================================
-        #  Bandmath EOJ
-        # ====================================================================
-
-        job_arn, job_status = run_bandmath_earth_observation_job(
-            eoj_arn, spectral_indices, output_bucket_name, key_prefix
+    # Run Axis EOJ chains for all available request manifest config files concurrently
+    scheduler = EarthObservationJobScheduler(
+        max_concurrent_chains=args.max_concurrent_chains,
+        max_concurrent_jobs=args.max_concurrent_jobs,
+    )
+    # One poller tracks the status of the in-flight EOJs of every chain
+    poller = EarthObservationJobPoller(
+        axisClient,
+        first_check_delay=EOJ_STATUS_FIRST_CHECK_DELAY,
+        max_delay=EOJ_STATUS_MAX_CHECK_DELAY,
+    )
+
+    chains = {
+        os.path.splitext(chain_name)[0]: functools.partial(
+            run_earth_observation_jobs_chain,
+            client=axisClient,
+            axis_request_config=axis_request_config,
+            data_collections_names=data_collections_names,
+            data_collections_arns=data_collections_arns,
+            output_bucket_name=output_bucket_name,
+            output_metadata_key=output_metadata_key,
+            journal_uri=journal_uri,
+            poller=poller,
+            aoi_options=aoi_options,
+            cache=cache,
+            local_bandmath=args.local_bandmath,
         )
-        satellite_images = list_satellite_images_in_s3(bucket_resource, key_prefix)
-        # keep only file that ends with .tif to avoid temporary files.
-
-        satellite_images = [img for img in satellite_images if img.endswith(".tif")]
-
-        logger.info(f"EOJ results: {satellite_images}")
-        logger.info("Create tif file to metadata mapping file")
-
-        for fips in county_fips:
-            # Generate mapping from current geospatial results
-            mapping_df = create_fips_isoweek_year_satellite_tiles_mapping(
-                satellite_images, fips, start_time, end_time, week, year
-            )
+        for chain_name, axis_request_config in axis_requests_configs.items()
+    }
 
-            unique_file_name = uuid.uuid4().hex
-            mapping_df.to_csv(
-                f"s3://{output_bucket_name}/{output_metadata_key}"
-                f"{week}/{unique_file_name}.csv",
-                index=False,
-            )
+    results = asyncio.run(scheduler.run(chains))
+    logger.info(f"EOJ chains results: {results}")
+    logger.info(f"EOJ status checks used {poller.api_calls} API calls")
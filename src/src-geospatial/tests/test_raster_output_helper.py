@@ -0,0 +1,68 @@
+import os
+from concurrent.futures import Future
+
+import numpy as np
+from rasterio.transform import from_origin
+
+from utils.raster_output_helper import DeferredUploader, RasterOutputWriter, TaskUploads
+
+PROFILE = {
+    "driver": "GTiff",
+    "dtype": "float32",
+    "count": 1,
+    "nodata": -9999.0,
+    "crs": "EPSG:4326",
+    "transform": from_origin(-89, 40, 0.001, 0.001),
+    "width": 16,
+    "height": 16,
+}
+
+
+class RecordingUploader:
+    def __init__(self):
+        self.uploaded = []
+
+    def submit(self, local_path, keys, remove=True):
+        self.uploaded.append(keys)
+        future = Future()
+        future.set_result(keys)
+        return future
+
+    @staticmethod
+    def wait(futures):
+        for future in futures:
+            future.result()
+
+
+def test_failed_task_uploads_are_discarded(tmp_path):
+    uploader = DeferredUploader()
+    writer = RasterOutputWriter(uploader, str(tmp_path), raster_format="gtiff")
+    writer.write_array(np.zeros((1, 16, 16), dtype="float32"), PROFILE, "crop-mosaic/failed.tif")
+    assert len(uploader.uploads) == 1
+    local_path = uploader.uploads[0][0]
+
+    # The task fails after writing, its files are dropped
+    uploader.discard()
+    assert not os.path.exists(local_path)
+
+    # The next task of the worker only hands over its own files
+    writer.write_array(np.ones((1, 16, 16), dtype="float32"), PROFILE, "crop-mosaic/next.tif")
+    task_uploads = TaskUploads(RecordingUploader())
+    task_uploads.submit({"fips": "01001", "isoweek": "1", "uploads": uploader.take()})
+    task_uploads.finish()
+    assert task_uploads.uploader.uploaded == [["crop-mosaic/next.tif"]]
+
+
+def test_failed_upload_turns_the_task_into_an_error():
+    class FailingUploader(RecordingUploader):
+        @staticmethod
+        def wait(futures):
+            raise RuntimeError("upload failed")
+
+    uploaded = []
+    task_uploads = TaskUploads(FailingUploader(), on_uploaded=uploaded.append)
+    result = {"result": "success", "fips": "01001", "isoweek": "1", "uploads": [("x", ["k"], True)]}
+    task_uploads.submit(result)
+    task_uploads.finish()
+    assert result["result"] == "error"
+    assert uploaded == []
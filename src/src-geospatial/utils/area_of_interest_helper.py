@@ -0,0 +1,133 @@
+import logging
+
+from shapely.geometry import MultiPolygon, Polygon
+
+logger = logging.getLogger()
+
+AOI_HULLS = ["none", "convex", "buffered"]
+
+
+def _drop_holes(geometry):
+    """Holes only reduce the AOI coverage, keep the exterior rings."""
+    if geometry.geom_type == "Polygon":
+        return Polygon(geometry.exterior)
+    return MultiPolygon([Polygon(geom.exterior) for geom in geometry.geoms])
+
+
+def count_vertices(geometry):
+    polygons = [geometry] if geometry.geom_type == "Polygon" else geometry.geoms
+    return sum(
+        len(polygon.exterior.coords) + sum(len(ring.coords) for ring in polygon.interiors)
+        for polygon in polygons
+    )
+
+
+def simplify_covering(geometry, tolerance):
+    """Simplify ``geometry`` with Douglas-Peucker while still covering it.
+
+    Douglas-Peucker moves the boundary by at most ``tolerance``, buffering by
+    the same distance first keeps every pixel of the original shape inside.
+    """
+    # join_style=2 (mitre) keeps the buffered corners to a single vertex
+    buffered = geometry.buffer(tolerance, join_style=2)
+    return _drop_holes(buffered.simplify(tolerance, preserve_topology=True))
+
+
+def simplify_to_budget(geometry, tolerance, max_vertices, max_iterations):
+    """Covering simplification of ``geometry`` doubling ``tolerance`` until it fits
+    in ``max_vertices``, returns the last AOI tried and its tolerance.
+
+    With large tolerances the topology preserving simplification can cut
+    into the buffer, such AOIs are not accepted even within the budget.
+    """
+    aoi = simplify_covering(geometry, tolerance)
+    for _ in range(max_iterations):
+        if count_vertices(aoi) <= max_vertices and aoi.covers(geometry):
+            break
+        tolerance *= 2
+        aoi = simplify_covering(geometry, tolerance)
+    if not aoi.covers(geometry):
+        # Never returned as a fitting AOI, the caller falls back
+        return geometry, tolerance
+    return aoi, tolerance
+
+
+def prepare_area_of_interest(
+    geometry, tolerance=0.0, max_vertices=None, hull="none", buffer_distance=0.0, max_iterations=12
+):
+    """Return a coarser AOI covering ``geometry`` and a report of the error it introduced.
+
+    The AOI only drives the EOJ raster query, the exact counties shapes are
+    applied again when cropping the mosaics, so a coarser covering AOI does not
+    change the extracted features.
+
+    Args:
+        geometry: union of the counties boundaries.
+        tolerance: simplification tolerance, in the units of the geometry CRS.
+        max_vertices: vertex budget of the AOI, the tolerance is doubled until
+            the AOI fits in it. Simplifications of the convex hull and the
+            minimum rotated rectangle are also tried, the smallest covering
+            AOI within the budget is kept. A budget none of them fits in is
+            logged and reported as exceeded.
+        hull: ``none``, ``convex`` (convex hull of the counties) or
+            ``buffered`` (counties buffered by ``buffer_distance``, which also
+            merges neighbouring parts).
+    """
+    if hull not in AOI_HULLS:
+        raise ValueError(f"Unknown AOI hull {hull}, expected one of {AOI_HULLS}")
+
+    aoi = _drop_holes(geometry)
+    if hull == "convex":
+        aoi = aoi.convex_hull
+    elif hull == "buffered":
+        aoi = _drop_holes(aoi.buffer(buffer_distance, join_style=2))
+    base = aoi
+
+    if tolerance > 0:
+        aoi = simplify_covering(base, tolerance)
+
+    fallback = None
+    if max_vertices and count_vertices(aoi) > max_vertices:
+        minx, miny, maxx, maxy = base.bounds
+        # Start from 1/10000 of the AOI extent when no tolerance is configured
+        initial_tolerance = tolerance or max(maxx - minx, maxy - miny) * 1e-4
+
+        # Every candidate covers the counties, the smallest one fitting the budget is kept
+        candidates = [
+            (None, *simplify_to_budget(base, initial_tolerance, max_vertices, max_iterations)),
+            (
+                "convex_hull",
+                *simplify_to_budget(
+                    base.convex_hull, initial_tolerance, max_vertices, max_iterations
+                ),
+            ),
+            ("minimum_rotated_rectangle", base.minimum_rotated_rectangle, None),
+        ]
+        fitting = [
+            candidate for candidate in candidates if count_vertices(candidate[1]) <= max_vertices
+        ]
+        if fitting:
+            fallback, aoi, tolerance = min(fitting, key=lambda candidate: candidate[1].area)
+            if fallback:
+                logger.warning(f"AOI simplified within {max_vertices} vertices from its {fallback}")
+        else:
+            fallback, aoi, tolerance = min(
+                candidates, key=lambda candidate: count_vertices(candidate[1])
+            )
+            logger.warning(
+                f"AOI of {count_vertices(aoi)} vertices over the budget of {max_vertices},"
+                " no covering shape fits in it"
+            )
+
+    original_area = geometry.area
+    report = {
+        "hull": hull,
+        "tolerance": tolerance,
+        "fallback": fallback,
+        "vertices_before": count_vertices(geometry),
+        "vertices_after": count_vertices(aoi),
+        "within_budget": count_vertices(aoi) <= max_vertices if max_vertices else None,
+        "area_error": (aoi.area - original_area) / original_area,
+        "uncovered_area": geometry.difference(aoi).area / original_area,
+    }
+    return aoi, report
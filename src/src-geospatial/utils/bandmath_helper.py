@@ -0,0 +1,116 @@
+import ast
+import os
+import re
+
+import numpy as np
+import rasterio
+
+try:
+    import numexpr
+except ImportError:  # numexpr is optional, NumPy evaluates the kernels otherwise
+    numexpr = None
+
+# Value written where an index can not be computed (missing input, division by zero)
+BANDMATH_NODATA = -9999
+
+_ALLOWED_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd)
+
+
+class BandMathKernel:
+    """Vectorized kernel of a bandmath equation.
+
+    Equations are the ones sent to the BandMath EOJ (see
+    ``spectral_indices_equation_prep``): spyndex formulas where the standard
+    band names were replaced by the Sentinel-2 band names and the constants by
+    their default value, e.g. ``( nir - red ) / ( nir + red )``.
+    """
+
+    def __init__(self, name, equation):
+        self.name = name
+        # reformat_formula spaces out every character, put back the power operator
+        self.expression = re.sub(r"\*\s*\*", "**", equation).strip()
+        tree = ast.parse(self.expression, mode="eval")
+
+        bands = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                bands.add(node.id)
+            elif isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load)):
+                continue
+            elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+                continue
+            elif not isinstance(node, _ALLOWED_OPERATORS):
+                raise ValueError(f"Unsupported element {ast.dump(node)} in {name} equation")
+
+        self.bands = sorted(bands)
+        self._code = compile(tree, f"<{name}>", "eval")
+
+    def evaluate(self, arrays):
+        """Evaluate the kernel over ``arrays``, a mapping band name -> array."""
+        local_arrays = {band: arrays[band] for band in self.bands}
+        if numexpr is not None:
+            return numexpr.evaluate(self.expression, local_dict=local_arrays)
+        # The equation was checked to only hold arithmetic on band names and numbers
+        return eval(self._code, {"__builtins__": {}}, local_arrays)
+
+
+def compile_spectral_indices(spectral_indices):
+    """Compile the ``[(name, equation), ...]`` pairs of a request manifest."""
+    return [BandMathKernel(name, equation) for name, equation in spectral_indices]
+
+
+def compute_spectral_indices(band_paths, kernels, output_dir, output_prefix):
+    """Compute the ``kernels`` block by block over the ``band_paths`` rasters.
+
+    ``band_paths`` maps the band names to rasters on the same grid (local
+    paths or ``s3://`` URIs). One float32 GeoTIFF per index is written to
+    ``{output_dir}/{output_prefix}_{index}.tif``, and their paths are returned.
+    """
+    needed_bands = sorted({band for kernel in kernels for band in kernel.bands})
+    missing = [band for band in needed_bands if band not in band_paths]
+    if missing:
+        raise ValueError(f"Bands {missing} are required to compute the spectral indices")
+
+    sources = {band: rasterio.open(band_paths[band]) for band in needed_bands}
+    try:
+        reference = sources[needed_bands[0]]
+        for band, src in sources.items():
+            if (src.width, src.height, src.transform) != (
+                reference.width,
+                reference.height,
+                reference.transform,
+            ):
+                raise ValueError(f"Band {band} is not on the same grid as {needed_bands[0]}")
+
+        profile = reference.profile.copy()
+        profile.update(dtype="float32", count=1, nodata=BANDMATH_NODATA)
+        output_paths = {
+            kernel.name: os.path.join(output_dir, f"{output_prefix}_{kernel.name}.tif")
+            for kernel in kernels
+        }
+        destinations = {
+            name: rasterio.open(path, "w", **profile) for name, path in output_paths.items()
+        }
+        try:
+            for _, window in reference.block_windows(1):
+                arrays = {}
+                invalid = np.zeros((window.height, window.width), dtype=bool)
+                for band, src in sources.items():
+                    data = src.read(1, window=window).astype("float32")
+                    if src.nodata is not None:
+                        invalid |= data == src.nodata
+                    arrays[band] = data
+
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    for kernel in kernels:
+                        index = np.asarray(kernel.evaluate(arrays), dtype="float32")
+                        index[invalid | ~np.isfinite(index)] = BANDMATH_NODATA
+                        destinations[kernel.name].write(index, 1, window=window)
+        finally:
+            for dst in destinations.values():
+                dst.close()
+    finally:
+        for src in sources.values():
+            src.close()
+
+    return list(output_paths.values())
@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+import threading
+
+import geopandas as gp
+from shapely.ops import unary_union
+
+from utils.feature_extraction_manifest_helper import read_etag
+
+logger = logging.getLogger()
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class CountyGeometryStore:
+    """Counties boundaries indexed by FIPS.
+
+    The national counties file is read once, then kept in memory. Unions of
+    several counties are memoized by their sorted FIPS set. When
+    ``cache_path`` is set, the counties are also saved as GeoParquet so that
+    the next process skips the GeoJSON download. The cache records the ETag
+    of the GeoJSON it was made from (size and mtime of a local file) and is
+    only used while it matches.
+    """
+
+    def __init__(self, counties_geojson, cache_path=None):
+        source = read_etag(counties_geojson) if cache_path else None
+        if source is not None and self._read_cache_source(cache_path) == source:
+            logger.info(f"Loading counties geometries from cache {cache_path}")
+            counties = gp.read_parquet(cache_path)
+        else:
+            logger.info(f"Loading counties geometries from {counties_geojson}")
+            counties = gp.read_file(counties_geojson)
+            counties["FIPS"] = counties["STATE"] + counties["COUNTY"]
+            if source is not None:
+                os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+                counties.to_parquet(f"{cache_path}.tmp")
+                os.replace(f"{cache_path}.tmp", cache_path)
+                with open(f"{cache_path}.source.json", "w") as source_file:
+                    json.dump({"source": counties_geojson, "etag": source}, source_file)
+
+        self.counties = counties
+        self.crs = counties.crs
+        self._geometries = dict(zip(counties["FIPS"], counties.geometry))
+        self._unions = {}
+
+    @staticmethod
+    def _read_cache_source(cache_path):
+        if not os.path.exists(cache_path) or not os.path.exists(f"{cache_path}.source.json"):
+            return None
+        with open(f"{cache_path}.source.json") as source_file:
+            return json.load(source_file)["etag"]
+
+    def geometry(self, fips):
+        return self._geometries[fips]
+
+    def union(self, fips):
+        """Union of the boundaries of the ``fips`` counties, unknown FIPS are ignored."""
+        key = tuple(sorted(set(fips)))
+        if key not in self._unions:
+            missing = [f for f in key if f not in self._geometries]
+            if missing:
+                logger.warning(f"Ignoring the unknown FIPS {missing}")
+            self._unions[key] = unary_union(
+                [self._geometries[f] for f in key if f in self._geometries]
+            )
+        return self._unions[key]
+
+
+def get_county_geometry_store(counties_geojson, cache_path=None):
+    """Return the process wide store of ``counties_geojson``, loading it on first use."""
+    with _stores_lock:
+        if counties_geojson not in _stores:
+            _stores[counties_geojson] = CountyGeometryStore(counties_geojson, cache_path)
+        return _stores[counties_geojson]
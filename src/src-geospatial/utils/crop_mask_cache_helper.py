@@ -0,0 +1,105 @@
+import fcntl
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import rasterio
+
+logger = logging.getLogger()
+
+
+class CropMaskCache:
+    """Cropped crop masks shared by all the weeks processed by an executor.
+
+    A crop mask only changes with the year, so the mask cropped with the
+    county shape (and used as the reprojection template of the mosaics) is
+    prepared once per ``(year, fips, crop)``. Prepared masks are kept in memory
+    up to ``max_bytes``, the least recently used ones are dropped.
+
+    With ``spill_dir``, every prepared mask is also written there as a
+    GeoTIFF as soon as it is prepared, and read back from there instead of
+    S3. The worker processes of an executor share the directory: a mask is
+    prepared by one of them, under a lock file, and read from disk by the
+    others. The cached arrays are read-only.
+    """
+
+    def __init__(self, max_bytes=1024 * 1024**2, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.hits = 0
+        self.misses = 0
+        self._masks = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, "_".join(str(part) for part in key) + ".tif")
+
+    def _spill(self, key, image, profile):
+        spill_path = self._spill_path(key)
+        if os.path.exists(spill_path):
+            return
+        os.makedirs(self.spill_dir, exist_ok=True)
+        # Other workers may read the spill directory, only expose complete files
+        tmp_path = f"{spill_path}.{os.getpid()}.tmp"
+        with rasterio.open(tmp_path, "w", **{**profile, "driver": "GTiff"}) as dst:
+            dst.write(image)
+        os.replace(tmp_path, spill_path)
+
+    def _read_spilled(self, key):
+        if self.spill_dir is None or not os.path.exists(self._spill_path(key)):
+            return None
+        with rasterio.open(self._spill_path(key)) as src:
+            return src.read(), src.profile
+
+    def _prepare_shared(self, key, prepare):
+        """Prepare the mask once for all the workers sharing ``spill_dir``."""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        with open(f"{self._spill_path(key)}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Prepared by another worker while waiting for the lock
+                spilled = self._read_spilled(key)
+                if spilled is not None:
+                    return spilled
+                logger.info(f"Preparing the crop mask {key}")
+                image, profile = prepare()
+                self._spill(key, image, profile)
+                return image, profile
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _add(self, key, image, profile):
+        image.flags.writeable = False
+        self._masks[key] = (image, profile)
+        self._size += image.nbytes
+        while self._size > self.max_bytes and len(self._masks) > 1:
+            # Already on disk with a spill_dir, written when prepared
+            _, (evicted_image, _) = self._masks.popitem(last=False)
+            self._size -= evicted_image.nbytes
+
+    def get(self, key, prepare):
+        """Prepared mask of ``key``, ``prepare()`` returns ``(image, profile)`` on a miss."""
+        with self._lock:
+            if key in self._masks:
+                self.hits += 1
+                self._masks.move_to_end(key)
+                return self._masks[key]
+
+            spilled = self._read_spilled(key)
+            if spilled is not None:
+                self.hits += 1
+                self._add(key, *spilled)
+                return spilled
+            self.misses += 1
+
+        if self.spill_dir is None:
+            logger.info(f"Preparing the crop mask {key}")
+            image, profile = prepare()
+        else:
+            image, profile = self._prepare_shared(key, prepare)
+        with self._lock:
+            if key not in self._masks:
+                self._add(key, image, profile)
+            return self._masks[key]
@@ -0,0 +1,236 @@
+import logging
+
+import numpy as np
+import pandas as pd
+import rasterio
+import zarr
+from rasterio.crs import CRS
+
+from utils.windowed_raster_helper import row_windows
+from utils.zonal_statistics_helper import ZonalLabelIndex, rasterize_cell_labels, zonal_statistics
+
+logger = logging.getLogger()
+
+# ISO years have 52 or 53 weeks, week w of the season is stored at index w - 1
+ISOWEEKS = 53
+
+# One chunk per (band, week) and spatial tile: the weeks of a county are written by
+# different processes without sharing a chunk, and a band time series is read alone
+DATACUBE_CHUNK_SIZE = 512
+
+DATACUBE_DIMENSIONS = ["band", "week", "y", "x"]
+
+
+def datacube_uri(datacubes_uri, type_of_crop, year, fips):
+    """Location of the datacube of a county and season."""
+    return f"{datacubes_uri}/{type_of_crop}/{int(year)}/{fips}.zarr"
+
+
+def open_datacube(uri, band_names, profile):
+    """Open the datacube of a county and season for writing, created on first use.
+
+    The cube holds the masked pixels of the county on the crop mask grid
+    (``profile``) as a ``pixels`` array of dimensions ``(band, week, y, x)``,
+    the crop mask as ``crop_mask`` and the weeks written so far as
+    ``weeks_written``. Every array is chunked and compressed with the zarr
+    defaults (Zarr format 3); their ``dimension_names`` make the cube
+    readable by xarray.
+    """
+    cube = zarr.open_group(uri, mode="a")
+    height, width = profile["height"], profile["width"]
+    nodata = profile.get("nodata")
+
+    cube.require_array(
+        "pixels",
+        shape=(len(band_names), ISOWEEKS, height, width),
+        chunks=(1, 1, DATACUBE_CHUNK_SIZE, DATACUBE_CHUNK_SIZE),
+        dtype=profile["dtype"],
+        fill_value=nodata if nodata is not None else 0,
+        dimension_names=DATACUBE_DIMENSIONS,
+    )
+    cube.require_array(
+        "crop_mask",
+        shape=(height, width),
+        chunks=(DATACUBE_CHUNK_SIZE, DATACUBE_CHUNK_SIZE),
+        dtype="uint8",
+        fill_value=0,
+        dimension_names=["y", "x"],
+    )
+    # One chunk per week, like the pixels
+    cube.require_array(
+        "weeks_written",
+        shape=(ISOWEEKS,),
+        chunks=(1,),
+        dtype="bool",
+        fill_value=False,
+        dimension_names=["week"],
+    )
+
+    if "band_names" not in cube.attrs:
+        # Same values whichever week creates the cube, concurrent writes are harmless
+        cube.attrs.update(
+            band_names=list(band_names),
+            crs=CRS.from_user_input(profile["crs"]).to_wkt(),
+            transform=list(profile["transform"])[:6],
+            nodata=nodata,
+        )
+    elif cube.attrs["band_names"] != list(band_names):
+        raise ValueError(
+            f"Datacube {uri} holds the bands {cube.attrs['band_names']}, not {list(band_names)}"
+        )
+    return cube
+
+
+def write_datacube_week(uri, isoweek, masked_image, crop_mask_image, profile, band_names):
+    """Write the ``(band, y, x)`` masked pixels of a week to the county datacube."""
+    cube = open_datacube(uri, band_names, dict(profile, dtype=masked_image.dtype.name))
+    cube["crop_mask"][:] = crop_mask_image[0] > 0
+    cube["pixels"][:, int(isoweek) - 1] = masked_image
+    # Set last, a week interrupted while written is not read back
+    cube["weeks_written"][int(isoweek) - 1] = True
+
+
+def write_datacube_week_from_raster(
+    uri, isoweek, masked_path, crop_mask_image, band_names, max_block_bytes
+):
+    """Same as ``write_datacube_week`` from a masked GeoTIFF, copied by blocks of rows."""
+    with rasterio.open(masked_path) as src:
+        cube = open_datacube(uri, band_names, src.profile)
+        cube["crop_mask"][:] = crop_mask_image[0] > 0
+        bytes_per_pixel = src.count * np.dtype(src.dtypes[0]).itemsize
+        for window in row_windows(src.height, src.width, bytes_per_pixel, max_block_bytes):
+            rows = slice(window.row_off, window.row_off + window.height)
+            cube["pixels"][:, int(isoweek) - 1, rows] = src.read(window=window)
+    cube["weeks_written"][int(isoweek) - 1] = True
+
+
+class CountyDatacube:
+    """Read side of a county datacube, to derive new features without the raw imagery.
+
+    Bands are returned as float ``(week, y, x)`` arrays of the written weeks
+    (``isoweeks``), nodata pixels as NaN. With ``crop_only`` the pixels out of
+    the crop mask are NaN as well; otherwise they keep the 0 the masking gave
+    them, which is how the zonal statistics files count them.
+
+    The cube is on the crop mask grid, the cells statistics computed here
+    are not reprojected to EPSG:4326 like the ones of the zonal statistics
+    files, so they differ slightly at the cells borders.
+    """
+
+    def __init__(self, uri, crop_only=True):
+        self.uri = uri
+        self.crop_only = crop_only
+        self._cube = zarr.open_group(uri, mode="r")
+        self.band_names = list(self._cube.attrs["band_names"])
+        self.crs = CRS.from_wkt(self._cube.attrs["crs"])
+        self.transform = rasterio.Affine(*self._cube.attrs["transform"])
+        self.nodata = self._cube.attrs["nodata"]
+        self.shape = tuple(self._cube["pixels"].shape[2:])
+        self.isoweeks = np.flatnonzero(self._cube["weeks_written"][:]) + 1
+        self._crop_mask = None
+
+    @property
+    def crop_mask(self):
+        if self._crop_mask is None:
+            self._crop_mask = self._cube["crop_mask"][:].astype(bool)
+        return self._crop_mask
+
+    def band(self, band_name, isoweeks=None):
+        """``(week, y, x)`` pixels of a band over ``isoweeks`` (every written week by default)."""
+        isoweeks = self.isoweeks if isoweeks is None else np.asarray(isoweeks, dtype=int)
+        missing = np.setdiff1d(isoweeks, self.isoweeks)
+        if missing.size:
+            raise ValueError(f"Weeks {missing.tolist()} are not in the datacube {self.uri}")
+
+        pixels = self._cube["pixels"].get_orthogonal_selection(
+            (self.band_names.index(band_name), isoweeks - 1, slice(None), slice(None))
+        ).astype(np.float64)
+        if self.nodata is not None:
+            pixels[pixels == self.nodata] = np.nan
+        if self.crop_only:
+            pixels[:, ~self.crop_mask] = np.nan
+        return pixels
+
+    def cell_index(self, cells, cell_ids=None):
+        """Label index of the cells (a GeoSeries, any CRS) over the cube grid."""
+        cells = cells.to_crs(self.crs)
+        labels = rasterize_cell_labels(cells, self.transform, self.shape)
+        return ZonalLabelIndex.from_labels(labels, len(cells), cell_ids=cell_ids)
+
+    def cell_aggregates(self, cells, band_names=None, isoweeks=None, stats=None):
+        """Statistics of the cells per week, one row per (week, cell).
+
+        Columns are the ``{stat}_{band_name}`` of the zonal statistics files,
+        plus ``isoweek`` and the ``id_10`` of the cells when ``cells`` is a
+        GeoDataFrame holding it.
+        """
+        band_names = band_names or self.band_names
+        cell_ids = cells["id_10"].to_numpy() if "id_10" in getattr(cells, "columns", []) else None
+        index = self.cell_index(cells.geometry, cell_ids=cell_ids)
+        isoweeks = self.isoweeks if isoweeks is None else np.asarray(isoweeks, dtype=int)
+
+        bands = {band_name: self.band(band_name, isoweeks) for band_name in band_names}
+        weeks_stats = []
+        for week_idx, isoweek in enumerate(isoweeks):
+            week_stats = zonal_statistics(
+                index,
+                np.stack([bands[band_name][week_idx] for band_name in band_names]),
+                band_names,
+                stats=stats,
+            )
+            week_stats.insert(0, "isoweek", isoweek)
+            if cell_ids is not None:
+                week_stats.insert(0, "id_10", cell_ids)
+            weeks_stats.append(week_stats)
+        return pd.concat(weeks_stats, ignore_index=True)
+
+    def cell_curves(self, cells, band_name, isoweeks=None):
+        """Mean of a band over each cell and week, one row per cell and one column per week."""
+        isoweeks = self.isoweeks if isoweeks is None else np.asarray(isoweeks, dtype=int)
+        aggregates = self.cell_aggregates(cells, [band_name], isoweeks, stats=["mean"])
+        # Rows are grouped by week, the cells in the same order every week
+        means = aggregates[f"mean_{band_name}"].to_numpy().reshape(len(isoweeks), len(cells))
+        index = aggregates["id_10"].iloc[: len(cells)] if "id_10" in aggregates else None
+        return pd.DataFrame(means.T, index=index, columns=isoweeks)
+
+
+def phenology_metrics(curves, smoothing_weeks=3, threshold=0.5):
+    """Phenology of the cells from their ``cell_curves`` (e.g. of an NDVI band).
+
+    Missing weeks are interpolated and the curves smoothed with a centered
+    rolling mean of ``smoothing_weeks``. The green-up and senescence weeks are
+    the first and last weeks the curve is above ``threshold`` of its
+    amplitude; ``integral`` is the sum of the curve over the weeks. Cells
+    without data get NaN metrics.
+    """
+    weeks = np.arange(curves.columns.min(), curves.columns.max() + 1)
+    smoothed = (
+        curves.reindex(columns=weeks)
+        .interpolate(axis=1, limit_area="inside")
+        .T.rolling(smoothing_weeks, center=True, min_periods=1)
+        .mean()
+        .T
+    )
+
+    values = smoothed.to_numpy()
+    has_data = ~np.isnan(values).all(axis=1)
+    # Cells without data are computed over zeros, their metrics are dropped below
+    values[~has_data] = 0
+    minimum = np.nanmin(values, axis=1)
+    maximum = np.nanmax(values, axis=1)
+    above = np.nan_to_num(values, nan=-np.inf) >= (
+        minimum + threshold * (maximum - minimum)
+    )[:, None]
+
+    metrics = {
+        "peak_week": weeks[np.nanargmax(values, axis=1)],
+        "peak_value": maximum,
+        "amplitude": maximum - minimum,
+        "greenup_week": weeks[above.argmax(axis=1)],
+        "senescence_week": weeks[len(weeks) - 1 - above[:, ::-1].argmax(axis=1)],
+        "integral": np.nansum(values, axis=1),
+    }
+    return pd.DataFrame(
+        {name: np.where(has_data, metric, np.nan) for name, metric in metrics.items()},
+        index=curves.index,
+    )
@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+import boto3
+import botocore
+
+from utils.eoj_pipeline_helper import read_json_document, write_json_document
+
+logger = logging.getLogger()
+
+s3_client = boto3.client("s3")
+
+
+def stage_cache_keys(stages, context):
+    """Content address of every stage of a chain.
+
+    The key of a stage hashes its full EOJ request (AOI geometry, time range,
+    cloud cover filter, resampling resolution, bandmath equations, ...) with
+    the key of the previous stage, so it changes whenever anything upstream
+    changes.
+    """
+    keys = []
+    previous_key = ""
+    for stage in stages:
+        config = {"Name": stage.name, **stage.job_config(context)}
+        if stage.input_config is not None:
+            config["InputConfig"] = stage.input_config(context)
+        previous_key = hashlib.sha256(
+            json.dumps([previous_key, config], sort_keys=True, default=str).encode("UTF-8")
+        ).hexdigest()
+        keys.append(previous_key)
+    return keys
+
+
+def _s3_prefix_exists(s3_uri):
+    bucket, prefix = s3_uri[len("s3://") :].split("/", 1)
+    response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1)
+    return response.get("KeyCount", 0) > 0
+
+
+class EarthObservationJobCache:
+    """Content addressed index of completed EOJs.
+
+    Each entry, stored as ``{uri}/{key}.json`` (local directory or S3 prefix),
+    records the ARN of the EOJ that produced a stage key and the S3 locations
+    its results were exported to.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri.rstrip("/")
+
+    def get(self, key):
+        return read_json_document(f"{self.uri}/{key}.json")
+
+    def put(self, key, stage_name, arn, export_uri=None):
+        entry = self.get(key) or {"stage": stage_name, "exports": []}
+        entry["arn"] = arn
+        if export_uri and export_uri not in entry["exports"]:
+            entry["exports"].append(export_uri)
+        write_json_document(f"{self.uri}/{key}.json", entry)
+
+    async def seed_journal(self, client, key, stage, journal, output_s3_uri):
+        """Record a cached EOJ of ``stage`` in the chain journal.
+
+        The cached EOJ is only reused if the service still reports it as
+        completed, and its export only if the results are still in S3.
+        """
+        entry = await asyncio.to_thread(self.get, key)
+        if entry is None:
+            return False
+
+        try:
+            eoj_status_response = await asyncio.to_thread(
+                client.get_earth_observation_job, Arn=entry["arn"]
+            )
+        except botocore.exceptions.ClientError as e:
+            logger.info(f"Ignoring cached {stage.name} EOJ {entry['arn']}: {e}")
+            return False
+        if eoj_status_response["Status"] != "COMPLETED":
+            return False
+
+        record = {"arn": entry["arn"], "status": "COMPLETED", "cache_key": key}
+        if (
+            stage.export
+            and output_s3_uri in entry["exports"]
+            and await asyncio.to_thread(_s3_prefix_exists, output_s3_uri)
+        ):
+            record.update(export_arn=entry["arn"], export_status="SUCCEEDED")
+
+        logger.info(f"Cache hit for {stage.name} EOJ {entry['arn']}")
+        await asyncio.to_thread(journal.update_stage, stage.name, **record)
+        return True
@@ -0,0 +1,230 @@
+import os
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import boto3
+import botocore
+
+EOJ_CLIENTS = ["sagemaker-geospatial", "local"]
+
+# Days between two synthetic acquisitions of the local client
+LOCAL_REVISIT_DAYS = 5
+
+
+def create_earth_observation_client(kind="sagemaker-geospatial", **options):
+    """Return the client used to run EOJs.
+
+    ``sagemaker-geospatial`` is the boto3 client of the service (``options``
+    are passed to ``boto3.client``), ``local`` is a
+    ``LocalEarthObservationClient`` simulating it offline.
+    """
+    if kind == "sagemaker-geospatial":
+        return boto3.client(service_name="sagemaker-geospatial", **options)
+    if kind == "local":
+        return LocalEarthObservationClient(**options)
+    raise ValueError(f"Unknown EOJ client {kind}, expected one of {EOJ_CLIENTS}")
+
+
+def _client_error(code, message, operation_name):
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code, "Message": message}}, operation_name
+    )
+
+
+def _parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class LocalEarthObservationClient:
+    """Stand-in for the sagemaker-geospatial client to run the orchestration offline.
+
+    Jobs complete after a random latency drawn in ``latency`` (seconds), plus
+    ``latency_per_day`` for every day of the queried time range, fail with
+    probability ``failure_rate``, and every call is throttled with
+    probability ``throttling_rate``. Exports write small synthetic GeoTIFFs,
+    one per acquisition date and band, under ``output_dir/<bucket>/<prefix>``.
+    Calls and started jobs are counted in ``api_calls`` and ``jobs_started``.
+    """
+
+    def __init__(
+        self,
+        output_dir="/tmp/local-eoj",
+        latency=(1.0, 3.0),
+        export_latency=(0.5, 1.0),
+        latency_per_day=0.0,
+        failure_rate=0.0,
+        throttling_rate=0.0,
+        seed=None,
+    ):
+        self.output_dir = output_dir
+        self.latency = latency
+        self.export_latency = export_latency
+        self.latency_per_day = latency_per_day
+        self.failure_rate = failure_rate
+        self.throttling_rate = throttling_rate
+        self.api_calls = 0
+        self.jobs_started = 0
+        self._random = random.Random(seed)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _call(self, operation_name):
+        self.api_calls += 1
+        if self._random.random() < self.throttling_rate:
+            raise _client_error("ThrottlingException", "Rate exceeded", operation_name)
+
+    def _status(self, job, now):
+        if now < job["finish_time"]:
+            return "IN_PROGRESS"
+        return "FAILED" if job["will_fail"] else "COMPLETED"
+
+    def _job(self, arn, operation_name):
+        if arn not in self._jobs:
+            raise _client_error(
+                "ResourceNotFoundException", f"Unknown job {arn}", operation_name
+            )
+        return self._jobs[arn]
+
+    def list_raster_data_collections(self, **params):
+        with self._lock:
+            self._call("ListRasterDataCollections")
+        return {
+            "RasterDataCollectionSummaries": [
+                {"Name": "Landsat Collection 2 Level-2", "Arn": "arn:local:raster-data-collection/landsat"},
+                {"Name": "Sentinel 2 L2A COGs", "Arn": "arn:local:raster-data-collection/sentinel-2"},
+            ]
+        }
+
+    def start_earth_observation_job(self, **params):
+        with self._lock:
+            self._call("StartEarthObservationJob")
+            now = time.monotonic()
+            arn = f"arn:local:earth-observation-job/{uuid.uuid4().hex}"
+            job = {
+                "Arn": arn,
+                "Name": params["Name"],
+                "InputConfig": params["InputConfig"],
+                "JobConfig": params["JobConfig"],
+                "CreationTime": datetime.utcnow(),
+                "will_fail": self._random.random() < self.failure_rate,
+            }
+            time_range = self._time_range(job)
+            days = (time_range[1] - time_range[0]).days
+            job["finish_time"] = (
+                now + self._random.uniform(*self.latency) + days * self.latency_per_day
+            )
+            self._jobs[arn] = job
+            self.jobs_started += 1
+        return {"Arn": arn, "Name": params["Name"], "Status": "INITIALIZING"}
+
+    def export_earth_observation_job(self, **params):
+        with self._lock:
+            self._call("ExportEarthObservationJob")
+            job = self._job(params["Arn"], "ExportEarthObservationJob")
+            if self._status(job, time.monotonic()) != "COMPLETED":
+                raise _client_error(
+                    "ValidationException", "Only completed jobs can be exported", "ExportEarthObservationJob"
+                )
+            job["export"] = {
+                "S3Uri": params["OutputConfig"]["S3Data"]["S3Uri"],
+                "finish_time": time.monotonic() + self._random.uniform(*self.export_latency),
+                "will_fail": self._random.random() < self.failure_rate,
+                "written": False,
+            }
+        return {"Arn": job["Arn"], "ExportStatus": "IN_PROGRESS"}
+
+    def get_earth_observation_job(self, Arn):
+        with self._lock:
+            self._call("GetEarthObservationJob")
+            job = self._job(Arn, "GetEarthObservationJob")
+            now = time.monotonic()
+            response = {"Arn": Arn, "Name": job["Name"], "Status": self._status(job, now)}
+            if response["Status"] == "FAILED":
+                response["ErrorDetails"] = {"Type": "SERVER_ERROR", "Message": "Simulated failure"}
+
+            export = job.get("export")
+            if export is not None:
+                response["ExportStatus"] = self._status(export, now)
+                if response["ExportStatus"] == "COMPLETED":
+                    response["ExportStatus"] = "SUCCEEDED"
+                    if not export["written"]:
+                        self._write_outputs(job, export["S3Uri"])
+                        export["written"] = True
+        return response
+
+    def list_earth_observation_jobs(self, **params):
+        with self._lock:
+            self._call("ListEarthObservationJobs")
+            now = time.monotonic()
+            jobs = sorted(
+                self._jobs.values(),
+                key=lambda job: job["CreationTime"],
+                reverse=params.get("SortOrder") == "DESCENDING",
+            )
+            start = int(params.get("NextToken", 0))
+            page = jobs[start : start + params.get("MaxResults", 20)]
+            response = {
+                "EarthObservationJobSummaries": [
+                    {
+                        "Arn": job["Arn"],
+                        "Name": job["Name"],
+                        "CreationTime": job["CreationTime"],
+                        "Status": self._status(job, now),
+                    }
+                    for job in page
+                ]
+            }
+            if start + len(page) < len(jobs):
+                response["NextToken"] = str(start + len(page))
+        return response
+
+    def _root_query(self, job):
+        while "PreviousEarthObservationJobArn" in job["InputConfig"]:
+            job = self._jobs[job["InputConfig"]["PreviousEarthObservationJobArn"]]
+        return job
+
+    def _time_range(self, job):
+        time_range = self._root_query(job)["InputConfig"]["RasterDataCollectionQuery"][
+            "TimeRangeFilter"
+        ]
+        return _parse_time(time_range["StartTime"]), _parse_time(time_range["EndTime"])
+
+    def _output_bands(self, job):
+        job_config = job["JobConfig"]
+        if "BandMathConfig" in job_config:
+            return [op["Name"] for op in job_config["BandMathConfig"]["CustomIndices"]["Operations"]]
+        root_config = self._root_query(job)["JobConfig"]
+        if "CloudRemovalConfig" in root_config:
+            return root_config["CloudRemovalConfig"]["TargetBands"]
+        return ["red", "green", "blue", "nir", "swir16"]
+
+    def _write_outputs(self, job, s3_uri):
+        """Write one synthetic GeoTIFF per acquisition date and band."""
+        import numpy as np
+        import rasterio
+        from rasterio.transform import from_origin
+
+        bucket, prefix = s3_uri[len("s3://") :].split("/", 1)
+        output_dir = os.path.join(self.output_dir, bucket, prefix)
+        os.makedirs(output_dir, exist_ok=True)
+
+        acquisition, end_time = self._time_range(job)
+        profile = {
+            "driver": "GTiff",
+            "dtype": "float32",
+            "count": 1,
+            "height": 64,
+            "width": 64,
+            "crs": "EPSG:32616",
+            "transform": from_origin(300000, 4500000, 30, 30),
+            "nodata": -9999,
+        }
+        while acquisition <= end_time:
+            for band in self._output_bands(job):
+                file_name = f"S2A_16TCK_{acquisition:%Y%m%d}_0_L2A_{band}.tif"
+                with rasterio.open(os.path.join(output_dir, file_name), "w", **profile) as dst:
+                    dst.write(np.random.default_rng().random((1, 64, 64), dtype="float32"))
+            acquisition += timedelta(days=LOCAL_REVISIT_DAYS)
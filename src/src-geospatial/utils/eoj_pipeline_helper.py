@@ -0,0 +1,273 @@
+import asyncio
+import json
+import logging
+import os
+import random
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import boto3
+import botocore
+
+logger = logging.getLogger()
+
+s3_client = boto3.client("s3")
+
+# Backoff of the throttled EOJ start and export calls, in seconds
+THROTTLING_RETRY_DELAY = 1
+THROTTLING_MAX_DELAY = 60
+THROTTLING_MAX_ATTEMPTS = 8
+
+
+def read_json_document(uri):
+    """Read a JSON document from a local file or an S3 object, None if missing."""
+    if uri.startswith("s3://"):
+        bucket, key = uri[len("s3://") :].split("/", 1)
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=key)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+        return json.loads(response["Body"].read())
+
+    if not os.path.exists(uri):
+        return None
+    with open(uri, "r") as document:
+        return json.load(document)
+
+
+def write_json_document(uri, content):
+    """Write a JSON document to a local file or an S3 object."""
+    body = json.dumps(content, indent=2)
+    if uri.startswith("s3://"):
+        bucket, key = uri[len("s3://") :].split("/", 1)
+        s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode("UTF-8"))
+        return
+
+    os.makedirs(os.path.dirname(os.path.abspath(uri)), exist_ok=True)
+    # Write to a temporary file first so a preemption never leaves a truncated document
+    with open(f"{uri}.tmp", "w") as document:
+        document.write(body)
+    os.replace(f"{uri}.tmp", uri)
+
+
+@dataclass
+class EarthObservationJobStage:
+    """Declarative description of one EOJ of a chain.
+
+    ``job_config`` builds the ``JobConfig`` of the EOJ from the chain context.
+    ``input_config`` builds the ``InputConfig`` of the first stage, the
+    following stages read the output of the previous EOJ. When ``export`` is
+    set, the results of the EOJ are exported to the chain output S3 location.
+    """
+
+    name: str
+    job_config: Callable[[dict], dict]
+    input_config: Optional[Callable[[dict], dict]] = None
+    export: bool = False
+
+
+class EarthObservationJobJournal:
+    """Durable record of the EOJs started by a chain.
+
+    The journal is a JSON document stored either in a local file or in an S3
+    object (``s3://bucket/key``) and rewritten after every state change, so a
+    restarted chain knows which stages already completed. Its methods block on
+    the write, async code calls them through ``asyncio.to_thread``.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.state = self._load()
+
+    def _load(self):
+        return read_json_document(self.uri) or {"stages": {}}
+
+    def save(self):
+        write_json_document(self.uri, self.state)
+
+    def stage(self, name):
+        return self.state["stages"].get(name, {})
+
+    def update_stage(self, name, **fields):
+        self.state["stages"].setdefault(name, {}).update(fields)
+        self.save()
+
+    def start_stage(self, name, arn, stages):
+        """Record a newly started EOJ and forget the stages following it, their
+        input is about to change."""
+        names = [stage.name for stage in stages]
+        for later_stage in names[names.index(name) + 1 :]:
+            self.state["stages"].pop(later_stage, None)
+        self.state["stages"][name] = {"arn": arn, "status": "IN_PROGRESS"}
+        self.save()
+
+
+async def wait_for_earth_observation_job(
+    poller, arn, status_key, success_status, log_name="EOJ"
+):
+    """Wait until ``status_key`` of an EOJ reaches ``success_status`` or ``FAILED``."""
+
+    eoj_status_response = await poller.wait(arn, status_key)
+    job_status = eoj_status_response[status_key]
+
+    if job_status == success_status:
+        logger.info(f"{log_name} finished successfuly.")
+    else:
+        logger.info(f"{log_name} Failed.")
+        logger.info(eoj_status_response)
+    return job_status
+
+
+async def call_with_throttling_retries(call, **params):
+    """Run the blocking client ``call`` on a thread, retried with a jittered exponential
+    backoff while it is throttled."""
+
+    for attempt in range(THROTTLING_MAX_ATTEMPTS):
+        try:
+            return await asyncio.to_thread(call, **params)
+        except botocore.exceptions.ClientError as e:
+            if (
+                e.response["Error"]["Code"] != "ThrottlingException"
+                or attempt == THROTTLING_MAX_ATTEMPTS - 1
+            ):
+                raise
+            delay = min(THROTTLING_MAX_DELAY, THROTTLING_RETRY_DELAY * 2**attempt)
+            delay = delay / 2 + random.uniform(0, delay / 2)
+            logger.warning(f"{e.operation_name} throttled, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def run_earth_observation_job_stage(
+    client, poller, stage, stages, context, previous_arn, journal, role_arn, output_s3_uri
+):
+    """Run (or resume) one stage and its export, return its ARN and status."""
+
+    record = journal.stage(stage.name)
+    job_arn = record.get("arn")
+
+    if record.get("status") != "COMPLETED":
+        if job_arn is None or record.get("status") == "FAILED":
+            if stage.input_config is not None:
+                input_config = await asyncio.to_thread(stage.input_config, context)
+            else:
+                input_config = {"PreviousEarthObservationJobArn": previous_arn}
+
+            eojParams = {
+                "Name": stage.name,
+                "InputConfig": input_config,
+                **stage.job_config(context),
+                "ExecutionRoleArn": role_arn,
+            }
+
+            eoj_response = await call_with_throttling_retries(
+                client.start_earth_observation_job, **eojParams
+            )
+            job_arn = eoj_response["Arn"]
+            await asyncio.to_thread(journal.start_stage, stage.name, job_arn, stages)
+        else:
+            logger.info(f"Resuming {stage.name} EOJ {job_arn}")
+
+        job_status = await wait_for_earth_observation_job(
+            poller, job_arn, "Status", "COMPLETED", f"{stage.name} EOJ"
+        )
+        await asyncio.to_thread(journal.update_stage, stage.name, status=job_status)
+        if job_status == "FAILED":
+            return job_arn, job_status
+
+    record = journal.stage(stage.name)
+    if not stage.export or record.get("export_status") == "SUCCEEDED":
+        return job_arn, "COMPLETED"
+
+    # export results of an EarthObservationJob to an S3 location.
+    if record.get("export_status") != "IN_PROGRESS":
+        eojParamsExport = {
+            "Arn": job_arn,
+            "ExecutionRoleArn": role_arn,
+            "OutputConfig": {"S3Data": {"S3Uri": output_s3_uri}},
+        }
+        eoj_response_export = await call_with_throttling_retries(
+            client.export_earth_observation_job, **eojParamsExport
+        )
+        await asyncio.to_thread(
+            journal.update_stage,
+            stage.name,
+            export_arn=eoj_response_export["Arn"],
+            export_status="IN_PROGRESS",
+        )
+
+    export_status = await wait_for_earth_observation_job(
+        poller,
+        journal.stage(stage.name)["export_arn"],
+        "ExportStatus",
+        "SUCCEEDED",
+        f"{stage.name} export EOJ",
+    )
+    await asyncio.to_thread(journal.update_stage, stage.name, export_status=export_status)
+    return job_arn, "COMPLETED" if export_status == "SUCCEEDED" else "FAILED"
+
+
+async def run_earth_observation_job_pipeline(
+    client,
+    poller,
+    stages,
+    context,
+    journal,
+    role_arn,
+    output_s3_uri,
+    scheduler,
+    chain_id,
+    cache=None,
+    cache_keys=None,
+):
+    """Run the EOJ ``stages`` in order, skipping the ones the journal records
+    as completed. Return the ARN and status of the last stage that ran.
+
+    When a ``cache`` is given, stages unknown to the journal are first looked
+    up by their content address in ``cache_keys``, and completed stages are
+    added to it.
+    """
+
+    job_arn, job_status = None, "COMPLETED"
+    for stage_idx, stage in enumerate(stages):
+        if cache is not None and not journal.stage(stage.name):
+            await cache.seed_journal(
+                client, cache_keys[stage_idx], stage, journal, output_s3_uri
+            )
+
+        record = journal.stage(stage.name)
+        if record.get("status") == "COMPLETED" and (
+            not stage.export or record.get("export_status") == "SUCCEEDED"
+        ):
+            logger.info(f"[{chain_id}] Reusing completed {stage.name} EOJ {record['arn']}")
+            job_arn = record["arn"]
+            continue
+
+        async with scheduler.job_slot(chain_id, stage.name):
+            job_arn, job_status = await run_earth_observation_job_stage(
+                client,
+                poller,
+                stage,
+                stages,
+                context,
+                job_arn,
+                journal,
+                role_arn,
+                output_s3_uri,
+            )
+
+        if job_status == "FAILED":
+            logger.info(f"[{chain_id}] {stage.name} EOJ failed, stopping the chain.")
+            break
+
+        if cache is not None:
+            await asyncio.to_thread(
+                cache.put,
+                cache_keys[stage_idx],
+                stage.name,
+                job_arn,
+                output_s3_uri if stage.export else None,
+            )
+
+    return job_arn, job_status
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import random
+import time
+
+import botocore
+
+logger = logging.getLogger()
+
+TERMINAL_STATUSES = {"Status": {"COMPLETED", "FAILED"}, "ExportStatus": {"SUCCEEDED", "FAILED"}}
+
+
+class EarthObservationJobPoller:
+    """Single poller tracking the status of every in-flight EOJ.
+
+    Each job is first checked after ``first_check_delay`` seconds, then with an
+    exponential backoff (with jitter) capped at ``max_delay``. When several jobs
+    are due at the same time their statuses are read with one paginated
+    ``list_earth_observation_jobs`` call instead of one ``get`` per job. Callers
+    get a future resolved with the ``get_earth_observation_job`` response once
+    the job reaches a terminal status.
+
+    When listing fails with an error other than throttling (e.g. AccessDenied,
+    ``sagemaker-geospatial:ListEarthObservationJobs`` not being granted), the
+    poller falls back to one ``get`` per job for the rest of its life.
+    """
+
+    def __init__(
+        self,
+        client,
+        first_check_delay=10,
+        max_delay=120,
+        backoff_factor=2,
+        batch_threshold=3,
+        max_list_pages=5,
+    ):
+        self.client = client
+        self.first_check_delay = first_check_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.batch_threshold = batch_threshold
+        self.max_list_pages = max_list_pages
+        self.api_calls = 0
+        self.list_disabled = False
+        self._jobs = {}
+        self._task = None
+        self._wakeup = None
+
+    def _next_delay(self, attempt):
+        delay = min(self.max_delay, self.first_check_delay * self.backoff_factor**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def track(self, arn, status_key="Status"):
+        """Start tracking ``arn`` and return a future of its final status response.
+
+        A job already tracked keeps its future, every caller waits on the same one.
+        """
+
+        tracked = self._jobs.get((arn, status_key))
+        if tracked is not None and not tracked["future"].done():
+            return tracked["future"]
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._jobs[(arn, status_key)] = {
+            "future": future,
+            "attempt": 0,
+            "status": None,
+            "next_check": time.monotonic() + self.first_check_delay,
+        }
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        else:
+            self._wakeup.set()
+        return future
+
+    async def wait(self, arn, status_key="Status"):
+        return await self.track(arn, status_key)
+
+    async def _run(self):
+        while self._jobs:
+            now = time.monotonic()
+            due = [job for job, state in self._jobs.items() if state["next_check"] <= now]
+            if not due:
+                next_check = min(state["next_check"] for state in self._jobs.values())
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=next_check - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                responses = await asyncio.to_thread(self._check, due)
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] != "ThrottlingException":
+                    responses = {job: e for job in due}
+                else:
+                    logger.warning(f"EOJ status checks throttled, backing off {len(due)} jobs")
+                    responses = {}
+            except botocore.exceptions.BotoCoreError as e:
+                logger.warning(f"EOJ status checks failed with {e}, backing off {len(due)} jobs")
+                responses = {}
+            except Exception as e:
+                # Never leave the waiting stages hanging on an unexpected error
+                responses = {job: e for job in due}
+
+            for job in due:
+                state = self._jobs[job]
+                response = responses.get(job)
+                if isinstance(response, Exception):
+                    del self._jobs[job]
+                    # A cancelled waiter has nothing to be told
+                    if not state["future"].done():
+                        state["future"].set_exception(response)
+                    continue
+
+                arn, status_key = job
+                status = response[status_key] if response else state["status"]
+                if status != state["status"]:
+                    logger.info(f"EOJ {arn} {status_key} is {status}")
+                    state["status"] = status
+
+                if status in TERMINAL_STATUSES[status_key]:
+                    del self._jobs[job]
+                    if not state["future"].done():
+                        state["future"].set_result(response)
+                    continue
+
+                state["attempt"] += 1
+                state["next_check"] = time.monotonic() + self._next_delay(state["attempt"])
+
+    def _get(self, arn):
+        self.api_calls += 1
+        return self.client.get_earth_observation_job(Arn=arn)
+
+    def _check(self, due):
+        """Return the status response of every due job, batching when possible."""
+
+        responses = {}
+        pending = [job for job in due if job[1] == "Status"]
+
+        if len(pending) >= self.batch_threshold and not self.list_disabled:
+            try:
+                listed = self._list_statuses({arn for arn, _ in pending})
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] == "ThrottlingException":
+                    raise
+                # Listing is an optimization, one missing permission must not fail the jobs
+                logger.warning(
+                    f"Listing the EOJs failed with {e}, reading the status of each job instead"
+                )
+                self.list_disabled = True
+                listed = {}
+            for job in pending:
+                status = listed.get(job[0])
+                # Finished jobs are read in full below, the response holds the failure reason
+                if status is not None and status not in TERMINAL_STATUSES["Status"]:
+                    responses[job] = {"Arn": job[0], "Status": status}
+
+        for job in due:
+            if job in responses:
+                continue
+            try:
+                responses[job] = self._get(job[0])
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] == "ThrottlingException":
+                    raise
+                responses[job] = e
+        return responses
+
+    def _list_statuses(self, arns):
+        """Read the status of ``arns`` from the most recent EOJs of the account."""
+
+        statuses = {}
+        params = {"SortBy": "CreationTime", "SortOrder": "DESCENDING"}
+        for _ in range(self.max_list_pages):
+            self.api_calls += 1
+            response = self.client.list_earth_observation_jobs(**params)
+            for summary in response["EarthObservationJobSummaries"]:
+                if summary["Arn"] in arns:
+                    statuses[summary["Arn"]] = summary["Status"]
+            if len(statuses) == len(arns) or "NextToken" not in response:
+                break
+            params["NextToken"] = response["NextToken"]
+        return statuses
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger()
+
+
+class EarthObservationJobScheduler:
+    """Run chains of EOJs concurrently.
+
+    Two limits are enforced: ``max_concurrent_chains`` bounds how many request
+    manifests are processed at once, and ``max_concurrent_jobs`` bounds how many
+    EOJs are running at any time across all chains, so the per-account EOJ
+    quota is never exceeded.
+    """
+
+    def __init__(self, max_concurrent_chains=4, max_concurrent_jobs=4, progress_interval=300):
+        self.max_concurrent_chains = max_concurrent_chains
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.progress_interval = progress_interval
+        self.progress = {}
+        self._chain_slots = None
+        self._job_slots = None
+
+    def _update_progress(self, chain_id, stage, status):
+        self.progress[chain_id] = {"stage": stage, "status": status, "since": time.monotonic()}
+        logger.info(f"[{chain_id}] stage={stage} status={status}")
+
+    @asynccontextmanager
+    async def job_slot(self, chain_id, stage):
+        """Hold one of the account EOJ slots while ``stage`` of ``chain_id`` runs."""
+        self._update_progress(chain_id, stage, "WAITING_FOR_SLOT")
+        async with self._job_slots:
+            self._update_progress(chain_id, stage, "RUNNING")
+            try:
+                yield
+            except BaseException:
+                self._update_progress(chain_id, stage, "FAILED")
+                raise
+            self._update_progress(chain_id, stage, "COMPLETED")
+
+    def log_progress(self):
+        now = time.monotonic()
+        for chain_id, state in self.progress.items():
+            elapsed = int(now - state["since"])
+            logger.info(
+                f"[{chain_id}] stage={state['stage']} status={state['status']}"
+                f" for {elapsed // 60}m{elapsed % 60:02d}s"
+            )
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(self.progress_interval)
+            self.log_progress()
+
+    async def _run_chain(self, chain_id, chain):
+        async with self._chain_slots:
+            self._update_progress(chain_id, None, "STARTED")
+            try:
+                result = await chain(self, chain_id)
+            except Exception as e:
+                logger.exception(f"[{chain_id}] chain failed")
+                self._update_progress(chain_id, None, "FAILED")
+                return e
+            self._update_progress(chain_id, None, "FINISHED")
+            return result
+
+    async def run(self, chains):
+        """Run every chain and return a ``{chain_id: result}`` mapping.
+
+        ``chains`` maps a chain id to a coroutine function called with
+        ``(scheduler, chain_id)``. A failing chain does not cancel the others;
+        its exception is returned as its result.
+        """
+        self._chain_slots = asyncio.Semaphore(self.max_concurrent_chains)
+        self._job_slots = asyncio.Semaphore(self.max_concurrent_jobs)
+
+        started = time.monotonic()
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            results = await asyncio.gather(
+                *[self._run_chain(chain_id, chain) for chain_id, chain in chains.items()]
+            )
+        finally:
+            reporter.cancel()
+
+        self.log_progress()
+        logger.info(
+            f"{len(chains)} EOJ chains finished in {int(time.monotonic() - started)}s"
+            f" (max {self.max_concurrent_chains} chains, {self.max_concurrent_jobs} jobs)"
+        )
+        return dict(zip(chains, results))
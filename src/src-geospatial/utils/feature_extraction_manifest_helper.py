@@ -0,0 +1,86 @@
+import glob
+import hashlib
+import logging
+import os
+
+import boto3
+import botocore
+
+from utils.eoj_pipeline_helper import read_json_document, write_json_document
+
+logger = logging.getLogger()
+
+s3_client = boto3.client("s3")
+
+
+def read_etag(uri):
+    """ETag of an S3 object (size and mtime of a local file), None if missing."""
+    if uri.startswith("s3://"):
+        bucket, key = uri[len("s3://") :].split("/", 1)
+        try:
+            return s3_client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+
+    if not os.path.exists(uri):
+        return None
+    stat = os.stat(uri)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def polygons_digest(shapefile_path):
+    """Hash of a shapefile and its sidecar files (.dbf, .shx, .prj, ...)."""
+    digest = hashlib.sha256()
+    for polygons_file in sorted(glob.glob(f"{os.path.splitext(shapefile_path)[0]}.*")):
+        digest.update(os.path.basename(polygons_file).encode("UTF-8"))
+        with open(polygons_file, "rb") as content:
+            digest.update(content.read())
+    return digest.hexdigest()
+
+
+def read_tile_etags(tile_paths):
+    """ETags of the tiles of a task, read once and shared by the manifests of its crops."""
+    return {tile_path: read_etag(tile_path) for tile_path in sorted(tile_paths)}
+
+
+def task_inputs_manifest(tile_etags, crop_mask_path, polygons_path, band_names, options=None):
+    """Everything a (FIPS, week) output depends on.
+
+    Tiles (``read_tile_etags``) and crop mask are identified by their ETags,
+    the cell polygons by their content, so a re-exported mosaic or new
+    polygons change the manifest.
+    """
+    return {
+        "tiles": dict(sorted(tile_etags.items())),
+        "crop_mask": {crop_mask_path: read_etag(crop_mask_path)},
+        "polygons": polygons_digest(polygons_path),
+        "band_names": list(band_names),
+        "options": options or {},
+    }
+
+
+class FeatureExtractionManifests:
+    """Inputs manifests of the outputs written by the previous runs.
+
+    The manifest of a (crop, year, week, FIPS) output is stored as
+    ``{uri}/{crop}/{year}/isoweek-{week}/{fips}.json`` (local directory or S3
+    prefix) once the output is written. A task whose manifest did not change,
+    and whose output still exists, does not need to run again.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri.rstrip("/")
+
+    def _manifest_uri(self, type_of_crop, year, isoweek, fips):
+        return f"{self.uri}/{type_of_crop}/{year}/isoweek-{isoweek}/{fips}.json"
+
+    def is_up_to_date(self, type_of_crop, year, isoweek, fips, manifest, output_uri):
+        stored = read_json_document(self._manifest_uri(type_of_crop, year, isoweek, fips))
+        if stored is None or stored != manifest:
+            return False
+        return read_etag(output_uri) is not None
+
+    def put(self, type_of_crop, year, isoweek, fips, manifest):
+        write_json_document(self._manifest_uri(type_of_crop, year, isoweek, fips), manifest)
@@ -0,0 +1,259 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger()
+
+
+def group_tasks_by_week(tasks):
+    """``{(starttime, endtime): [task, ...]}`` with the weeks in chronological order."""
+    weeks = {}
+    for task in sorted(tasks, key=lambda task: (task["starttime"], task["endtime"])):
+        weeks.setdefault((task["starttime"], task["endtime"]), []).append(task)
+    return weeks
+
+
+def error_result(task, error):
+    """Result of a failed task, same keys as the ``handler`` results plus the error."""
+    return {
+        "result": "error",
+        "fips": f"{task['fips']}",
+        "isoweek": f"{task['week']}",
+        "year": f"{task['year']}",
+        "error": f"{type(error).__name__}: {error}",
+        "traceback": traceback.format_exc(),
+    }
+
+
+def _run_task(run, task):
+    try:
+        return run(task)
+    except Exception as e:
+        return error_result(task, e)
+
+
+class FeatureExtractionPool:
+    """Run the (FIPS, week) feature extraction tasks on a pool of processes.
+
+    Tasks are grouped by week: ``prepare_week(tasks)`` runs in the parent
+    process once per week (e.g. to build the stacked mosaic of the week) before
+    the counties of that week are fanned out to the workers. A week is only
+    prepared once the tasks of the week before the previous one are done. ``initializer``
+    sets up the per-process state (county geometries, caches) the ``run(task)``
+    function relies on. With ``max_workers=1`` tasks run in this process.
+
+    A failing task does not stop the others, its error is returned as its
+    result: ``{"result": "error", "error": ..., "traceback": ...}``. When a
+    worker process dies, the tasks interrupted with it run again each in a
+    single process pool, so only the one killing its worker again fails, and
+    the remaining weeks go on in a new pool.
+
+    ``on_result(result)`` is called in this process with each result as soon
+    as its task is done (e.g. to upload what the task wrote).
+    """
+
+    def __init__(
+        self,
+        run,
+        max_workers=None,
+        initializer=None,
+        initargs=(),
+        prepare_week=None,
+        on_result=None,
+    ):
+        self.run = run
+        self.max_workers = max_workers or os.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.prepare_week = prepare_week
+        self.on_result = on_result
+
+    def _collect(self, results, result):
+        results.append(result)
+        if self.on_result is not None:
+            self.on_result(result)
+
+    def _prepare_week(self, week, week_tasks):
+        if self.prepare_week is None:
+            return week_tasks
+        try:
+            self.prepare_week(week_tasks)
+        except Exception as e:
+            logger.exception(f"Failed to prepare the week {week}")
+            return [error_result(task, e) for task in week_tasks]
+        return week_tasks
+
+    def _run_in_process(self, weeks):
+        if self.initializer is not None:
+            self.initializer(*self.initargs)
+        results = []
+        for week, week_tasks in weeks.items():
+            for task in self._prepare_week(week, week_tasks):
+                self._collect(
+                    results,
+                    task if task.get("result") == "error" else _run_task(self.run, task),
+                )
+        return results
+
+    def _executor(self, max_workers):
+        # Workers are spawned, GDAL and boto3 handles of the parent are not fork safe
+        return ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=self.initializer,
+            initargs=self.initargs,
+        )
+
+    def _run_weeks_in_pool(self, weeks):
+        """Run ``weeks`` on a new pool, until they are done or a worker process dies.
+
+        Returns the results, the tasks interrupted by the death of a worker
+        (every task still running or queued in the broken pool) and the weeks
+        not submitted yet.
+        """
+        results, interrupted, remaining_weeks = [], [], []
+        tasks_by_future = {}
+
+        def collect_done(block):
+            """Collect the results of the tasks done, waiting for one at least if ``block``."""
+            done, _ = wait(
+                tasks_by_future, timeout=None if block else 0, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                task = tasks_by_future.pop(future)
+                try:
+                    self._collect(results, future.result())
+                except BrokenProcessPool:
+                    interrupted.append(task)
+                    continue
+                except Exception as e:
+                    self._collect(results, error_result(task, e))
+                if len(results) % 50 == 0:
+                    logger.info(f"{len(results)} tasks finished")
+
+        with self._executor(self.max_workers) as executor:
+            weeks_futures = []
+            for week_idx, (week, week_tasks) in enumerate(weeks):
+                # Prepare at most one week ahead, so what is prepared for a week (e.g.
+                # cached files) is not evicted by the following weeks before it runs.
+                # Results are collected while waiting, as soon as their task is done
+                collect_done(block=False)
+                while len(weeks_futures) >= 2 and any(
+                    future in tasks_by_future for future in weeks_futures[-2]
+                ):
+                    collect_done(block=True)
+                week_futures = []
+                week_tasks = self._prepare_week(week, week_tasks)
+                for task_idx, task in enumerate(week_tasks):
+                    if task.get("result") == "error":
+                        self._collect(results, task)
+                        continue
+                    try:
+                        future = executor.submit(_run_task, self.run, task)
+                    except BrokenProcessPool:
+                        interrupted.append(task)
+                        remaining_weeks = [
+                            (week, week_tasks[task_idx + 1 :]),
+                            *weeks[week_idx + 1 :],
+                        ]
+                        break
+                    tasks_by_future[future] = task
+                    week_futures.append(future)
+                weeks_futures.append(week_futures)
+                # The pool broke while submitting, the weeks left go to a new pool
+                if remaining_weeks:
+                    break
+
+            while tasks_by_future:
+                collect_done(block=True)
+        return results, interrupted, [week for week in remaining_weeks if week[1]]
+
+    def _run_isolated(self, tasks):
+        """Run the tasks on ``max_workers`` single process pools, a task killing its worker
+        fails alone."""
+        queue, results = list(tasks), []
+        queue_lock = threading.Lock()
+
+        def drain():
+            executor = None
+            try:
+                while True:
+                    with queue_lock:
+                        if not queue:
+                            return
+                        task = queue.pop()
+                    if executor is None:
+                        executor = self._executor(1)
+                    try:
+                        self._collect(results, executor.submit(_run_task, self.run, task).result())
+                    except BrokenProcessPool as e:
+                        logger.error(
+                            f"Worker process died running FIPS {task['fips']} week {task['week']}"
+                        )
+                        self._collect(results, error_result(task, e))
+                        executor.shutdown()
+                        executor = None
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+
+        drainers = min(self.max_workers, len(queue))
+        with ThreadPoolExecutor(max_workers=drainers) as threads:
+            for drainer in [threads.submit(drain) for _ in range(drainers)]:
+                drainer.result()
+        return results
+
+    def _run_in_pool(self, weeks):
+        results, pending_weeks = [], list(weeks.items())
+        while pending_weeks:
+            pool_results, interrupted, pending_weeks = self._run_weeks_in_pool(pending_weeks)
+            results.extend(pool_results)
+            if interrupted:
+                # A crash (OOM, segfault in GDAL) takes down every task of the pool, the
+                # interrupted ones run again in their own process to isolate the one responsible
+                logger.warning(
+                    f"A worker process died, running the {len(interrupted)} interrupted tasks"
+                    " in isolated processes"
+                )
+                results.extend(self._run_isolated(interrupted))
+            if pending_weeks:
+                logger.info(
+                    f"Restarting the worker pool for the {len(pending_weeks)} remaining weeks"
+                )
+        return results
+
+    def run_all(self, tasks):
+        """Run every task and return their results, failed tasks included."""
+        weeks = group_tasks_by_week(tasks)
+        logger.info(
+            f"Running {len(tasks)} tasks over {len(weeks)} weeks"
+            f" with {self.max_workers} worker processes"
+        )
+
+        started = time.monotonic()
+        if self.max_workers == 1:
+            results = self._run_in_process(weeks)
+        else:
+            results = self._run_in_pool(weeks)
+
+        failed = [result for result in results if result.get("result") == "error"]
+        skipped = [result for result in results if result.get("result") == "skipped"]
+        for result in failed:
+            logger.error(
+                f"=== Error processing FIPS: {result['fips']}  Week: {result['isoweek']} ==="
+                f" {result['error']}"
+            )
+        logger.info(
+            f"{len(results) - len(failed) - len(skipped)} tasks succeeded,"
+            f" {len(skipped)} skipped, {len(failed)} failed"
+            f" in {int(time.monotonic() - started)}s"
+        )
+        peaks = [result["peak_memory_mb"] for result in results if "peak_memory_mb" in result]
+        if peaks:
+            logger.info(f"Peak memory of the tasks: {max(peaks)} MB")
+        return results
@@ -1,3 +1,9 @@
+import glob
+import re
+import string
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
 import boto3
 import pandas as pd
 
@@ -20,8 +26,110 @@ def list_files_under_s3_key_prefix(bucket, s3_key_prefix, endswith=None):
         ]
 
 
-def list_satellite_images_in_s3(bucket, key_prefix):
-    return list_files_under_s3_key_prefix(bucket, key_prefix)
+# Split points of a flat prefix listing, keys are listed in UTF-8 binary order
+KEY_RANGE_BOUNDARIES = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+
+def list_files_under_s3_key_prefix_concurrently(
+    bucket_name, s3_key_prefix, endswith=None, max_workers=16
+):
+    """List the files under a prefix, listing its sub-prefixes and key ranges in parallel.
+
+    Every "directory" found with a delimited listing is paginated by its own
+    worker. When a prefix holds more than one page of objects, the keys after
+    the first page are split into ranges at ``prefix + c`` for each character
+    of ``KEY_RANGE_BOUNDARIES``, each range listed by its own worker, so flat
+    EOJ exports are not listed one page at a time either.
+    """
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    def keep(key):
+        return endswith is None or key.endswith(endswith)
+
+    def list_first_page(prefix):
+        page = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=prefix, Delimiter="/")
+        keys = [obj["Key"] for obj in page.get("Contents", [])]
+        sub_prefixes = [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+        ranges = []
+        if page.get("IsTruncated"):
+            # Keys after the last one listed, in (start_after, end] ranges
+            last = max(keys[-1:] + sub_prefixes[-1:])
+            boundaries = [
+                f"{prefix}{char}" for char in KEY_RANGE_BOUNDARIES if f"{prefix}{char}" > last
+            ]
+            ranges = [
+                (prefix, start_after, end)
+                for start_after, end in zip([last] + boundaries, boundaries + [None])
+            ]
+        return [key for key in keys if keep(key)], sub_prefixes, ranges
+
+    def list_key_range(prefix, start_after, end):
+        keys, sub_prefixes = [], []
+        for page in paginator.paginate(
+            Bucket=bucket_name, Prefix=prefix, Delimiter="/", StartAfter=start_after
+        ):
+            page_keys = [obj["Key"] for obj in page.get("Contents", [])]
+            page_prefixes = [p["Prefix"] for p in page.get("CommonPrefixes", [])]
+            keys.extend(key for key in page_keys if end is None or key <= end)
+            sub_prefixes.extend(p for p in page_prefixes if end is None or p <= end)
+            if end is not None and max(page_keys[-1:] + page_prefixes[-1:], default="") > end:
+                break
+        return [key for key in keys if keep(key)], sub_prefixes, []
+
+    keys, listed_prefixes = [], {s3_key_prefix}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = [executor.submit(list_first_page, s3_key_prefix)]
+        while pending:
+            future = pending.pop()
+            prefix_keys, sub_prefixes, ranges = future.result()
+            keys.extend(prefix_keys)
+            pending.extend(executor.submit(list_key_range, *key_range) for key_range in ranges)
+            # A directory spanning the first page and a range is reported twice
+            for sub_prefix in sub_prefixes:
+                if sub_prefix not in listed_prefixes:
+                    listed_prefixes.add(sub_prefix)
+                    pending.append(executor.submit(list_first_page, sub_prefix))
+    return sorted(f"s3://{bucket_name}/{key}" for key in set(keys))
+
+
+def list_satellite_images_in_s3(bucket_name, key_prefix, endswith=".tif"):
+    return list_files_under_s3_key_prefix_concurrently(bucket_name, key_prefix, endswith)
+
+
+def get_satellite_image_acquisition_date(s3_sallite_image_path):
+    """Acquisition date encoded in the file name (``..._YYYYMMDD_...``), None if absent."""
+    satellite_image_file_name = s3_sallite_image_path.split("/")[-1]
+    for candidate in re.findall(r"(?<!\d)(\d{8})(?!\d)", satellite_image_file_name):
+        try:
+            return datetime.strptime(candidate, "%Y%m%d").date()
+        except ValueError:
+            continue
+    return None
+
+
+def split_satellite_images_by_window(satellite_images_s3_keys, windows):
+    """Assign season wide EOJ results to the time windows their acquisition date falls in.
+
+    ``windows`` are dicts holding the ``startime`` and ``endtime`` of a window
+    (ISO 8601), the images of each window are returned in the same order.
+    """
+    dated_images = [
+        (get_satellite_image_acquisition_date(image), image) for image in satellite_images_s3_keys
+    ]
+    undated = [image for date, image in dated_images if date is None]
+    if undated:
+        raise ValueError(f"No acquisition date found in the name of {undated[:5]}")
+
+    return [
+        [
+            image
+            for date, image in dated_images
+            if datetime.fromisoformat(window["startime"].replace("Z", "")).date()
+            <= date
+            <= datetime.fromisoformat(window["endtime"].replace("Z", "")).date()
+        ]
+        for window in windows
+    ]
 
 
 def get_satellite_images_record_with_metadata(
@@ -55,3 +163,90 @@ def create_fips_isoweek_year_satellite_tiles_mapping(
     )
 
     return satellite_images_with_metadata
+
+
+def write_satellite_tiles_catalog(mapping_df, catalog_uri):
+    """Append satellite tiles records to the catalog, partitioned by year and week.
+
+    Every call writes new uniquely named Parquet files, so concurrent writers
+    never overwrite each other.
+    """
+    mapping_df = mapping_df.astype({"FIPS": str, "week": int, "year": int})
+    mapping_df.to_parquet(catalog_uri, partition_cols=["year", "week"], index=False)
+
+
+def read_satellite_tiles_catalog(catalog_uri, fips=None, week=None, year=None, band_names=None):
+    """Read the satellite tiles records matching the (FIPS, week, year, band) filters.
+
+    Filters are pushed down to Parquet, partitions and row groups that can not
+    match are not read.
+    """
+    filters = []
+    if fips is not None:
+        filters.append(("FIPS", "in", [str(f) for f in fips]))
+    if week is not None:
+        filters.append(("week", "=", int(week)))
+    if year is not None:
+        filters.append(("year", "=", int(year)))
+    if band_names is not None:
+        filters.append(("band_name", "in", list(band_names)))
+
+    catalog_df = pd.read_parquet(catalog_uri, filters=filters or None)
+    return catalog_df.astype({"FIPS": str, "week": int, "year": int})
+
+
+def read_satellite_tiles_mapping_files(mapping_files_glob):
+    """Read the per FIPS mapping CSVs written by older geospatial processing jobs."""
+    mapping_files = sorted(glob.glob(mapping_files_glob))
+    if not mapping_files:
+        raise FileNotFoundError(f"No satellite tiles mapping file matches {mapping_files_glob}")
+    return pd.concat(
+        [pd.read_csv(mapping_file, dtype={"FIPS": str}) for mapping_file in mapping_files],
+        ignore_index=True,
+    )
+
+
+class SatelliteTilesIndex:
+    """Band mosaics of every (FIPS, starttime, endtime), in band order.
+
+    Built once from the satellite tiles records, so looking up the tiles of a
+    task is a dictionary access instead of filtering the whole catalog. Only
+    the ``band_names`` bands are kept, one mosaic per band (the last record
+    wins), ordered like ``band_names``.
+    """
+
+    def __init__(self, mapping_df, band_names):
+        self.band_names = list(band_names)
+        band_order = {band_name: idx for idx, band_name in enumerate(self.band_names)}
+
+        tiles = {}
+        for record in mapping_df[mapping_df["band_name"].isin(band_order)].to_dict(
+            orient="records"
+        ):
+            key = (str(record["FIPS"]), record["starttime"], record["endtime"])
+            tiles.setdefault(key, {})[record["band_name"]] = record
+
+        self._tiles = {
+            key: sorted(bands.values(), key=lambda record: band_order[record["band_name"]])
+            for key, bands in tiles.items()
+        }
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, fips, starttime, endtime):
+        """Records of the band mosaics of a task, ``[]`` if there are none."""
+        return self._tiles.get((str(fips), starttime, endtime), [])
+
+    def tasks(self):
+        """One ``{starttime, endtime, FIPS, year, week}`` record per indexed task."""
+        return [
+            {
+                "starttime": starttime,
+                "endtime": endtime,
+                "FIPS": fips,
+                "year": records[0]["year"],
+                "week": records[0]["week"],
+            }
+            for (fips, starttime, endtime), records in self._tiles.items()
+        ]
@@ -0,0 +1,205 @@
+import logging
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from utils.satellite_image_preparation_helper import (
+    convert_to_cloud_optimized_geotiff,
+    write_cloud_optimized_geotiff,
+    write_rasterio_image_from_numy_array,
+)
+
+logger = logging.getLogger()
+
+s3_client = boto3.client("s3")
+
+MB = 1024**2
+
+
+class BackgroundUploader:
+    """Upload local files to an S3 bucket on a pool of background threads.
+
+    ``submit`` returns right away, so the next rasters are computed while the
+    previous ones are being uploaded. Large files are sent as concurrent
+    multipart uploads. Local files are removed once uploaded.
+    """
+
+    def __init__(self, bucket_name, max_workers=4, multipart_chunksize=16 * MB):
+        self.bucket_name = bucket_name
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_chunksize,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=4,
+        )
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _upload(self, local_path, keys, remove):
+        try:
+            for key in keys:
+                s3_client.upload_file(
+                    local_path, self.bucket_name, key, Config=self.transfer_config
+                )
+                logger.info(f"Uploaded s3://{self.bucket_name}/{key}")
+        finally:
+            if remove and os.path.exists(local_path):
+                os.remove(local_path)
+        return keys
+
+    def submit(self, local_path, key, remove=True):
+        """Upload ``local_path`` to ``key`` (or a list of keys) in the background.
+
+        Returns the future of the upload.
+        """
+        keys = [key] if isinstance(key, str) else list(key)
+        return self._executor.submit(self._upload, local_path, keys, remove)
+
+    @staticmethod
+    def wait(futures):
+        """Wait for the uploads of ``futures``, raises the error of the first failed one."""
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class DeferredUploader:
+    """Stand-in for ``BackgroundUploader`` in the worker processes of a pool.
+
+    ``submit`` only records the file and its keys. The task returns them
+    (``take``) with its result, and the parent process uploads them with
+    ``TaskUploads`` while the worker goes on with its next task.
+    """
+
+    def __init__(self):
+        self.uploads = []
+
+    def submit(self, local_path, key, remove=True):
+        keys = [key] if isinstance(key, str) else list(key)
+        self.uploads.append((local_path, keys, remove))
+
+    def take(self):
+        """The uploads recorded since the last call."""
+        uploads, self.uploads = self.uploads, []
+        return uploads
+
+    def discard(self):
+        """Drop the uploads recorded since the last ``take``, e.g. of a failed task.
+
+        Their local files are removed (unless submitted with ``remove=False``),
+        they are not credited to the next task of the worker.
+        """
+        for local_path, _, remove in self.take():
+            if remove and os.path.exists(local_path):
+                os.remove(local_path)
+
+    @staticmethod
+    def wait(futures):
+        pass
+
+
+class TaskUploads:
+    """Upload the files the pool tasks return (``uploads``) while the workers compute.
+
+    ``submit(result)`` starts the uploads of a task result as soon as it comes
+    in. A task whose upload failed becomes an error result, ``on_uploaded(result)``
+    is called for the others (e.g. to record their manifests). Tasks are
+    settled as their uploads end, checked on each ``submit``, and ``finish``
+    waits once for the remaining ones at the end of the pool run.
+    """
+
+    def __init__(self, uploader, on_uploaded=None):
+        self.uploader = uploader
+        self.on_uploaded = on_uploaded
+        self.submitted = []
+
+    def submit(self, result):
+        uploads = result.pop("uploads", None)
+        if uploads is None:
+            return
+        futures = [
+            self.uploader.submit(local_path, keys, remove=remove)
+            for local_path, keys, remove in uploads
+        ]
+        self.submitted.append((result, futures))
+        self._settle(block=False)
+
+    def _settle(self, block):
+        pending = []
+        for result, futures in self.submitted:
+            if not block and not all(future.done() for future in futures):
+                pending.append((result, futures))
+                continue
+            try:
+                self.uploader.wait(futures)
+            except Exception as e:
+                logger.error(
+                    f"Failed to upload the rasters of FIPS {result['fips']}"
+                    f" week {result['isoweek']}: {e}"
+                )
+                result.update(
+                    result="error",
+                    error=f"{type(e).__name__}: {e}",
+                    traceback=traceback.format_exc(),
+                )
+                continue
+            if self.on_uploaded is not None:
+                self.on_uploaded(result)
+        self.submitted = pending
+
+    def finish(self):
+        """Wait for the uploads still running."""
+        self._settle(block=True)
+
+
+class RasterOutputWriter:
+    """Write the output rasters of a task locally and upload them in the background.
+
+    Rasters are written as Cloud Optimized GeoTIFFs (``raster_format="cog"``)
+    or as plain GeoTIFFs (``"gtiff"``) under ``temp_dirpath``. The futures of
+    the uploads are kept until ``wait`` is called, at the end of the task;
+    with a ``DeferredUploader`` the uploads are left to the parent process.
+    """
+
+    def __init__(self, uploader, temp_dirpath, raster_format="cog"):
+        self.uploader = uploader
+        self.temp_dirpath = temp_dirpath
+        self.raster_format = raster_format
+        self.pending = []
+
+    def _local_path(self, key):
+        key = key if isinstance(key, str) else key[0]
+        return os.path.join(self.temp_dirpath, f"upload_{os.getpid()}_{key.replace('/', '_')}")
+
+    def write_array(self, numpy_array, ras_metadata, key):
+        """Write ``numpy_array`` once and upload it to ``key`` (or keys) in the background."""
+        local_path = self._local_path(key)
+        if self.raster_format == "cog":
+            write_cloud_optimized_geotiff(local_path, numpy_array, ras_metadata)
+        else:
+            write_rasterio_image_from_numy_array(
+                local_path, numpy_array, {**ras_metadata, "driver": "GTiff"}
+            )
+        self.pending.append(self.uploader.submit(local_path, key))
+
+    def write_file(self, raster_path, key):
+        """Upload the GeoTIFF ``raster_path`` to ``key`` in the background.
+
+        ``raster_path`` is moved (converted to a COG) to a file owned by the upload.
+        """
+        local_path = self._local_path(key)
+        if self.raster_format == "cog":
+            convert_to_cloud_optimized_geotiff(raster_path, local_path)
+            os.remove(raster_path)
+        else:
+            os.replace(raster_path, local_path)
+        self.pending.append(self.uploader.submit(local_path, key))
+
+    def wait(self):
+        """Wait for the uploads submitted so far, raises if one of them failed."""
+        pending, self.pending = self.pending, []
+        self.uploader.wait(pending)
@@ -0,0 +1,249 @@
+import ctypes
+import ctypes.util
+import fcntl
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+logger = logging.getLogger()
+
+MB = 1024**2
+
+# GDAL settings of the /vsis3/ reads: no directory listing on open, large merged
+# range requests over HTTP/2, a shared in-memory cache of the fetched blocks and
+# counted network requests
+REMOTE_RASTER_GDAL_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff,.vrt",
+    "GDAL_HTTP_VERSION": "2",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIRANGE": "YES",
+    "GDAL_HTTP_MAX_RETRY": "5",
+    "GDAL_HTTP_RETRY_DELAY": "1",
+    "VSI_CACHE": "TRUE",
+    "VSI_CACHE_SIZE": str(64 * MB),
+    "CPL_VSIL_CURL_CACHE_SIZE": str(256 * MB),
+    "GDAL_CACHEMAX": "512",
+    "CPL_VSIL_NETWORK_STATS_ENABLED": "YES",
+}
+
+
+def configure_remote_raster_access(**overrides):
+    """Set the GDAL options of the remote reads for this process and its workers.
+
+    Options already set in the environment are kept.
+    """
+    for option, value in {**REMOTE_RASTER_GDAL_OPTIONS, **overrides}.items():
+        os.environ.setdefault(option, str(value))
+
+
+@functools.lru_cache(maxsize=None)
+def _gdal_library():
+    """The GDAL library rasterio is linked with, None if it can not be found."""
+    import rasterio  # noqa: F401 (loads the GDAL library of rasterio in the process)
+
+    try:
+        with open("/proc/self/maps") as maps_file:
+            loaded = {line.split()[-1] for line in maps_file if "libgdal" in line}
+    except OSError:
+        loaded = set()
+    library_path = next(iter(loaded), None) or ctypes.util.find_library("gdal")
+    if library_path is None:
+        logger.warning("GDAL library not found, the /vsis3/ network statistics are not counted")
+        return None
+
+    library = ctypes.CDLL(library_path)
+    library.VSINetworkStatsGetAsSerializedJSON.argtypes = [ctypes.c_void_p]
+    library.VSINetworkStatsGetAsSerializedJSON.restype = ctypes.c_void_p
+    library.VSIFree.argtypes = [ctypes.c_void_p]
+    return library
+
+
+def reset_network_stats():
+    """Reset the GDAL network statistics of this process."""
+    library = _gdal_library()
+    if library is not None:
+        library.VSINetworkStatsReset()
+
+
+def read_network_stats(handler="vsis3"):
+    """Requests sent and bytes fetched by the GDAL ``handler`` since the last reset.
+
+    Counted by GDAL (``CPL_VSIL_NETWORK_STATS_ENABLED``) for the whole
+    process, so the range reads of the rasters opened through /vsis3/ are
+    counted, with or without the ``RemoteRasterCache``.
+    """
+    network_io = {"requests": 0, "bytes_fetched": 0}
+    library = _gdal_library()
+    if library is None:
+        return network_io
+
+    serialized = library.VSINetworkStatsGetAsSerializedJSON(None)
+    try:
+        stats = json.loads(ctypes.string_at(serialized))
+    finally:
+        library.VSIFree(serialized)
+    for method in stats.get("handlers", {}).get(handler, {}).get("methods", {}).values():
+        network_io["requests"] += method.get("count", 0)
+        network_io["bytes_fetched"] += method.get("downloaded_bytes", 0)
+    return network_io
+
+
+class RemoteRasterCache:
+    """Bounded on-disk cache of whole S3 rasters, shared by the worker processes.
+
+    Not a block cache: a file is downloaded entirely on its first use, then
+    read locally. It pays off when many counties read the same band mosaics
+    (a week of a small request); for large mosaics of which each county only
+    needs a window, the /vsis3/ range reads fetch much less. ``prefetch``
+    downloads the files a task needs concurrently, once, under ``cache_dir``.
+    Downloads are serialized per file with a lock file, so two workers never
+    fetch the same file.
+
+    The cache never holds more than ``max_bytes``: room for a new file is
+    made by removing the least recently used files, except the ones used in
+    the last ``min_age`` seconds (they may still be read through a VRT). A
+    file that does not fit is not cached, ``get`` returns its S3 URI and it
+    is read through /vsis3/.
+
+    ``counters`` holds the I/O of this process: bytes fetched from S3, S3
+    requests sent (HEAD and ranged GETs, retries included), hits, misses and
+    files ``bypassed`` because they did not fit.
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 1024 * MB, max_workers=16, min_age=600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self.min_age = min_age
+        self.transfer_config = TransferConfig(
+            multipart_threshold=16 * MB, multipart_chunksize=16 * MB, max_concurrency=4
+        )
+        self.counters = {"bytes_fetched": 0, "requests": 0, "hits": 0, "misses": 0, "bypassed": 0}
+        self._counters_lock = threading.Lock()
+        # A client of its own, so only the requests of the cache are counted
+        self.s3_client = boto3.client("s3")
+        self.s3_client.meta.events.register("before-send.s3", self._count_request)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _local_path(self, s3_uri):
+        return os.path.join(self.cache_dir, s3_uri[len("s3://") :].replace("/", "__"))
+
+    def _count(self, **increments):
+        with self._counters_lock:
+            for counter, increment in increments.items():
+                self.counters[counter] += increment
+
+    def _count_request(self, **kwargs):
+        self._count(requests=1)
+
+    def get(self, s3_uri):
+        """Local copy of ``s3_uri``, downloaded on a miss. Other paths are returned as is.
+
+        Returns ``s3_uri`` itself when the file does not fit in the cache.
+        """
+        if not s3_uri.startswith("s3://"):
+            return s3_uri
+
+        local_path = self._local_path(s3_uri)
+        if os.path.exists(local_path):
+            os.utime(local_path)
+            self._count(hits=1)
+            return local_path
+
+        with open(f"{local_path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Downloaded by another worker while waiting for the lock
+                if os.path.exists(local_path):
+                    os.utime(local_path)
+                    self._count(hits=1)
+                    return local_path
+
+                bucket, key = s3_uri[len("s3://") :].split("/", 1)
+                size = self.s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+                tmp_path = f"{local_path}.{os.getpid()}.tmp"
+                if not self._reserve(tmp_path, size):
+                    logger.info(f"{s3_uri} does not fit in the remote raster cache, read from S3")
+                    self._count(misses=1, bypassed=1)
+                    return s3_uri
+                try:
+                    # Written in place, the reserved size stays accounted for during the download
+                    with open(tmp_path, "r+b") as tmp_file:
+                        self.s3_client.download_fileobj(
+                            bucket, key, tmp_file, Config=self.transfer_config
+                        )
+                    os.replace(tmp_path, local_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        self._count(misses=1, bytes_fetched=size)
+        return local_path
+
+    def prefetch(self, s3_uris):
+        """Download the files of ``s3_uris`` concurrently, returns their local paths."""
+        s3_uris = list(s3_uris)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(self.get, s3_uris))
+
+    def _reserve(self, tmp_path, size):
+        """Make room for ``size`` bytes and reserve them with ``tmp_path``, False if they
+        do not fit.
+
+        Downloads in progress (``.tmp`` files) count in the cache size. The
+        check and the reservation hold a lock of the whole cache, so workers
+        cannot overfill it together.
+        """
+        with open(os.path.join(self.cache_dir, ".cache.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                cached, cache_size = [], 0
+                for entry in os.scandir(self.cache_dir):
+                    if entry.name.endswith(".lock"):
+                        continue
+                    stat = entry.stat()
+                    cache_size += stat.st_size
+                    if not entry.name.endswith(".tmp"):
+                        cached.append((stat.st_mtime, stat.st_size, entry.path))
+
+                now = time.time()
+                for mtime, file_size, cached_path in sorted(cached):
+                    if cache_size + size <= self.max_bytes or now - mtime < self.min_age:
+                        break
+                    try:
+                        os.remove(cached_path)
+                    except FileNotFoundError:
+                        continue
+                    cache_size -= file_size
+                if cache_size + size > self.max_bytes:
+                    return False
+
+                with open(tmp_path, "wb") as tmp_file:
+                    tmp_file.truncate(size)
+                return True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @property
+    def hit_rate(self):
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return self.counters["hits"] / lookups if lookups else 0.0
+
+    def log_counters(self, label="Remote rasters"):
+        logger.info(
+            f"{label}: {self.counters['bytes_fetched'] / MB:.1f} MB fetched in"
+            f" {self.counters['requests']} requests, {self.counters['hits']} hits,"
+            f" {self.counters['misses']} misses (hit rate {self.hit_rate:.0%}),"
+            f" {self.counters['bypassed']} read from S3 as they did not fit"
+        )
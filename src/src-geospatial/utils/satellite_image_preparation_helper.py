@@ -1,8 +1,20 @@
+import functools
 import os
+import xml.etree.ElementTree as ET
 from datetime import date, datetime, timedelta
 
 import numpy as np
+import pyproj
 import rasterio
+import rasterio.mask
+import rasterio.shutil
+import rasterio.warp
+from rasterio.crs import CRS
+from rasterio.dtypes import dtype_rev, typename_fwd
+from rasterio.io import MemoryFile
+from rasterio.transform import array_bounds
+from rasterio.warp import Resampling
+from rasterio.windows import Window
 
 
 def get_first_day_in_isoweek(year, week):
@@ -31,12 +43,248 @@ def reproject_tif_with_template_raster(src_file, target_file, template_raster):
         )
 
 
+def to_gdal_path(path):
+    """Read ``s3://`` URIs through GDAL's /vsis3/ virtual file system."""
+    return path.replace("s3://", "/vsis3/", 1) if path.startswith("s3://") else path
+
+
+def build_band_stack_vrt(band_paths, vrt_path, band_names=None):
+    """Stack single band rasters on the same grid into a multi-band VRT.
+
+    Only the headers of the band files are read, the VRT references them so
+    that later reads (e.g. a crop with ``rasterio.mask.mask``) fetch just the
+    windows they need from each band.
+    """
+    if not band_paths:
+        raise ValueError(f"No band to stack into {vrt_path}")
+
+    bands = []
+    for band_path in band_paths:
+        with rasterio.open(to_gdal_path(band_path)) as src:
+            bands.append(
+                {
+                    "path": to_gdal_path(band_path),
+                    "crs": src.crs,
+                    "transform": src.transform,
+                    "width": src.width,
+                    "height": src.height,
+                    "dtype": src.dtypes[0],
+                    "nodata": src.nodata,
+                    "block_shape": src.block_shapes[0],
+                }
+            )
+
+    reference = bands[0]
+    for band in bands[1:]:
+        if (band["crs"], band["transform"], band["width"], band["height"]) != (
+            reference["crs"],
+            reference["transform"],
+            reference["width"],
+            reference["height"],
+        ):
+            raise ValueError(f"{band['path']} is not on the same grid as {reference['path']}")
+
+    vrt = ET.Element(
+        "VRTDataset",
+        rasterXSize=str(reference["width"]),
+        rasterYSize=str(reference["height"]),
+    )
+    ET.SubElement(vrt, "SRS").text = reference["crs"].to_wkt()
+    ET.SubElement(vrt, "GeoTransform").text = ", ".join(
+        repr(value) for value in reference["transform"].to_gdal()
+    )
+
+    for band_idx, band in enumerate(bands):
+        data_type = typename_fwd[dtype_rev[band["dtype"]]]
+        vrt_band = ET.SubElement(
+            vrt, "VRTRasterBand", dataType=data_type, band=str(band_idx + 1)
+        )
+        if band_names is not None:
+            ET.SubElement(vrt_band, "Description").text = band_names[band_idx]
+        if band["nodata"] is not None:
+            ET.SubElement(vrt_band, "NoDataValue").text = repr(band["nodata"])
+
+        source = ET.SubElement(vrt_band, "SimpleSource")
+        ET.SubElement(source, "SourceFilename", relativeToVRT="0").text = band["path"]
+        ET.SubElement(source, "SourceBand").text = "1"
+        ET.SubElement(
+            source,
+            "SourceProperties",
+            RasterXSize=str(band["width"]),
+            RasterYSize=str(band["height"]),
+            DataType=data_type,
+            BlockXSize=str(band["block_shape"][1]),
+            BlockYSize=str(band["block_shape"][0]),
+        )
+        rect = {
+            "xOff": "0",
+            "yOff": "0",
+            "xSize": str(band["width"]),
+            "ySize": str(band["height"]),
+        }
+        ET.SubElement(source, "SrcRect", **rect)
+        ET.SubElement(source, "DstRect", **rect)
+
+    ET.ElementTree(vrt).write(vrt_path)
+    return vrt_path
+
+
+# Pixels reprojected at once by reproject_array_like, bounds its temporary coordinates
+NEAREST_BLOCK_PIXELS = 1024**2
+
+
+@functools.lru_cache(maxsize=16)
+def _transformer(dst_crs_wkt, src_crs_wkt):
+    return pyproj.Transformer.from_crs(dst_crs_wkt, src_crs_wkt, always_xy=True)
+
+
+def nearest_source_pixels(src_crs, src_transform, dst_crs, dst_transform, window):
+    """Row and column of the source pixel under the center of each pixel of ``window``.
+
+    The destination grid is ``(dst_crs, dst_transform)``. Every pixel center
+    is transformed exactly, so a pixel gets the same source pixel however the
+    grid is split in windows. GDAL's warper interpolates the transformation
+    over each chunk it warps, and picks other pixels when the chunks change.
+    Pixel centers out of the source CRS domain get ``-1``.
+    """
+    rows, cols = np.mgrid[
+        window.row_off : window.row_off + window.height,
+        window.col_off : window.col_off + window.width,
+    ]
+    xs, ys = dst_transform * (cols + 0.5, rows + 0.5)
+    xs, ys = _transformer(
+        CRS.from_user_input(dst_crs).to_wkt(),
+        CRS.from_user_input(src_crs).to_wkt(),
+    ).transform(xs, ys)
+    src_cols, src_rows = ~src_transform * (xs, ys)
+    finite = np.isfinite(src_cols) & np.isfinite(src_rows)
+    src_rows = np.where(finite, np.floor(src_rows), -1).astype(np.int64)
+    src_cols = np.where(finite, np.floor(src_cols), -1).astype(np.int64)
+    return src_rows, src_cols
+
+
+def sample_nearest(source, src_rows, src_cols, fill):
+    """``(band, y, x)`` pixels of ``source`` at ``src_rows``, ``src_cols``, ``fill`` outside."""
+    inside = (
+        (src_rows >= 0)
+        & (src_rows < source.shape[1])
+        & (src_cols >= 0)
+        & (src_cols < source.shape[2])
+    )
+    destination = np.full((source.shape[0],) + src_rows.shape, fill, dtype=source.dtype)
+    destination[:, inside] = source[:, src_rows[inside], src_cols[inside]]
+    return destination
+
+
+def reproject_array_like(source, source_meta, template_meta, resampling=Resampling.nearest):
+    """In memory ``rio warp --like``: reproject ``source`` onto the template's grid.
+
+    ``source_meta`` and ``template_meta`` are rasterio profiles (crs,
+    transform, width, height, nodata). Returns the array and its profile.
+    Nearest neighbour pixels are picked with ``nearest_source_pixels``, so
+    the block by block processing gives the same pixels; other resamplings
+    go through GDAL.
+    """
+    nodata = source_meta.get("nodata")
+    fill = nodata if nodata is not None else 0
+    height, width = template_meta["height"], template_meta["width"]
+    if resampling == Resampling.nearest:
+        destination = np.empty((source.shape[0], height, width), dtype=source.dtype)
+        block_rows = max(1, NEAREST_BLOCK_PIXELS // max(1, width))
+        for row_off in range(0, height, block_rows):
+            window = Window(0, row_off, width, min(block_rows, height - row_off))
+            src_rows, src_cols = nearest_source_pixels(
+                source_meta["crs"],
+                source_meta["transform"],
+                template_meta["crs"],
+                template_meta["transform"],
+                window,
+            )
+            destination[:, row_off : row_off + window.height] = sample_nearest(
+                source, src_rows, src_cols, fill
+            )
+    else:
+        destination = np.full((source.shape[0], height, width), fill, dtype=source.dtype)
+        rasterio.warp.reproject(
+            source,
+            destination,
+            src_transform=source_meta["transform"],
+            src_crs=source_meta["crs"],
+            src_nodata=nodata,
+            dst_transform=template_meta["transform"],
+            dst_crs=template_meta["crs"],
+            dst_nodata=nodata,
+            resampling=resampling,
+        )
+
+    destination_meta = source_meta.copy()
+    destination_meta.update(
+        crs=template_meta["crs"],
+        transform=template_meta["transform"],
+        width=template_meta["width"],
+        height=template_meta["height"],
+    )
+    return destination, destination_meta
+
+
+def reproject_array_to_crs(source, source_meta, dst_crs, resampling=Resampling.nearest):
+    """In memory ``rio warp --dst-crs``: reproject ``source`` to ``dst_crs``."""
+    transform, width, height = rasterio.warp.calculate_default_transform(
+        source_meta["crs"],
+        dst_crs,
+        source_meta["width"],
+        source_meta["height"],
+        *array_bounds(source_meta["height"], source_meta["width"], source_meta["transform"]),
+    )
+    return reproject_array_like(
+        source,
+        source_meta,
+        {"crs": dst_crs, "transform": transform, "width": width, "height": height},
+        resampling=resampling,
+    )
+
+
 def write_rasterio_image_from_numy_array(output_filename, numpy_array, ras_metadata):
     # https://gis.stackexchange.com/a/324693
     with rasterio.open(output_filename, "w", **ras_metadata) as dst:
         dst.write(numpy_array)
 
 
+# Tiled, compressed, with overviews: viewers range read the tiles and levels they need
+COG_CREATION_OPTIONS = {
+    "BLOCKSIZE": 512,
+    "COMPRESS": "DEFLATE",
+    "PREDICTOR": "YES",
+    "OVERVIEWS": "AUTO",
+    "OVERVIEW_RESAMPLING": "NEAREST",
+    "BIGTIFF": "IF_SAFER",
+}
+
+
+def convert_to_cloud_optimized_geotiff(src_path, dst_path, **creation_options):
+    """Copy a raster to a Cloud Optimized GeoTIFF (GDAL COG driver)."""
+    rasterio.shutil.copy(
+        src_path, dst_path, driver="COG", **{**COG_CREATION_OPTIONS, **creation_options}
+    )
+    return dst_path
+
+
+def write_cloud_optimized_geotiff(output_filename, numpy_array, ras_metadata, **creation_options):
+    """Write ``numpy_array`` as a Cloud Optimized GeoTIFF."""
+    ras_metadata = {**ras_metadata, "driver": "GTiff"}
+    with MemoryFile() as memfile:
+        with memfile.open(**ras_metadata) as dst:
+            dst.write(numpy_array)
+        with memfile.open() as src:
+            rasterio.shutil.copy(
+                src,
+                output_filename,
+                driver="COG",
+                **{**COG_CREATION_OPTIONS, **creation_options},
+            )
+    return output_filename
+
+
 # source: https://gis.stackexchange.com/questions/371065/apply-same-coordinate-system-to-raster-image-and-geojson-with-rasterio
 def crop_image_with_fips_shape(
     image_path, fips, geo_counties_fips, geojson_projection="EPSG:4326"
@@ -59,3 +307,22 @@ def crop_image_with_fips_shape(
         out_meta = src.meta
 
         return out_image, out_transform, out_meta, raster_meta
+
+
+def crop_image_with_fips_shape_as_profile(image_path, fips, geo_counties_fips):
+    """Crop ``image_path`` with the county's shape, returns the array and its GeoTIFF profile."""
+    out_image, out_transform, _, raster_meta = crop_image_with_fips_shape(
+        image_path, fips, geo_counties_fips, geojson_projection="EPSG:4326"
+    )
+    profile = {
+        key: value
+        for key, value in raster_meta.items()
+        if key not in ("blockxsize", "blockysize", "tiled")
+    }
+    profile.update(
+        driver="GTiff",
+        transform=out_transform,
+        height=out_image.shape[1],
+        width=out_image.shape[2],
+    )
+    return out_image, profile
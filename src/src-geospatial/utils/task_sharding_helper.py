@@ -0,0 +1,111 @@
+import heapq
+import json
+import logging
+import os
+
+import fsspec
+
+logger = logging.getLogger()
+
+RESOURCE_CONFIG_PATH = "/opt/ml/config/resourceconfig.json"
+PROCESSING_JOB_CONFIG_PATH = "/opt/ml/config/processingjobconfig.json"
+
+# Equal area projection of the contiguous US, county areas are proportional to their pixels
+AREA_CRS = "EPSG:5070"
+
+
+def read_host_index_and_count(resource_config_path=RESOURCE_CONFIG_PATH):
+    """``(host_index, host_count)`` of this processing instance, ``(0, 1)`` outside SageMaker."""
+    if not os.path.exists(resource_config_path):
+        return 0, 1
+    with open(resource_config_path) as resource_config_file:
+        resource_config = json.load(resource_config_file)
+    hosts = sorted(resource_config["hosts"])
+    return hosts.index(resource_config["current_host"]), len(hosts)
+
+
+def check_input_fully_replicated(
+    local_path, processing_job_config_path=PROCESSING_JOB_CONFIG_PATH
+):
+    """Raise a ``ValueError`` when this instance did not get every file of the input.
+
+    Sharding the tasks between the hosts needs the whole metadata on each of
+    them: an input at ``local_path`` distributed ``ShardedByS3Key``, or with
+    fewer local files than objects under its S3 prefix, would silently leave
+    counties unprocessed. Nothing is checked outside SageMaker.
+    """
+    if not os.path.exists(processing_job_config_path):
+        return
+    with open(processing_job_config_path) as processing_job_config_file:
+        processing_job_config = json.load(processing_job_config_file)
+
+    for processing_input in processing_job_config.get("ProcessingInputs", []):
+        s3_input = processing_input.get("S3Input")
+        if s3_input is None or s3_input["LocalPath"].rstrip("/") != local_path.rstrip("/"):
+            continue
+
+        if s3_input.get("S3DataDistributionType") == "ShardedByS3Key":
+            raise ValueError(
+                f"The input {processing_input['InputName']} is ShardedByS3Key, sharding the"
+                " tasks needs it FullyReplicated"
+            )
+        fs, prefix = fsspec.core.url_to_fs(s3_input["S3Uri"])
+        expected_files = [key for key in fs.find(prefix) if not key.endswith("/")]
+        local_files = [
+            os.path.join(dirpath, filename)
+            for dirpath, _, filenames in os.walk(local_path)
+            for filename in filenames
+        ]
+        if len(local_files) < len(expected_files):
+            raise ValueError(
+                f"{len(local_files)} of the {len(expected_files)} files of"
+                f" {s3_input['S3Uri']} are under {local_path}, sharding the tasks needs all of"
+                " them"
+            )
+
+
+def county_areas(geo_counties_fips, fips_list):
+    """``{fips: area in km2}`` of the counties, from their polygons."""
+    counties = geo_counties_fips[geo_counties_fips["FIPS"].isin(set(fips_list))]
+    areas = counties.to_crs(AREA_CRS).geometry.area / 1e6
+    return dict(zip(counties["FIPS"], areas))
+
+
+def assign_counties_to_hosts(tasks, county_weights, host_count):
+    """Split the tasks between ``host_count`` hosts, returns one task list per host.
+
+    All the weeks of a county go to the same host, so the county's crop masks
+    and cells label indexes are prepared once. A county weighs its area times
+    its number of weeks; counties are assigned heaviest first to the least
+    loaded host (LPT), which bounds the most loaded host to 4/3 of the optimum.
+    The assignment only depends on the tasks and the weights, every host
+    computes the same one. Counties without a weight get the median weight.
+    """
+    counties = {}
+    for task in tasks:
+        counties.setdefault(str(task["fips"]), []).append(task)
+
+    known_weights = sorted(county_weights[fips] for fips in counties if fips in county_weights)
+    default_weight = known_weights[len(known_weights) // 2] if known_weights else 1.0
+    counties_weights = {
+        fips: county_weights.get(fips, default_weight) * len(county_tasks)
+        for fips, county_tasks in counties.items()
+    }
+
+    hosts_tasks = [[] for _ in range(host_count)]
+    hosts_loads = [(0.0, host_index) for host_index in range(host_count)]
+    for fips in sorted(counties, key=lambda fips: (-counties_weights[fips], fips)):
+        load, host_index = heapq.heappop(hosts_loads)
+        hosts_tasks[host_index].extend(counties[fips])
+        heapq.heappush(hosts_loads, (load + counties_weights[fips], host_index))
+
+    for load, host_index in sorted(hosts_loads, key=lambda item: item[1]):
+        logger.info(
+            f"Host {host_index}: {len(hosts_tasks[host_index])} tasks, load {load:.0f}"
+        )
+    return hosts_tasks
+
+
+def shard_tasks(tasks, county_weights, host_index, host_count):
+    """Tasks of the host ``host_index`` out of ``host_count``."""
+    return assign_counties_to_hosts(tasks, county_weights, host_count)[host_index]
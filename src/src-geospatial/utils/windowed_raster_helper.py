@@ -0,0 +1,297 @@
+import logging
+import math
+import os
+from contextlib import ExitStack
+
+import numpy as np
+import psutil
+import rasterio
+import rasterio.features
+import rasterio.warp
+from rasterio.windows import Window
+
+from utils.satellite_image_preparation_helper import (
+    nearest_source_pixels,
+    sample_nearest,
+    to_gdal_path,
+)
+from utils.zonal_statistics_helper import ZonalStatisticsAccumulator
+
+logger = logging.getLogger()
+
+
+class PeakMemoryTracker:
+    """Peak resident memory of the process, sampled after each processed block."""
+
+    def __init__(self):
+        self._process = psutil.Process()
+        self.start = self._process.memory_info().rss
+        self.peak = self.start
+
+    def sample(self):
+        self.peak = max(self.peak, self._process.memory_info().rss)
+
+    @property
+    def peak_mb(self):
+        return self.peak / 1024**2
+
+    @property
+    def increase_mb(self):
+        return (self.peak - self.start) / 1024**2
+
+
+def row_windows(height, width, bytes_per_pixel, max_block_bytes):
+    """Full width windows of as many rows as ``max_block_bytes`` allows (one row at least)."""
+    block_rows = max(1, int(max_block_bytes // (width * bytes_per_pixel)))
+    for row_off in range(0, height, block_rows):
+        yield Window(0, row_off, width, min(block_rows, height - row_off))
+
+
+def _source_window(src, dst_crs, dst_transform, window, margin=2):
+    """Window of ``src`` under the ``window`` of the destination grid, None if outside."""
+    bounds = rasterio.windows.bounds(window, dst_transform)
+    src_bounds = rasterio.warp.transform_bounds(dst_crs, src.crs, *bounds, densify_pts=21)
+    covered = rasterio.windows.from_bounds(*src_bounds, transform=src.transform)
+    col_start = max(0, math.floor(covered.col_off) - margin)
+    row_start = max(0, math.floor(covered.row_off) - margin)
+    col_stop = min(src.width, math.ceil(covered.col_off + covered.width) + margin)
+    row_stop = min(src.height, math.ceil(covered.row_off + covered.height) + margin)
+    if col_stop <= col_start or row_stop <= row_start:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def source_pixels_per_pixel(src, dst_crs, dst_transform, width, height):
+    """Source pixels read for each pixel of the destination grid, to size the strips."""
+    src_window = _source_window(src, dst_crs, dst_transform, Window(0, 0, width, height))
+    if src_window is None:
+        return 1.0
+    return max(1.0, src_window.width * src_window.height / (width * height))
+
+
+def read_reprojected(src, dst_crs, dst_transform, window):
+    """Pixels of ``src`` reprojected onto the ``window`` of the ``(dst_crs, dst_transform)`` grid.
+
+    Nearest neighbour pixels of ``nearest_source_pixels``, like
+    ``reproject_array_like``: a strip gets the same pixels as the whole
+    raster reprojected in memory, whatever its height. Only the source
+    pixels under the strip are read.
+    """
+    fill = src.nodata if src.nodata is not None else 0
+    src_rows, src_cols = nearest_source_pixels(
+        src.crs, src.transform, dst_crs, dst_transform, window
+    )
+    inside = (src_rows >= 0) & (src_rows < src.height) & (src_cols >= 0) & (src_cols < src.width)
+    if not inside.any():
+        return np.full((src.count, window.height, window.width), fill, dtype=src.dtypes[0])
+
+    row_start, col_start = src_rows[inside].min(), src_cols[inside].min()
+    src_window = Window(
+        col_start,
+        row_start,
+        src_cols[inside].max() - col_start + 1,
+        src_rows[inside].max() - row_start + 1,
+    )
+    return sample_nearest(
+        src.read(window=src_window), src_rows - row_start, src_cols - col_start, fill
+    )
+
+
+# Pixel centers, their source coordinates and source pixels of read_reprojected
+NEAREST_BYTES_PER_PIXEL = 64
+
+
+def crop_to_county_windowed(
+    mosaic_path, county_geometries, output_path, max_block_bytes, memory_tracker=None
+):
+    """Block by block ``rasterio.mask.mask(crop=True)`` of the mosaic with the county.
+
+    The mosaic is cropped to the window of the county (EPSG:4326
+    ``county_geometries``) in its own CRS, pixels outside of the county are
+    set to nodata, and the result is written to ``output_path`` one strip of
+    rows at a time. Returns the profile of the GeoTIFF.
+    """
+    with rasterio.open(to_gdal_path(mosaic_path)) as src:
+        county = [
+            rasterio.warp.transform_geom("EPSG:4326", src.crs, geometry)
+            for geometry in county_geometries
+        ]
+        county_window = rasterio.features.geometry_window(src, county)
+        nodata = src.nodata if src.nodata is not None else 0
+        profile = {
+            "driver": "GTiff",
+            "dtype": src.dtypes[0],
+            "count": src.count,
+            "nodata": src.nodata,
+            "crs": src.crs,
+            "transform": src.window_transform(county_window),
+            "width": int(county_window.width),
+            "height": int(county_window.height),
+        }
+
+        # The strip, its mask and the county mask
+        bytes_per_pixel = src.count * (np.dtype(src.dtypes[0]).itemsize + 1) + 1
+        with rasterio.open(output_path, "w", **profile) as dst:
+            for window in row_windows(
+                profile["height"], profile["width"], bytes_per_pixel, max_block_bytes
+            ):
+                src_window = Window(
+                    county_window.col_off + window.col_off,
+                    county_window.row_off + window.row_off,
+                    window.width,
+                    window.height,
+                )
+                block = src.read(window=src_window, masked=True)
+                outside = rasterio.features.geometry_mask(
+                    county,
+                    out_shape=(window.height, window.width),
+                    transform=src.window_transform(src_window),
+                )
+                block.mask = block.mask | outside
+                dst.write(block.filled(nodata), window=window)
+
+                if memory_tracker is not None:
+                    memory_tracker.sample()
+
+    return profile
+
+
+def write_masked_county_mosaic(
+    mosaic_path,
+    county_geometries,
+    crop_mask_images,
+    crop_mask_profile,
+    mosaic_output_path,
+    masked_output_paths,
+    max_block_bytes,
+    memory_tracker=None,
+):
+    """Block by block version of the crop, reprojection and masking of a county mosaic.
+
+    Same steps, in the same order, as the in-memory processing: the mosaic is
+    cropped with the county (EPSG:4326 ``county_geometries``) in its own CRS
+    by ``crop_to_county_windowed``, then reprojected onto the crop mask grid
+    one strip of rows at a time. The strip is written
+    to ``mosaic_output_path`` and, multiplied by each of the
+    ``crop_mask_images`` (all on the ``crop_mask_profile`` grid), to the
+    matching ``masked_output_paths``. Returns the profile of the GeoTIFFs.
+    """
+    county_path = f"{mosaic_output_path}.county.tif"
+    try:
+        crop_to_county_windowed(
+            mosaic_path, county_geometries, county_path, max_block_bytes, memory_tracker
+        )
+        with rasterio.open(county_path) as src:
+            nodata = src.nodata
+            dtype = np.dtype(src.dtypes[0])
+            profile = {
+                "driver": "GTiff",
+                "dtype": src.dtypes[0],
+                "count": src.count,
+                "nodata": nodata,
+                "crs": crop_mask_profile["crs"],
+                "transform": crop_mask_profile["transform"],
+                "width": crop_mask_profile["width"],
+                "height": crop_mask_profile["height"],
+            }
+
+            # The source pixels under the strip, the strip, a masked copy, the crop mask rows
+            # and the coordinates of the nearest source pixels
+            source_pixels = source_pixels_per_pixel(
+                src, profile["crs"], profile["transform"], profile["width"], profile["height"]
+            )
+            bytes_per_pixel = (
+                (source_pixels + 2) * src.count * dtype.itemsize
+                + crop_mask_images[0].dtype.itemsize
+                + NEAREST_BYTES_PER_PIXEL
+            )
+            with ExitStack() as datasets:
+                mosaic_dst = datasets.enter_context(
+                    rasterio.open(mosaic_output_path, "w", **profile)
+                )
+                masked_dsts = [
+                    datasets.enter_context(rasterio.open(masked_output_path, "w", **profile))
+                    for masked_output_path in masked_output_paths
+                ]
+                for window in row_windows(
+                    profile["height"], profile["width"], bytes_per_pixel, max_block_bytes
+                ):
+                    block = read_reprojected(src, profile["crs"], profile["transform"], window)
+                    mosaic_dst.write(block, window=window)
+
+                    rows = slice(window.row_off, window.row_off + window.height)
+                    block_nodata = block == nodata if nodata is not None else None
+                    for crop_mask_image, masked_dst in zip(crop_mask_images, masked_dsts):
+                        # Like rio calc, pixels without data in the mosaic stay nodata
+                        masked = (block * crop_mask_image[:1, rows]).astype(dtype)
+                        if block_nodata is not None:
+                            masked[block_nodata] = nodata
+                        masked_dst.write(masked, window=window)
+
+                    if memory_tracker is not None:
+                        memory_tracker.sample()
+    finally:
+        if os.path.exists(county_path):
+            os.remove(county_path)
+
+    return profile
+
+
+def zonal_statistics_windowed(
+    raster_path,
+    cells,
+    band_names,
+    max_block_bytes,
+    dst_crs="EPSG:4326",
+    stats=None,
+    memory_tracker=None,
+):
+    """Statistics of the cells over ``raster_path`` reprojected to ``dst_crs``, block by block.
+
+    The raster is reprojected to ``dst_crs``, on the grid ``rio warp
+    --dst-crs`` would pick, one strip of rows at a time; the cells are
+    rasterized on each strip and the statistics are accumulated, so only one
+    strip is in memory.
+    """
+    cells = list(cells)
+    cells_bounds = np.array([cell.bounds for cell in cells]).reshape(-1, 4)
+
+    with rasterio.open(raster_path) as src:
+        transform, width, height = rasterio.warp.calculate_default_transform(
+            src.crs, dst_crs, src.width, src.height, *src.bounds
+        )
+        accumulator = ZonalStatisticsAccumulator(
+            len(cells), band_names, nodata=src.nodata, stats=stats
+        )
+        # The source pixels under the strip, the strip, the cell labels of its pixels and
+        # the coordinates of the nearest source pixels
+        source_pixels = source_pixels_per_pixel(src, dst_crs, transform, width, height)
+        bytes_per_pixel = (
+            (source_pixels + 1) * src.count * np.dtype(src.dtypes[0]).itemsize
+            + 4
+            + NEAREST_BYTES_PER_PIXEL
+        )
+        for window in row_windows(height, width, bytes_per_pixel, max_block_bytes):
+            left, bottom, right, top = rasterio.windows.bounds(window, transform)
+            in_window = np.flatnonzero(
+                (cells_bounds[:, 0] <= right)
+                & (cells_bounds[:, 2] >= left)
+                & (cells_bounds[:, 1] <= top)
+                & (cells_bounds[:, 3] >= bottom)
+            )
+            if not in_window.size:
+                continue
+
+            labels = rasterio.features.rasterize(
+                ((cells[idx], idx + 1) for idx in in_window),
+                out_shape=(window.height, window.width),
+                transform=rasterio.windows.transform(window, transform),
+                fill=0,
+                dtype="int32",
+            )
+            accumulator.update(labels, read_reprojected(src, dst_crs, transform, window))
+
+            if memory_tracker is not None:
+                memory_tracker.sample()
+
+    return accumulator.result()
@@ -0,0 +1,302 @@
+import hashlib
+import io
+import json
+import logging
+import os
+
+import boto3
+import botocore
+import numpy as np
+import pandas as pd
+import rasterio.features
+
+logger = logging.getLogger()
+
+s3_client = boto3.client("s3")
+
+ZONAL_STATISTICS = ["min", "max", "mean", "count", "sum"]
+
+# Statistics computed by rasterstats.zonal_stats by default, in its order
+DEFAULT_ZONAL_STATISTICS = ["min", "max", "mean", "count"]
+
+
+def rasterize_cell_labels(geometries, transform, shape, all_touched=False):
+    """Label grid of the cells on the raster grid ``(transform, shape)``.
+
+    A pixel holds the 1-based position of the cell in ``geometries`` its
+    center falls in (any cell it touches with ``all_touched``), 0 outside of
+    every cell, the same pixel selection rasterstats makes for each polygon.
+    """
+    return rasterio.features.rasterize(
+        ((geometry, idx + 1) for idx, geometry in enumerate(geometries)),
+        out_shape=shape,
+        transform=transform,
+        fill=0,
+        all_touched=all_touched,
+        dtype="int32",
+    )
+
+
+class ZonalLabelIndex:
+    """Pixels of every cell of a label grid, grouped by cell.
+
+    ``pixels[offsets[i]:offsets[i + 1]]`` are the flat offsets of the pixels
+    of cell ``i``, so reducing a band over the cells is a gather followed by
+    segment reductions, without rasterizing the cells again.
+    """
+
+    def __init__(self, pixels, offsets, shape, cell_ids=None):
+        self.pixels = pixels
+        self.offsets = offsets
+        self.shape = tuple(shape)
+        self.cell_ids = cell_ids
+
+    @classmethod
+    def from_labels(cls, labels, n_zones, cell_ids=None):
+        flat_labels = labels.ravel()
+        pixels = np.flatnonzero(flat_labels)
+        # Stable sorts of 16 bits integers are radix sorts
+        sort_labels = flat_labels[pixels]
+        if n_zones < np.iinfo(np.uint16).max:
+            sort_labels = sort_labels.astype(np.uint16)
+        pixels = pixels[np.argsort(sort_labels, kind="stable")]
+        offsets = np.searchsorted(flat_labels[pixels], np.arange(1, n_zones + 2))
+        return cls(pixels, offsets, labels.shape, cell_ids)
+
+    @property
+    def n_zones(self):
+        return len(self.offsets) - 1
+
+    def to_bytes(self):
+        pixels_dtype = np.uint32 if np.prod(self.shape) < 2**32 else np.int64
+        arrays = {
+            "pixels": self.pixels.astype(pixels_dtype),
+            "offsets": self.offsets.astype(np.int64),
+            "shape": np.asarray(self.shape, dtype=np.int64),
+        }
+        if self.cell_ids is not None:
+            arrays["cell_ids"] = np.asarray(self.cell_ids)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, content):
+        with np.load(io.BytesIO(content)) as arrays:
+            return cls(
+                arrays["pixels"].astype(np.int64),
+                arrays["offsets"],
+                arrays["shape"],
+                arrays["cell_ids"] if "cell_ids" in arrays else None,
+            )
+
+
+def cell_index_key(fips, cells, transform, crs, shape, all_touched=False):
+    """Cache key of the label index of ``cells`` over a raster grid.
+
+    Hashes the grid (transform, CRS, shape) and the cells geometries, so any
+    change of the cell polygons or of the crop mask grid builds a new index.
+    """
+    digest = hashlib.sha256(
+        json.dumps(
+            [fips, list(transform)[:6], str(crs), list(shape), all_touched], default=str
+        ).encode("UTF-8")
+    )
+    for geometry in cells:
+        digest.update(geometry.wkb)
+    return f"{fips}-{digest.hexdigest()[:24]}"
+
+
+class ZonalLabelIndexCache:
+    """Label indexes of the cells, built once and reused across weeks and indices.
+
+    The cell polygons and the crop mask grid of a county do not change within
+    a season, so the index is kept in memory for the process and saved as a
+    compressed ``{uri}/{key}.npz`` (local directory or S3 prefix) for the
+    next executors and runs. Without ``uri`` indexes are only kept in memory.
+    """
+
+    def __init__(self, uri=None):
+        self.uri = uri.rstrip("/") if uri else None
+        self._indexes = {}
+
+    def _read(self, key):
+        uri = f"{self.uri}/{key}.npz"
+        if uri.startswith("s3://"):
+            bucket, object_key = uri[len("s3://") :].split("/", 1)
+            try:
+                response = s3_client.get_object(Bucket=bucket, Key=object_key)
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] == "NoSuchKey":
+                    return None
+                raise
+            return response["Body"].read()
+
+        if not os.path.exists(uri):
+            return None
+        with open(uri, "rb") as index_file:
+            return index_file.read()
+
+    def _write(self, key, content):
+        uri = f"{self.uri}/{key}.npz"
+        if uri.startswith("s3://"):
+            bucket, object_key = uri[len("s3://") :].split("/", 1)
+            s3_client.put_object(Bucket=bucket, Key=object_key, Body=content)
+            return
+
+        os.makedirs(self.uri, exist_ok=True)
+        # Worker processes may build the same index, each writes its own temp file
+        with open(f"{uri}.{os.getpid()}.tmp", "wb") as index_file:
+            index_file.write(content)
+        os.replace(f"{uri}.{os.getpid()}.tmp", uri)
+
+    def get(self, fips, cells, transform, crs, shape, cell_ids=None, all_touched=False):
+        """Label index of ``cells`` over the grid, built if it is not cached yet."""
+        cells = list(cells)
+        key = cell_index_key(fips, cells, transform, crs, shape, all_touched)
+        if key in self._indexes:
+            return self._indexes[key]
+
+        content = self._read(key) if self.uri else None
+        if content is not None:
+            logger.info(f"Loaded the cells label index {key}")
+            index = ZonalLabelIndex.from_bytes(content)
+        else:
+            logger.info(f"Building the cells label index {key}")
+            labels = rasterize_cell_labels(cells, transform, shape, all_touched)
+            index = ZonalLabelIndex.from_labels(labels, len(cells), cell_ids)
+            if self.uri:
+                self._write(key, index.to_bytes())
+
+        self._indexes[key] = index
+        return index
+
+
+def zonal_statistics(index, bands, band_names, nodata=None, stats=None):
+    """Statistics of every band over the cells of ``index``.
+
+    ``bands`` is a ``(band, height, width)`` array on the grid of the index,
+    pixels equal to ``nodata`` or NaN are ignored. Returns one row per cell
+    with ``{stat}_{band_name}`` columns, the layout of the rasterstats based
+    zonal statistics files (NaN statistics for cells without valid pixels).
+    """
+    stats = stats or DEFAULT_ZONAL_STATISTICS
+    unknown = [stat for stat in stats if stat not in ZONAL_STATISTICS]
+    if unknown:
+        raise ValueError(f"Unsupported zonal statistics {unknown}, expected {ZONAL_STATISTICS}")
+    if bands.shape[1:] != index.shape:
+        raise ValueError(f"Bands of shape {bands.shape[1:]} do not match the index {index.shape}")
+
+    # Segment reductions over the cells with at least one pixel
+    not_empty = np.diff(index.offsets) > 0
+    starts = index.offsets[:-1][not_empty]
+
+    columns = {}
+    for band, band_name in zip(bands, band_names):
+        # Gather the pixels of the cells, grouped by cell
+        values = np.take(band.ravel(), index.pixels)
+        valid = np.ones(values.shape, dtype=bool)
+        if np.issubdtype(values.dtype, np.floating):
+            valid &= ~np.isnan(values)
+        if nodata is not None:
+            valid &= values != nodata
+
+        reduced = {"count": np.zeros(index.n_zones, dtype=np.int64)}
+        if starts.size:
+            reduced["count"][not_empty] = np.add.reduceat(valid, starts, dtype=np.int64)
+            if "sum" in stats or "mean" in stats:
+                reduced["sum"] = np.add.reduceat(
+                    np.where(valid, values, 0), starts, dtype=np.float64
+                )
+            if "min" in stats or "max" in stats:
+                # fmin and fmax skip the NaN put in place of the invalid pixels
+                values = np.where(valid, values, np.nan)
+                reduced["min"] = np.fmin.reduceat(values, starts)
+                reduced["max"] = np.fmax.reduceat(values, starts)
+            if "mean" in stats:
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    reduced["mean"] = reduced["sum"] / reduced["count"][not_empty]
+
+        has_data = reduced["count"] > 0
+        for stat in stats:
+            if stat == "count":
+                columns[f"count_{band_name}"] = reduced["count"]
+                continue
+            column = np.full(index.n_zones, np.nan)
+            if starts.size:
+                column[not_empty] = reduced[stat]
+            column[~has_data] = np.nan
+            columns[f"{stat}_{band_name}"] = column
+
+    return pd.DataFrame(columns)
+
+
+class ZonalStatisticsAccumulator:
+    """Statistics of the cells accumulated over the blocks of a raster.
+
+    Each ``update`` reduces a block of bands with the cell labels of the same
+    block (``rasterize_cell_labels`` over the block window), so the raster
+    never has to be held in memory at once. ``result`` returns the same
+    frame ``zonal_statistics`` computes over the whole raster.
+    """
+
+    def __init__(self, n_zones, band_names, nodata=None, stats=None):
+        self.stats = stats or DEFAULT_ZONAL_STATISTICS
+        unknown = [stat for stat in self.stats if stat not in ZONAL_STATISTICS]
+        if unknown:
+            raise ValueError(f"Unsupported zonal statistics {unknown}, expected {ZONAL_STATISTICS}")
+        self.n_zones = n_zones
+        self.band_names = list(band_names)
+        self.nodata = nodata
+        # Zone 0 collects the pixels outside of every cell
+        shape = (len(self.band_names), n_zones + 1)
+        self._count = np.zeros(shape, dtype=np.int64)
+        self._sum = np.zeros(shape, dtype=np.float64)
+        self._min = np.full(shape, np.nan)
+        self._max = np.full(shape, np.nan)
+
+    def update(self, labels, bands):
+        """Add a ``(band, height, width)`` block and the cell labels of its pixels."""
+        if bands.shape[1:] != labels.shape:
+            raise ValueError(
+                f"Bands of shape {bands.shape[1:]} do not match the labels {labels.shape}"
+            )
+
+        flat_labels = labels.ravel()
+        inside = flat_labels > 0
+        flat_labels = flat_labels[inside]
+        for band_idx, band in enumerate(bands):
+            values = band.ravel()[inside]
+            valid = np.ones(values.shape, dtype=bool)
+            if np.issubdtype(values.dtype, np.floating):
+                valid &= ~np.isnan(values)
+            if self.nodata is not None:
+                valid &= values != self.nodata
+
+            zones, values = flat_labels[valid], values[valid].astype(np.float64)
+            self._count[band_idx] += np.bincount(zones, minlength=self.n_zones + 1)
+            self._sum[band_idx] += np.bincount(zones, weights=values, minlength=self.n_zones + 1)
+            np.fmin.at(self._min[band_idx], zones, values)
+            np.fmax.at(self._max[band_idx], zones, values)
+
+    def result(self):
+        columns = {}
+        for band_idx, band_name in enumerate(self.band_names):
+            count = self._count[band_idx, 1:]
+            has_data = count > 0
+            with np.errstate(divide="ignore", invalid="ignore"):
+                reduced = {
+                    "min": self._min[band_idx, 1:],
+                    "max": self._max[band_idx, 1:],
+                    "sum": self._sum[band_idx, 1:],
+                    "mean": self._sum[band_idx, 1:] / count,
+                }
+            for stat in self.stats:
+                if stat == "count":
+                    columns[f"count_{band_name}"] = count
+                    continue
+                column = reduced[stat].copy()
+                column[~has_data] = np.nan
+                columns[f"{stat}_{band_name}"] = column
+
+        return pd.DataFrame(columns)
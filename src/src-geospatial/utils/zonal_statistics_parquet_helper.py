@@ -0,0 +1,100 @@
+import io
+import logging
+
+import fsspec
+import geopandas as gp
+import pandas as pd
+import pyarrow.parquet as pq
+
+logger = logging.getLogger()
+
+
+def zonal_statistics_parquet_uri(dataset_uri, type_of_crop, year, isoweek, fips):
+    """Hive partitioned location of a (crop, year, week, FIPS) statistics file."""
+    return (
+        f"{dataset_uri}/crop_type={type_of_crop}/year={int(year)}/isoweek={int(isoweek)}"
+        f"/zonal_stats_{fips}.parquet"
+    )
+
+
+def cell_polygons_parquet_uri(cells_uri, fips):
+    # Not a partition, FIPS codes would be read back as integers without their leading zero
+    return f"{cells_uri}/cell_polygons_{fips}.parquet"
+
+
+def write_zonal_statistics_parquet(stats_df, zonal_polygons, uri):
+    """Write the statistics of the cells with their attributes, without their geometry.
+
+    Crop, year and week are not stored in the file, they are the partition
+    columns of the dataset.
+    """
+    attributes = pd.DataFrame(zonal_polygons.drop(columns=zonal_polygons.geometry.name))
+    pd.concat([stats_df, attributes], axis=1).to_parquet(uri, index=False)
+
+
+# Parquet key-value metadata holding the polygons_digest of the cell polygons file
+POLYGONS_DIGEST_METADATA_KEY = b"polygons_digest"
+
+
+def read_cell_polygons_digest(uri):
+    """``polygons_digest`` stored in a cell polygons file, None if missing.
+
+    Only the Parquet footer is read.
+    """
+    try:
+        with fsspec.open(uri, "rb") as parquet_file:
+            metadata = pq.read_schema(parquet_file).metadata or {}
+    except FileNotFoundError:
+        return None
+    digest = metadata.get(POLYGONS_DIGEST_METADATA_KEY)
+    return digest.decode("UTF-8") if digest is not None else None
+
+
+def write_cell_polygons_parquet(zonal_polygons, uri, digest):
+    """Write the cell polygons of a county as GeoParquet, shared by all the weeks.
+
+    ``digest`` (``polygons_digest`` of the shapefile) is stored in the
+    Parquet metadata; the file is only rewritten when it changes, new cell
+    polygons replace stale ones.
+    """
+    if read_cell_polygons_digest(uri) == digest:
+        return False
+    logger.info(f"Write the cell polygons to {uri}")
+    buffer = io.BytesIO()
+    zonal_polygons.to_parquet(buffer, index=False)
+    buffer.seek(0)
+    table = pq.read_table(buffer)
+    table = table.replace_schema_metadata(
+        {**table.schema.metadata, POLYGONS_DIGEST_METADATA_KEY: digest.encode("UTF-8")}
+    )
+    with fsspec.open(uri, "wb") as parquet_file:
+        pq.write_table(table, parquet_file)
+    return True
+
+
+def read_zonal_statistics(dataset_uri, type_of_crop=None, year=None, isoweeks=None, columns=None):
+    """Read the cells statistics matching the crop, year and weeks filters.
+
+    Partition filters are pushed down to Parquet, only the files and the
+    ``columns`` needed are read. ``crop_type``, ``year`` and ``isoweek`` are
+    returned as columns.
+    """
+    filters = []
+    if type_of_crop is not None:
+        filters.append(("crop_type", "=", type_of_crop))
+    if year is not None:
+        filters.append(("year", "=", int(year)))
+    if isoweeks is not None:
+        filters.append(("isoweek", "in", [int(week) for week in isoweeks]))
+
+    return pd.read_parquet(dataset_uri, columns=columns, filters=filters or None)
+
+
+def read_cell_polygons(cells_uri, fips=None):
+    """Cell polygons of the counties, to join with the statistics on ``id_10``."""
+    if fips is None:
+        return gp.read_parquet(cells_uri)
+    return pd.concat(
+        [gp.read_parquet(cell_polygons_parquet_uri(cells_uri, f)) for f in fips],
+        ignore_index=True,
+    )